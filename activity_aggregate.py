@@ -0,0 +1,116 @@
+'''
+The aggregate module combines the activity data of many instances, so they
+can be compared or totalled on the chart as a few lines rather than a line for
+every instance.
+
+The values of each instance (divided by the number of times each week was
+collected, as on the chart) are placed in one 2-D array, with a row for each
+instance and a column for each week. Instances are matched on a shared grid
+of weeks starting on Mondays (UTC), so weeks given by instances in different
+time zones are placed in the same column. If several weeks of an instance
+are placed in the same column (such as after its time zone changed), their
+values are averaged. Weeks an instance has no data for are NaN, and are left
+out of the statistics for that week.
+
+For each week, the total, median and percentiles of the instances' values,
+the number of instances with data, and each instance's share of the total are
+then calculated at once for every week with NumPy.
+'''
+
+import numpy
+from activity_analytics import weekly_averages
+
+WEEK = 7 * 24 * 60 * 60
+DAY = 24 * 60 * 60
+
+# The first Monday after the Unix epoch (a Thursday), which the grid of weeks
+# is aligned to.
+FIRST_MONDAY = 4 * DAY
+
+# The percentiles of the instances' values shown around the median.
+PERCENTILES = (25, 75)
+
+# The most instances shown separately in a stacked chart of each instance's
+# share. The rest are added together.
+STACK_LIMIT = 10
+
+
+# Get the number of the week on the shared grid for each week, rounding each
+# to the nearest Monday.
+def week_numbers(weeks):
+    return (numpy.asarray(weeks, dtype=numpy.int64) - FIRST_MONDAY
+            + WEEK // 2) // WEEK
+
+
+# Place the values of a metric for each [name, DataFrame] pair in
+# data_df_array in one array, with a row for each instance and a column for
+# each week on the shared grid that any instance has data for. Returns the
+# names of the instances, the weeks (as Unix timestamps) and the array.
+def align_instances(data_df_array, metric):
+    names = [name for name, data_df in data_df_array]
+    numbers = [week_numbers(data_df['week'].to_numpy())
+               for name, data_df in data_df_array]
+    all_numbers = numpy.concatenate(numbers) if numbers else numpy.empty(
+        0, dtype=numpy.int64)
+    grid = numpy.unique(all_numbers)
+    values = numpy.full((len(names), len(grid)), numpy.nan)
+    if len(grid) > 0:
+        rows = numpy.repeat(numpy.arange(len(names)),
+                            [len(instance_numbers)
+                             for instance_numbers in numbers])
+        columns = numpy.searchsorted(grid, all_numbers)
+        # Add up the values placed in each cell and count them, so the weeks
+        # of an instance placed in the same column are averaged.
+        totals = numpy.zeros(values.shape)
+        counts = numpy.zeros(values.shape, dtype=numpy.int64)
+        numpy.add.at(totals, (rows, columns), numpy.concatenate(
+            [weekly_averages(data_df, metric)
+             for name, data_df in data_df_array]))
+        numpy.add.at(counts, (rows, columns), 1)
+        filled = counts > 0
+        values[filled] = totals[filled] / counts[filled]
+    return names, grid * WEEK + FIRST_MONDAY, values
+
+
+# Calculate the statistics of a metric across the instances in data_df_array
+# for each week. Returns a dictionary of the instances' names, the weeks, the
+# aligned values, and (for each week) the number of instances with data
+# ('reporting'), the 'total', 'median', 'lower' and 'upper' percentiles of
+# their values, and the 'share' of the total of each instance.
+def aggregate_instances(data_df_array, metric, percentiles=PERCENTILES):
+    names, weeks, values = align_instances(data_df_array, metric)
+    aggregate = {'names': names, 'weeks': weeks, 'values': values,
+                 'percentiles': percentiles}
+    # Every week on the grid has data for at least one instance, so no
+    # statistic is taken of a week without values.
+    aggregate['reporting'] = numpy.count_nonzero(~numpy.isnan(values), axis=0)
+    aggregate['total'] = numpy.nansum(values, axis=0)
+    if len(weeks) > 0:
+        aggregate['median'] = numpy.nanmedian(values, axis=0)
+        aggregate['lower'], aggregate['upper'] = numpy.nanpercentile(
+            values, percentiles, axis=0)
+    else:
+        for key in ('median', 'lower', 'upper'):
+            aggregate[key] = numpy.empty(0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        aggregate['share'] = numpy.where(aggregate['total'] > 0,
+                                         values / aggregate['total'],
+                                         numpy.nan)
+    return aggregate
+
+
+# Get the shares of the total to show in a stacked chart: the limit - 1
+# instances with the largest average share, and the rest added together (if
+# there are more than limit instances). Returns the labels and an array of the
+# shares, with a row for each label, with 0 for weeks without data.
+def stacked_shares(aggregate, limit=STACK_LIMIT):
+    shares = numpy.nan_to_num(aggregate['share'])
+    names = aggregate['names']
+    if len(names) <= limit:
+        return list(names), shares
+    order = numpy.argsort(-shares.mean(axis=1), kind='stable')
+    kept = order[:limit - 1]
+    others = shares[order[limit - 1:]].sum(axis=0)
+    return ([names[position] for position in kept]
+            + [str(len(names) - limit + 1) + ' other instances'],
+            numpy.vstack((shares[kept], others)))
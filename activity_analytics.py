@@ -0,0 +1,221 @@
+'''
+The analytics module calculates series derived from an instance's activity
+data, which can be shown on the chart alongside the collected values:
+- 'rolling': the average of each value over the last ROLLING_WEEKS weeks.
+- 'weekly_growth': the change in each value since the previous week.
+- 'yearly_growth': the change in each value since the same week a year
+  earlier.
+- 'cumulative': the running total of each value (such as the total number of
+  registrations since data was first collected).
+- 'anomalies': the weeks whose value is more than ANOMALY_THRESHOLD standard
+  deviations from the average of the previous ANOMALY_WEEKS weeks.
+
+As with the chart, each value is first divided by the number of times its
+week was collected. Every series is calculated for an instance's whole
+history at once with NumPy, so the rolling averages and anomalies at the start
+of a date range use the weeks before it. The series, and the resolutions they
+are drawn at (see activity_lod), are cached for each instance until its data
+changes, so only the date range has to be selected when the chart is redrawn.
+
+Weeks are matched by their dates rather than their positions, so missing
+weeks are not compared with the wrong week. Weeks without a value (such as the
+first weeks of a rolling average) are left out of each series.
+'''
+
+from threading import Lock
+import numpy
+from activity_frames import select_weeks
+from activity_lod import build_levels
+
+WEEK = 7 * 24 * 60 * 60
+
+# The difference allowed between the date of a week and the date it is
+# matched with (the start of a week moves by an hour when the clocks change).
+WEEK_TOLERANCE = 24 * 60 * 60
+
+# The number of weeks averaged by the rolling average.
+ROLLING_WEEKS = 4
+
+# The number of previous weeks a week is compared with to find anomalies, and
+# the number of standard deviations from their average that is an anomaly.
+ANOMALY_WEEKS = 12
+ANOMALY_THRESHOLD = 3
+
+# The series that can be derived, and how they are described on the chart.
+SERIES = {'rolling': str(ROLLING_WEEKS) + '-week average',
+          'weekly_growth': 'week-over-week growth',
+          'yearly_growth': 'year-over-year growth',
+          'cumulative': 'cumulative total',
+          'anomalies': 'anomalies'}
+
+# The series that are changes as a fraction, rather than values.
+GROWTH_SERIES = ('weekly_growth', 'yearly_growth')
+
+
+# Get each value of a metric divided by the number of times its week was
+# collected.
+def weekly_averages(data_df, metric):
+    return (data_df[metric].to_numpy(dtype=numpy.float64)
+            / numpy.maximum(data_df['count'].to_numpy(), 1))
+
+
+# Get the average of each value and the window - 1 values before it. The
+# first window - 1 averages are NaN.
+def rolling_mean(values, window):
+    averages = numpy.full(len(values), numpy.nan)
+    if len(values) >= window:
+        totals = numpy.cumsum(numpy.concatenate(([0.0], values)))
+        averages[window - 1:] = (totals[window:] - totals[:-window]) / window
+    return averages
+
+
+# Get the value of the week the given number of weeks before each week, or
+# NaN if that week was not collected.
+def lagged_values(weeks, values, lag):
+    targets = weeks - lag * WEEK
+    positions = numpy.minimum(numpy.searchsorted(
+        weeks, targets - WEEK_TOLERANCE), max(len(weeks) - 1, 0))
+    lagged = numpy.full(len(values), numpy.nan)
+    if len(weeks) == 0:
+        return lagged
+    found = numpy.abs(weeks[positions] - targets) <= WEEK_TOLERANCE
+    lagged[found] = values[positions[found]]
+    return lagged
+
+
+# Get the change in each value since the given number of weeks before, as a
+# fraction. The change is NaN if the earlier week was not collected or its
+# value was 0.
+def growth(weeks, values, lag):
+    previous = lagged_values(weeks, values, lag)
+    changes = numpy.full(len(values), numpy.nan)
+    valid = previous > 0
+    changes[valid] = values[valid] / previous[valid] - 1
+    return changes
+
+
+# Get the number of standard deviations each value is from the average of the
+# window values before it. The score is NaN for the first window values and
+# for values whose previous values are all the same.
+def z_scores(values, window):
+    scores = numpy.full(len(values), numpy.nan)
+    if len(values) <= window:
+        return scores
+    totals = numpy.cumsum(numpy.concatenate(([0.0], values)))
+    squares = numpy.cumsum(numpy.concatenate(([0.0], values * values)))
+    means = (totals[window:-1] - totals[:-window - 1]) / window
+    variances = ((squares[window:-1] - squares[:-window - 1]) / window
+                 - means * means)
+    deviations = numpy.sqrt(numpy.maximum(variances, 0))
+    varied = deviations > 1e-9 * numpy.maximum(numpy.abs(means), 1)
+    current = values[window:]
+    scores[window:][varied] = ((current[varied] - means[varied])
+                               / deviations[varied])
+    return scores
+
+
+# Calculate a derived series of a metric for every week of an instance's
+# data. Returns the weeks and values of the series, leaving out the weeks
+# without a value. The values of 'anomalies' are the metric's values in the
+# anomalous weeks.
+def derive_series(data_df, metric, series):
+    weeks = data_df['week'].to_numpy()
+    values = weekly_averages(data_df, metric)
+    if series == 'rolling':
+        derived = rolling_mean(values, ROLLING_WEEKS)
+    elif series == 'weekly_growth':
+        derived = growth(weeks, values, 1)
+    elif series == 'yearly_growth':
+        derived = growth(weeks, values, 52)
+    elif series == 'cumulative':
+        derived = numpy.cumsum(values)
+    elif series == 'anomalies':
+        scores = z_scores(values, ANOMALY_WEEKS)
+        derived = numpy.where(numpy.abs(scores) > ANOMALY_THRESHOLD, values,
+                              numpy.nan)
+    else:
+        raise ValueError('Unknown series: ' + series)
+    kept = ~numpy.isnan(derived)
+    return weeks[kept], derived[kept]
+
+
+# A cache of the series derived from the data in an instance cache (see
+# activity_frames). The series of an instance are calculated when they are
+# first needed, and again once its data changes. They are removed when the
+# instance's data is removed from the instance cache, so they are only kept
+# for the instances within its memory budget.
+class AnalyticsCache:
+    def __init__(self, data):
+        self.data = data
+        self.entries = {}
+        self.lock = Lock()
+        data.on_removal(self.discard)
+
+    # Get the cached series of an instance, replacing them if its data has
+    # changed since they were calculated. Returns the instance cache's entry
+    # and the cached series.
+    def cached(self, name):
+        entry = self.data.entry(name)
+        with self.lock:
+            cached = self.entries.get(name)
+            if cached is None or cached['generation'] != entry['generation']:
+                cached = {'generation': entry['generation'], 'series': {},
+                          'levels': {}}
+                self.entries[name] = cached
+        return entry, cached
+
+    # Get a derived series of a metric for an instance, as its weeks and
+    # values. If start and end are given, only the weeks from start up to
+    # (but not including) end are returned.
+    def series(self, name, metric, series, start=None, end=None):
+        entry, cached = self.cached(name)
+        with self.lock:
+            result = cached['series'].get((metric, series))
+        if result is None:
+            result = derive_series(entry['frame'], metric, series)
+            with self.lock:
+                cached['series'][(metric, series)] = result
+        weeks, values = result
+        if start is None:
+            return weeks, values
+        first, last = select_weeks(weeks, start, end)
+        return weeks[first:last], values[first:last]
+
+    # Get the resolutions a derived series of a metric for an instance is
+    # drawn at (see build_levels), for its whole history.
+    def levels(self, name, metric, series):
+        entry, cached = self.cached(name)
+        with self.lock:
+            levels = cached['levels'].get((metric, series))
+        if levels is None:
+            levels = build_levels(*self.series(name, metric, series))
+            with self.lock:
+                cached['levels'][(metric, series)] = levels
+        return levels
+
+    # Get the derived series to show for each [name, DataFrame] pair in
+    # data_df_array, as [name, metric, series, weeks, values] lists. The date
+    # range of each DataFrame is used.
+    def derived_array(self, data_df_array, metrics, series_names):
+        derived = []
+        for name, data_df in data_df_array:
+            start = end = None
+            if len(data_df) > 0:
+                weeks = data_df['week'].to_numpy()
+                start, end = int(weeks[0]), int(weeks[-1]) + 1
+            for metric in metrics:
+                for series in series_names:
+                    if len(data_df) == 0:
+                        weeks = numpy.empty(0, dtype=numpy.int64)
+                        values = numpy.empty(0)
+                    else:
+                        weeks, values = self.series(name, metric, series,
+                                                    start, end)
+                    derived.append([name, metric, series, weeks, values])
+        return derived
+
+    # Remove the series of an instance, so that they are calculated again
+    # when they are next needed.
+    def discard(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
@@ -0,0 +1,285 @@
+'''
+The conversion module merges data files written by earlier versions (pickled
+lists of weeks with string values) into the collected data of an instance. It
+is used by the data-conversion tool.
+
+The source files for an instance are read one at a time, and the weeks in
+each are merged into the instance's data using the dictionary-based merge
+engine. Once every source file has been merged, the instance's data is
+written once, as a new snapshot in the current format. The snapshot is
+written to a temporary file and then swapped in, and is read back to check
+that it was stored correctly. The data is loaded, merged and written while
+holding the instance's writer lock, so no week stored by the back-end in the
+meantime is lost.
+
+The SHA-256 checksum of every source file merged into an instance is recorded
+in a manifest ('./data_files/.conversion-manifest.json'), and files that have
+already been merged are skipped, so running the same conversion again does
+not change the data. The weeks the conversion changed are also recorded, with
+the number of samples ('count') of each. Collecting more data only adds to
+the count of a week, so if a recorded week is missing or has a lower count,
+the data has been replaced since (for example, restored from a backup), and
+this is reported.
+
+The snapshot and the manifest cannot be replaced in one step, so before the
+snapshot is written, a marker recording the files being merged and the weeks
+they change is written to './data_files/.conversion-pending/'. The marker is
+removed once the manifest is updated. If the conversion stops in between, the
+next conversion finds the marker: if the instance's data contains the weeks
+it records, the files are recorded as merged, and otherwise the marker is
+discarded.
+
+A migration can be run as a dry run, which reports the weeks that would be
+added or changed (with their values before and after) without writing
+anything.
+'''
+
+from hashlib import sha256
+from json import dumps, loads
+from os import fsync, listdir, makedirs, path, replace
+from pickle import load
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+import numpy
+from activity_merge import SUMMED_KEYS, index_weeks, merge_activity
+from activity_storage import (COLUMNS, DATA_DIRECTORY, instance_exists,
+                              load_columns, load_instance,
+                              records_to_columns, remove_if_exists,
+                              write_columns_locked, writer_lock)
+
+# The file the checksums of the merged source files are recorded in.
+MANIFEST_FILE = path.join(DATA_DIRECTORY, '.conversion-manifest.json')
+
+# The directory the markers of unfinished conversions are written to.
+PENDING_DIRECTORY = path.join(DATA_DIRECTORY, '.conversion-pending')
+
+# The values reported for each week that is added or changed.
+REPORTED_KEYS = SUMMED_KEYS + ('count',)
+
+
+# Convert the values of a week stored by an earlier version to integers.
+def prepare_stored_entry(entry):
+    prepared = {'week': int(entry['week']),
+                'count': int(entry.get('count', 1))}
+    for key in SUMMED_KEYS:
+        prepared[key] = int(entry[key])
+    return prepared
+
+
+# Get the data already collected for an instance, or an empty list if none
+# has been collected. If the data exists but cannot be read, the exception is
+# raised, so the data is never replaced by the converted data alone.
+def load_existing(name):
+    if not instance_exists(name):
+        return []
+    return load_instance(name)
+
+
+# Read a data file written by an earlier version.
+def read_legacy_file(file_path):
+    with open(file_path, 'rb') as legacy_file:
+        return load(legacy_file)
+
+
+# Read the weeks in each source file in turn, yielding the weeks of one file
+# at a time, prepared for merging.
+def stream_sources(source_paths):
+    for source_path in source_paths:
+        yield [prepare_stored_entry(entry)
+               for entry in read_legacy_file(source_path)]
+
+
+# Get the SHA-256 checksum of a file.
+def file_checksum(file_path):
+    checksum = sha256()
+    with open(file_path, 'rb') as checked_file:
+        for block in iter(lambda: checked_file.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+# Get the SHA-256 checksum of an instance's data in columns.
+def columns_checksum(columns):
+    return sha256(numpy.ascontiguousarray(columns, dtype=numpy.int64)
+                  .tobytes()).hexdigest()
+
+
+# Get the weeks changed by a merge, as a sorted list of [week, count] pairs.
+def merged_weeks(changed_entries):
+    return sorted([int(entry['week']), int(entry['count'])]
+                  for entry in changed_entries)
+
+
+# Check whether an instance's data still contains the weeks written by a
+# conversion (given by merged_weeks), each with at least the number of samples
+# it had then.
+def contains_weeks(name, weeks):
+    if not weeks:
+        return True
+    if not instance_exists(name):
+        return False
+    columns = load_columns(name)
+    if columns.shape[1] == 0:
+        return False
+    recorded = numpy.array(weeks, dtype=numpy.int64).reshape(-1, 2)
+    positions = numpy.minimum(columns[0].searchsorted(recorded[:, 0]),
+                              columns.shape[1] - 1)
+    return bool(numpy.all(
+        (columns[0][positions] == recorded[:, 0])
+        & (columns[COLUMNS.index('count')][positions] >= recorded[:, 1])))
+
+
+# Load the manifest of the source files merged into each instance, as a
+# dictionary keyed by the instance's name.
+def load_manifest(manifest_file=MANIFEST_FILE):
+    try:
+        with open(manifest_file, 'r') as manifest:
+            return loads(manifest.read())
+    except (OSError, ValueError):
+        return {}
+
+
+# Write a JSON file, replacing the previous file in one step.
+def write_json(file_path, value):
+    directory = path.dirname(file_path) or '.'
+    makedirs(directory, exist_ok=True)
+    with NamedTemporaryFile('w', dir=directory, suffix='.tmp',
+                            delete=False) as temporary_file:
+        temporary_file.write(dumps(value, indent=1, sort_keys=True))
+        temporary_file.flush()
+        fsync(temporary_file.fileno())
+    replace(temporary_file.name, file_path)
+
+
+# Store the manifest, replacing the previous file in one step.
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    write_json(manifest_file, manifest)
+
+
+# Get the path of the marker of an unfinished conversion of an instance.
+def marker_path(name):
+    return path.join(PENDING_DIRECTORY, name + '.json')
+
+
+# Remove the marker of a conversion once the manifest has been updated.
+def remove_marker(name):
+    remove_if_exists(marker_path(name))
+
+
+# Record the files merged into an instance and the weeks they changed (see
+# merged_weeks) in its manifest entry.
+def record_merge(manifest, name, checksums, weeks):
+    entry = manifest.setdefault(name, {'sources': []})
+    entry['sources'] += [checksum for checksum in checksums
+                         if checksum not in entry['sources']]
+    # Manifests written by earlier versions recorded a checksum of the
+    # snapshot instead.
+    entry.pop('data_checksum', None)
+    recorded = dict(entry.get('merged_weeks', []))
+    recorded.update(dict(weeks))
+    entry['merged_weeks'] = sorted([week, count]
+                                   for week, count in recorded.items())
+
+
+# Finish the conversions that stopped after their marker was written, adding
+# the files to the manifest if their snapshot was written and discarding the
+# marker otherwise. Returns the names of the instances whose files were
+# recorded as merged and those whose markers were discarded.
+def resolve_markers(manifest):
+    recorded = []
+    discarded = []
+    if not path.isdir(PENDING_DIRECTORY):
+        return recorded, discarded
+    for file_name in sorted(listdir(PENDING_DIRECTORY)):
+        if not file_name.endswith('.json'):
+            continue
+        name = file_name[:-len('.json')]
+        try:
+            with open(marker_path(name), 'r') as marker_file:
+                marker = loads(marker_file.read())
+            written = contains_weeks(name, marker['merged_weeks'])
+        except Exception:
+            written = False
+        if written:
+            record_merge(manifest, name, marker['sources'],
+                         marker['merged_weeks'])
+            save_manifest(manifest)
+            recorded.append(name)
+        else:
+            discarded.append(name)
+        remove_marker(name)
+    return recorded, discarded
+
+
+# Get the reported values of a week.
+def week_values(entry):
+    return [int(entry[key]) for key in REPORTED_KEYS]
+
+
+# Merge the source files that have not already been merged (according to
+# their checksums) into the collected data of an instance, and write the
+# result unless dry_run is True. Returns a report of the migration: the
+# numbers of source files, of files skipped and of weeks read, the weeks
+# added or changed (as (week, values before or None, values after) tuples),
+# the checksums of the merged files, the checksum of the result, the weeks
+# changed (see merged_weeks), whether the data no longer contains the
+# recorded_weeks of the earlier conversions ('data_changed'), and the time
+# taken in seconds. Unless it is a dry run, the marker of the conversion is
+# left for the caller to remove once the files are recorded in the manifest.
+def migrate_instance(name, source_paths, merged_checksums=(), dry_run=False,
+                     recorded_weeks=None):
+    started = perf_counter()
+    report = {'name': name, 'sources': len(source_paths), 'skipped': 0,
+              'records': 0, 'weeks': 0, 'changes': [], 'checksums': [],
+              'data_checksum': None, 'merged_weeks': [], 'dry_run': dry_run,
+              'data_changed': (recorded_weeks is not None
+                               and not contains_weeks(name, recorded_weeks))}
+
+    # Skip the files that have already been merged, or that are given twice.
+    seen = set(merged_checksums)
+    pending = []
+    for source_path in source_paths:
+        checksum = file_checksum(source_path)
+        if checksum in seen:
+            report['skipped'] += 1
+            continue
+        seen.add(checksum)
+        pending.append(source_path)
+        report['checksums'].append(checksum)
+    if pending and dry_run:
+        merge_sources(name, pending, report)
+    elif pending:
+        with writer_lock(name):
+            columns = merge_sources(name, pending, report)
+            write_json(marker_path(name),
+                       {'sources': report['checksums'],
+                        'merged_weeks': report['merged_weeks']})
+            write_columns_locked(name, columns)
+            # Check that the data was stored correctly.
+            if (columns_checksum(load_columns(name))
+                    != report['data_checksum']):
+                raise OSError('The data written for ' + name + ' does not '
+                              + 'match the converted data.')
+    report['seconds'] = perf_counter() - started
+    return report
+
+
+# Merge source files into the collected data of an instance, adding the
+# weeks read and changed to a migration's report. Returns the merged data in
+# columns.
+def merge_sources(name, source_paths, report):
+    data = load_existing(name)
+    index = index_weeks(data)
+    before = {entry['week']: week_values(entry) for entry in data}
+    changed = {}
+    for entries in stream_sources(source_paths):
+        for entry in merge_activity(data, entries, index):
+            changed[entry['week']] = entry
+        report['records'] += len(entries)
+    report['changes'] = [(week, before.get(week), week_values(changed[week]))
+                         for week in sorted(changed)]
+    report['merged_weeks'] = merged_weeks(changed.values())
+    report['weeks'] = len(data)
+    columns = records_to_columns(data)
+    report['data_checksum'] = columns_checksum(columns)
+    return columns
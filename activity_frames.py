@@ -0,0 +1,147 @@
+'''
+The frames module provides the front-end with the collected activity data.
+
+At start-up, only a small index of the available instances is built, from the
+summaries kept by the index module (see activity_index). The data
+for an instance is loaded (memory-mapped) when it is first needed, and the
+least recently used instances are evicted once the loaded data exceeds a
+memory budget.
+
+The DataFrame prepared for each loaded instance is cached with the data, and
+both are only loaded again when the instance's data files change. As the data
+is sorted by 'week', the weeks in a date range are found with a binary search
+and returned as a slice of the cached DataFrame. The resolutions each metric
+is drawn at (see activity_lod) are also cached with the data once they are
+first needed.
+'''
+
+from collections import OrderedDict
+from threading import Lock
+import numpy
+from activity_storage import (COLUMNS, load_columns, columns_to_dataframe,
+                              data_generation)
+from activity_lod import build_levels
+from activity_index import instance_summaries
+
+# The default amount of memory the loaded data may use, in bytes.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+# Create an index of the instances that data has been collected for, with the
+# first and last week, the number of weeks collected, and the latest averages
+# and growth of each value for each instance. The summaries are read from the
+# index of instances. For the instances whose summaries are missing or out of
+# date, only the end of their data is read, so start-up does not depend on
+# how much data has been collected.
+def build_instance_index():
+    return instance_summaries()
+
+
+# Get the positions of the first week at or after start and the first week at
+# or after end, in a sorted array of weeks.
+def select_weeks(weeks, start, end):
+    return (int(weeks.searchsorted(start, side='left')),
+            int(weeks.searchsorted(end, side='left')))
+
+
+# A least recently used cache of the data loaded for each instance, and the
+# DataFrames prepared from it.
+class InstanceCache:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.memory_used = 0
+        self.lock = Lock()
+        self.removal_callbacks = []
+
+    # Call a function with the name of each instance whose data is removed
+    # from the cache, so anything kept for it elsewhere can be removed too.
+    # The function is called while the cache's lock is held, so it must not
+    # use the cache.
+    def on_removal(self, callback):
+        self.removal_callbacks.append(callback)
+
+    # Call the removal callbacks for an instance.
+    def removed(self, name):
+        for callback in self.removal_callbacks:
+            callback(name)
+
+    # Get the cache entry for an instance, loading the data if it is not
+    # loaded or if the instance's data files have changed since it was loaded.
+    def entry(self, name):
+        generation = data_generation(name)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry['generation'] == generation:
+                self.entries.move_to_end(name)
+                return entry
+        columns = load_columns(name)
+        entry = {'generation': generation, 'columns': columns,
+                 'frame': columns_to_dataframe(columns), 'levels': {},
+                 'memory': columns.nbytes}
+        with self.lock:
+            if name in self.entries:
+                self.memory_used -= self.entries.pop(name)['memory']
+            self.entries[name] = entry
+            self.memory_used += entry['memory']
+            self.evict()
+            return entry
+
+    # Get the data for an instance as columns.
+    def get(self, name):
+        return self.entry(name)['columns']
+
+    # Get the data for an instance as a DataFrame sorted by 'week'. The
+    # DataFrame shares its memory with the cached data, so it must not be
+    # modified.
+    def frame(self, name):
+        return self.entry(name)['frame']
+
+    # Get the data for an instance between start (inclusive) and end
+    # (exclusive) as a slice of the cached DataFrame, which must not be
+    # modified.
+    def frame_range(self, name, start, end):
+        entry = self.entry(name)
+        first, last = select_weeks(entry['columns'][0], start, end)
+        return entry['frame'].iloc[first:last]
+
+    # Get the resolutions a metric of an instance is drawn at (see
+    # build_levels), for its whole history. Each value is divided by the
+    # number of times its week was collected. The resolutions are created when
+    # they are first needed, and again once the instance's data changes.
+    def levels(self, name, metric):
+        entry = self.entry(name)
+        with self.lock:
+            levels = entry['levels'].get(metric)
+        if levels is None:
+            columns = entry['columns']
+            levels = build_levels(columns[0], columns[COLUMNS.index(metric)]
+                                  / numpy.maximum(columns[COLUMNS.index(
+                                      'count')], 1))
+            size = sum(weeks.nbytes + values.nbytes
+                       for description, weeks, values in levels)
+            with self.lock:
+                if metric not in entry['levels']:
+                    entry['levels'][metric] = levels
+                    entry['memory'] += size
+                    # The entry may have been replaced or evicted meanwhile.
+                    if self.entries.get(name) is entry:
+                        self.memory_used += size
+                        self.evict()
+        return levels
+
+    # Remove the data for an instance, so that it is loaded again when it is
+    # next needed.
+    def discard(self, name):
+        with self.lock:
+            if name in self.entries:
+                self.memory_used -= self.entries.pop(name)['memory']
+                self.removed(name)
+
+    # Remove the least recently used data until the memory budget is met,
+    # always keeping the most recently used instance.
+    def evict(self):
+        while self.memory_used > self.memory_budget and len(self.entries) > 1:
+            name, entry = self.entries.popitem(last=False)
+            self.memory_used -= entry['memory']
+            self.removed(name)
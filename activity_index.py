@@ -0,0 +1,198 @@
+'''
+The index module keeps a small summary of the collected data for every
+instance in './data_files/.index.json', so the front-end can describe, sort
+and filter the instances without loading their data.
+
+The summary of an instance contains its first and last week, the number of
+weeks collected, the average of each value in the last week, and the growth
+of each value: the change in its average over the last GROWTH_WEEKS weeks
+compared with the GROWTH_WEEKS weeks before, as a fraction.
+
+The summary is updated by the storage module whenever an instance's data is
+written, from the data being written (or, when weeks are appended to the
+journal, from the end of the data), so updating it does not depend on how
+much data has been collected. Each summary records the generation of the
+data files it was created from, so a summary that is missing or out of date
+(for example, if the data was written by an earlier version, or updating the
+index failed) is created again when the index is read.
+
+The index is shared by the back-end, the front-end and the data-conversion
+tool, so it is only changed while holding a lock on './data_files/.index.lock'
+(see file_lock), and is replaced in one step.
+'''
+
+from json import dumps, loads
+from os import makedirs, path, replace
+from tempfile import NamedTemporaryFile
+from threading import Lock
+import numpy
+from activity_storage import (COLUMNS, DATA_DIRECTORY, data_generation,
+                              file_lock, list_instances, load_tail)
+
+INDEX_FILE = path.join(DATA_DIRECTORY, '.index.json')
+INDEX_LOCK_FILE = path.join(DATA_DIRECTORY, '.index.lock')
+
+# The values summarised for each instance.
+METRICS = ('statuses', 'logins', 'registrations')
+
+# The number of weeks compared to calculate the growth of each value.
+GROWTH_WEEKS = 4
+
+index_lock = Lock()
+
+
+# Get the generation of an instance's data in the form stored in the index.
+def stored_generation(name):
+    return loads(dumps(data_generation(name)))
+
+
+# Create the summary of an instance's data from the number of weeks collected,
+# the first week, and the columns of (at least) the last 2 * GROWTH_WEEKS
+# weeks.
+def summarise_tail(rows, first_week, tail):
+    summary = {'rows': rows, 'first_week': None, 'last_week': None,
+               'latest': {}, 'growth': {}}
+    if rows == 0:
+        return summary
+    summary['first_week'] = int(first_week)
+    summary['last_week'] = int(tail[0][-1])
+    count = numpy.maximum(tail[COLUMNS.index('count')][-2 * GROWTH_WEEKS:], 1)
+    for metric in METRICS:
+        averages = tail[COLUMNS.index(metric)][-2 * GROWTH_WEEKS:] / count
+        summary['latest'][metric] = float(averages[-1])
+        growth = None
+        if len(averages) == 2 * GROWTH_WEEKS:
+            previous = averages[:GROWTH_WEEKS].mean()
+            if previous > 0:
+                growth = float(averages[GROWTH_WEEKS:].mean() / previous - 1)
+        summary['growth'][metric] = growth
+    return summary
+
+
+# Read the index, or an empty index if it has not been created.
+def read_index():
+    try:
+        with open(INDEX_FILE, 'r') as index_file:
+            index = loads(index_file.read())
+        return index if isinstance(index, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+# Write the index, replacing the previous file in one step.
+def write_index(index):
+    makedirs(DATA_DIRECTORY, exist_ok=True)
+    with NamedTemporaryFile('w', dir=DATA_DIRECTORY, prefix='.index',
+                            suffix='.tmp', delete=False) as temporary_file:
+        temporary_file.write(dumps(index, sort_keys=True))
+    replace(temporary_file.name, INDEX_FILE)
+
+
+# Create the summary of an instance's data in columns.
+def summarise_columns(columns):
+    return summarise_tail(int(columns.shape[1]),
+                          columns[0][0] if columns.shape[1] > 0 else None,
+                          columns[:, -2 * GROWTH_WEEKS:])
+
+
+# Create the summary of an instance from its data files. Only the end of its
+# data is read, so this takes the same time however much data has been
+# collected.
+def summarise_instance(name):
+    # The generation is read first, so if the data changes while it is being
+    # summarised, the summary is seen to be out of date.
+    summary = {'generation': stored_generation(name)}
+    summary.update(summarise_tail(*load_tail(name, 2 * GROWTH_WEEKS)))
+    return summary
+
+
+# Store summaries in the index, as a dictionary keyed by the instances' names.
+# A summary is only stored if it is still up to date, so a summary created
+# while another process was writing the instance's data does not replace the
+# newer summary stored by that process.
+def store_summaries(summaries):
+    with index_lock, file_lock(INDEX_LOCK_FILE):
+        index = read_index()
+        for name, summary in summaries.items():
+            if summary['generation'] == stored_generation(name):
+                index[name] = summary
+        write_index(index)
+
+
+# Update the summary of an instance in the index after its data has been
+# written. If the columns written are given, the summary is created from them;
+# otherwise it is created from the end of the data. This must be called while
+# holding the instance's writer lock, so the data does not change before the
+# summary is stored.
+def update_index(name, columns=None):
+    if columns is None:
+        summary = summarise_instance(name)
+    else:
+        summary = {'generation': stored_generation(name)}
+        summary.update(summarise_columns(columns))
+    store_summaries({name: summary})
+
+
+# Get the summaries of the instances that data has been collected for, as a
+# list of dictionaries that also contain each instance's name. Summaries that
+# are missing or out of date are created again (and stored). Instances with no
+# data, or whose data cannot be read, are not included.
+def instance_summaries():
+    index = read_index()
+    created = {}
+    summaries = []
+    for name in list_instances():
+        summary = index.get(name)
+        if (summary is None
+                or summary.get('generation') != stored_generation(name)):
+            try:
+                summary = summarise_instance(name)
+            except Exception:
+                continue
+            created[name] = summary
+        if summary['rows'] > 0:
+            summaries.append(dict(summary, name=name))
+    if created:
+        try:
+            store_summaries(created)
+        except OSError:
+            pass
+    return summaries
+
+
+# Get the summaries whose instance name contains the given text (ignoring
+# case).
+def filter_summaries(summaries, text):
+    text = text.lower()
+    return [summary for summary in summaries
+            if text in summary['name'].lower()]
+
+
+# Sort summaries by the given key: 'name', 'rows', 'last_week', or the name of
+# a metric ('latest' average) or 'growth:' followed by the name of a metric.
+# Everything except the name is sorted from highest to lowest, and missing
+# values are sorted last.
+def sort_summaries(summaries, key):
+    if key == 'name':
+        return sorted(summaries, key=lambda summary: summary['name'])
+
+    def value(summary):
+        if key.startswith('growth:'):
+            return summary['growth'].get(key[len('growth:'):])
+        if key in METRICS:
+            return summary['latest'].get(key)
+        return summary.get(key)
+
+    return sorted(summaries, key=lambda summary: (
+        value(summary) is None, -(value(summary) or 0), summary['name']))
+
+
+# Describe an instance's summary in one line.
+def describe_summary(summary):
+    description = (summary['name'] + ' (' + str(summary['rows']) + ' weeks, '
+                   + f'{summary["latest"].get("statuses", 0):.0f} statuses '
+                   + 'last week')
+    growth = summary['growth'].get('statuses')
+    if growth is not None:
+        description += f', {growth:+.0%} statuses'
+    return description + ')'
@@ -0,0 +1,142 @@
+'''
+The level-of-detail module reduces the number of points drawn for long date
+ranges, so the chart stays readable and quick to draw however much data is
+shown.
+
+Each series is aggregated into weekly, monthly and quarterly averages, and the
+finest of these that fits within a limit on the number of points (based on the
+width of the chart) is used. If even the quarterly averages do not fit, they
+are reduced further with the Largest-Triangle-Three-Buckets (LTTB) algorithm,
+which keeps the points that most affect the shape of the line, such as peaks
+and troughs. The number of points drawn for each line is therefore bounded.
+
+The resolutions of a series can be created once for an instance's whole
+history and cached (see InstanceCache.levels), so redrawing the chart only
+has to select the weeks in the date range from each of them.
+
+Series that are stacked on each other share their weeks, so they are reduced
+together: every series is averaged over the same periods, and if even the
+quarterly averages do not fit, over groups of consecutive quarters.
+'''
+
+import numpy
+
+# The resolutions each series can be drawn at, from finest to coarsest, as
+# (description, number of months in each period) pairs. A number of months of
+# None leaves the data weekly.
+RESOLUTIONS = (('weekly', None), ('monthly', 1), ('quarterly', 3))
+
+# The number of pixels of the chart's width to allow for each point.
+POINT_SPACING = 4
+
+# The fewest points a line can be limited to.
+MINIMUM_POINTS = 16
+
+
+# Get the maximum number of points to draw for each line of a figure, based on
+# its width in pixels.
+def point_limit(figure):
+    width = figure.get_figwidth() * figure.dpi
+    return max(int(width / POINT_SPACING), MINIMUM_POINTS)
+
+
+# Average the values over periods of the given number of calendar months. Each
+# period is placed at the average of its weeks. The values can be an array
+# with a row for each series, which are all averaged over the same periods.
+def aggregate(weeks, values, months):
+    if len(weeks) == 0:
+        return weeks, values
+    periods = weeks.view('datetime64[s]').astype('datetime64[M]')\
+        .astype(numpy.int64) // months
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(periods))
+                                + 1))
+    counts = numpy.diff(numpy.append(starts, len(weeks)))
+    return (numpy.add.reduceat(weeks, starts) // counts,
+            numpy.add.reduceat(values, starts, axis=-1) / counts)
+
+
+# Create each resolution of a series, as (description, weeks, values) tuples.
+def build_levels(weeks, values):
+    levels = []
+    for description, months in RESOLUTIONS:
+        if months is None:
+            levels.append((description, weeks, values))
+        else:
+            levels.append((description,) + aggregate(weeks, values, months))
+    return levels
+
+
+# Reduce a series to the given number of points with the
+# Largest-Triangle-Three-Buckets algorithm. The first and last points are
+# always kept.
+def lttb(weeks, values, threshold):
+    length = len(weeks)
+    if threshold >= length or threshold < 3:
+        return weeks, values
+    x = weeks.astype(numpy.float64)
+    every = (length - 2) / (threshold - 2)
+    indices = numpy.empty(threshold, dtype=numpy.intp)
+    indices[0] = 0
+    indices[-1] = length - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, length)
+        average_x = x[end:next_end].mean()
+        average_y = values[end:next_end].mean()
+        # Keep the point forming the largest triangle with the previous point
+        # kept and the average of the next bucket.
+        areas = numpy.abs((x[previous] - average_x)
+                          * (values[start:end] - values[previous])
+                          - (x[previous] - x[start:end])
+                          * (average_y - values[previous]))
+        previous = start + int(areas.argmax())
+        indices[bucket + 1] = previous
+    return weeks[indices], values[indices]
+
+
+# Get the finest resolution of a series with no more than max_points points,
+# reducing the coarsest resolution if none fit. Returns the description of the
+# resolution used and the weeks and values to draw.
+def level_of_detail(weeks, values, max_points):
+    if len(weeks) <= max_points:
+        return 'weekly', weeks, values
+    for description, level_weeks, level_values in build_levels(weeks,
+                                                               values):
+        if len(level_weeks) <= max_points:
+            return description, level_weeks, level_values
+    return (description,) + lttb(level_weeks, level_values, max_points)
+
+
+# Get the finest resolution with no more than max_points points between start
+# (inclusive) and end (exclusive), given the resolutions of a series created
+# by build_levels, reducing the coarsest resolution if none fit. Returns the
+# description of the resolution used and the weeks and values to draw.
+def select_level(levels, start, end, max_points):
+    for description, weeks, values in levels:
+        first = int(weeks.searchsorted(start, side='left'))
+        last = int(weeks.searchsorted(end, side='left'))
+        if last - first <= max_points:
+            return description, weeks[first:last], values[first:last]
+    return (description,) + lttb(weeks[first:last], values[first:last],
+                                 max_points)
+
+
+# Get the finest resolution of several series with the same weeks (given as an
+# array with a row for each series) with no more than max_points points.
+# If none fit, groups of consecutive periods of the coarsest resolution are
+# averaged. Returns the description of the resolution used and the weeks and
+# values to draw.
+def shared_level_of_detail(weeks, values, max_points):
+    if len(weeks) <= max_points:
+        return 'weekly', weeks, values
+    for description, level_weeks, level_values in build_levels(weeks,
+                                                               values):
+        if len(level_weeks) <= max_points:
+            return description, level_weeks, level_values
+    size = -(-len(level_weeks) // max_points)
+    starts = numpy.arange(0, len(level_weeks), size)
+    counts = numpy.diff(numpy.append(starts, len(level_weeks)))
+    return (description, numpy.add.reduceat(level_weeks, starts) // counts,
+            numpy.add.reduceat(level_values, starts, axis=-1) / counts)
@@ -0,0 +1,107 @@
+'''
+The merge engine combines newly collected activity data with previously
+collected activity data. It is shared by the back-end and the data-conversion
+tool.
+
+Entries are matched on their 'week' timestamp using a dictionary, so merging m
+new entries into a history of n entries takes O(n + m) time.
+
+Besides the sum of each value over every time its week was collected, the
+lowest and highest single sample of each value are kept.
+
+The values of the current week keep growing until the week is over, so
+samples of it are not added to the totals. A week that is still in progress
+is stored with a 'count' of 0 and the values of its latest sample, which are
+replaced by each later sample, and by the first sample taken once the week is
+over. Readers treat a 'count' of 0 as a single sample.
+'''
+
+from datetime import datetime
+
+# The values that are summed when the same week is collected more than once.
+SUMMED_KEYS = ('statuses', 'logins', 'registrations')
+
+# The suffixes of the keys of the lowest and highest sample of each value.
+MINIMUM_SUFFIX = '_min'
+MAXIMUM_SUFFIX = '_max'
+
+
+# Convert a Unix timestamp to the timestamp of midnight (local time) on the
+# same day, so that the same week always has the same 'week' value.
+def normalise_week(timestamp):
+    return int(datetime.fromtimestamp(int(timestamp)).replace(
+        hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+# Prepare the activity data returned by the API for merging by converting its
+# string values to integers.
+# The first entry is the current week, which is still in progress, so it is
+# only included if include_current is True (when sampling during the week),
+# with a 'count' of 0 so it replaces the week's previous sample rather than
+# being added to it.
+def prepare_requested_data(requested_data, include_current=False):
+    prepared = []
+    for position, entry in enumerate(requested_data):
+        if position == 0 and not include_current:
+            continue
+        prepared_entry = {'week': normalise_week(entry['week'])}
+        for key in SUMMED_KEYS:
+            prepared_entry[key] = int(entry[key])
+        if position == 0:
+            prepared_entry['count'] = 0
+        prepared.append(prepared_entry)
+    return prepared
+
+
+# Get the lowest and highest sample of a value of an entry. An entry without
+# them (such as one collected by an earlier version) uses its average value.
+def sample_range(entry, key):
+    average = int(entry[key]) // max(int(entry.get('count', 1)), 1)
+    return (int(entry.get(key + MINIMUM_SUFFIX, average)),
+            int(entry.get(key + MAXIMUM_SUFFIX, average)))
+
+
+# Create a dictionary of the entries in data, keyed by their 'week' value.
+def index_weeks(data):
+    return {entry['week']: entry for entry in data}
+
+
+# Add new entries to data, summing 'statuses', 'logins', 'registrations', and
+# 'count' when a week already exists. This is used to handle data
+# inconsistencies between requests. New entries without a 'count' are treated
+# as a single request. The lowest and highest samples of each value are also
+# updated. A week in progress (with a 'count' of 0) is replaced by any new
+# entry for it, and a new entry for a week in progress is ignored if the week
+# is already over.
+# An index created by index_weeks can be passed to avoid recreating it, and is
+# kept up to date. Returns the entries of data that were added or changed.
+def merge_activity(data, new_entries, index=None):
+    if index is None:
+        index = index_weeks(data)
+    changed = {}
+    for new_entry in new_entries:
+        count = int(new_entry.get('count', 1))
+        entry = index.get(new_entry['week'])
+        in_progress = entry is not None and int(entry['count']) == 0
+        if entry is not None and not in_progress and count == 0:
+            continue
+        if entry is None or in_progress:
+            if entry is None:
+                entry = {'week': new_entry['week']}
+                data.append(entry)
+                index[entry['week']] = entry
+            entry['count'] = count
+            for key in SUMMED_KEYS:
+                entry[key] = int(new_entry[key])
+                entry[key + MINIMUM_SUFFIX], entry[key + MAXIMUM_SUFFIX] = \
+                    sample_range(new_entry, key)
+        else:
+            for key in SUMMED_KEYS:
+                minimum, maximum = sample_range(entry, key)
+                new_minimum, new_maximum = sample_range(new_entry, key)
+                entry[key] += int(new_entry[key])
+                entry[key + MINIMUM_SUFFIX] = min(minimum, new_minimum)
+                entry[key + MAXIMUM_SUFFIX] = max(maximum, new_maximum)
+            entry['count'] += count
+        changed[entry['week']] = entry
+    return list(changed.values())
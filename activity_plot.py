@@ -0,0 +1,283 @@
+'''
+The plot module draws the activity data on a chart.
+
+A single figure is kept for the lifetime of the program, with one line for
+each instance and metric that has been shown. Redrawing the chart only updates
+the data and visibility of those lines, rather than creating a new figure.
+Hidden lines are kept so they can be shown again quickly, up to
+MAX_HIDDEN_LINES, after which the least recently shown are removed.
+
+Long date ranges are drawn at a lower level of detail (monthly or quarterly
+averages, reduced further if needed), so the number of points drawn for each
+line is limited by the width of the chart. The resolution used is shown in the
+legend. If the resolutions of each line are cached (see
+InstanceCache.levels), they are given to the controller, so a redraw only
+selects the weeks in the date range from them.
+
+Series derived from the data (see activity_analytics) can be shown with the
+collected values. Growth rates are drawn as percentages against a second
+y-axis on the right, which is only shown while they are, and anomalies are
+drawn as points over the values they were found in.
+
+The data of many instances can also be combined (see activity_aggregate) and
+shown as a few lines instead of a line for each instance: the total of each
+metric, the median with the range between two percentiles shaded, or a
+stacked area of each instance's share of the total.
+
+matplotlib.pyplot is not used, so the chart can be drawn with any canvas (such
+as a Tk canvas in the front-end, or an image file).
+'''
+
+from collections import OrderedDict
+import numpy
+from dateutil.tz import tzlocal
+from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+from matplotlib.figure import Figure
+from matplotlib.ticker import PercentFormatter, ScalarFormatter
+from activity_lod import (level_of_detail, point_limit, select_level,
+                          shared_level_of_detail)
+from activity_analytics import GROWTH_SERIES, SERIES
+from activity_aggregate import stacked_shares
+
+# The metrics that can be shown on the chart.
+METRICS = ('statuses', 'logins', 'registrations')
+
+# The most hidden lines kept on the chart.
+MAX_HIDDEN_LINES = 50
+
+# The ways the data of many instances can be combined, and how they are
+# described.
+AGGREGATE_STYLES = {'total': 'Total', 'distribution': 'Median and range',
+                    'share': 'Share of the total (stacked)'}
+
+
+# Get the ordinal suffix of a percentile, such as 'th' for 25.
+def ordinal(number):
+    if number % 100 in (11, 12, 13):
+        return str(number) + 'th'
+    return str(number) + {1: 'st', 2: 'nd', 3: 'rd'}.get(number % 10, 'th')
+
+
+# Get the weeks (Unix timestamps) as datetime64 values, without copying them.
+def week_dates(weeks):
+    return weeks.view('datetime64[s]')
+
+
+# Draws the activity data for the selected instances on a single figure.
+# levels can be given to get the cached resolutions of each line, as
+# levels(name, metric, series), where series is None for the collected values.
+class PlotController:
+    def __init__(self, figure=None, levels=None):
+        self.figure = figure if figure is not None else Figure()
+        self.levels = levels
+        self.default_size = tuple(self.figure.get_size_inches())
+        self.ax = self.figure.subplots()
+        self.ax.grid()
+        # Label the x-axis with dates in local time, as the weeks start at
+        # local midnight. The labels are chosen by matplotlib when the chart
+        # is drawn, so they also update when it is zoomed or panned.
+        locator = AutoDateLocator(tz=tzlocal())
+        self.ax.xaxis.set_major_locator(locator)
+        self.ax.xaxis.set_major_formatter(ConciseDateFormatter(locator,
+                                                               tz=tzlocal()))
+        # The lines drawn, from the least to the most recently shown.
+        self.lines = OrderedDict()
+        self.growth_ax = None
+        # Shaded areas cannot be updated, so they are created again each time
+        # the chart is updated.
+        self.areas = []
+        self.showing_shares = False
+
+    # Set the size of the figure in inches. A size of None uses the default
+    # size for that dimension.
+    def set_size(self, width=None, height=None):
+        self.figure.set_size_inches(
+            width if width is not None else self.default_size[0],
+            height if height is not None else self.default_size[1])
+
+    # Get the axes to draw growth rates on, creating them when they are first
+    # needed.
+    def growth_axes(self):
+        if self.growth_ax is None:
+            self.growth_ax = self.ax.twinx()
+            self.growth_ax.yaxis.set_major_formatter(PercentFormatter(1))
+        return self.growth_ax
+
+    # Draw or update a line, returning it.
+    def draw_line(self, key, ax, weeks, values, label, **style):
+        line = self.lines.get(key)
+        if line is None:
+            line, = ax.plot(week_dates(weeks), values, label=label, **style)
+            self.lines[key] = line
+        else:
+            line.set_data(week_dates(weeks), values)
+            line.set_label(label)
+            self.lines.move_to_end(key)
+        return line
+
+    # Get the resolution of a line to draw with no more than max_points
+    # points, using its cached resolutions if there are any. Returns the
+    # description of the resolution used and the weeks and values to draw.
+    def line_detail(self, name, metric, series, weeks, values, max_points):
+        if self.levels is None or len(weeks) == 0:
+            return level_of_detail(weeks, values, max_points)
+        return select_level(self.levels(name, metric, series), weeks[0],
+                            weeks[-1] + 1, max_points)
+
+    # Show the given metrics for each [name, DataFrame] pair in
+    # data_df_array, and hide every other line. Each value is divided by the
+    # number of times its week was collected. The size of the figure should be
+    # set first, as it limits the number of points drawn. Derived series can
+    # also be shown, given as [name, metric, series, weeks, values] lists
+    # (see AnalyticsCache.derived_array).
+    def update(self, data_df_array, metrics, derived=()):
+        self.remove_areas()
+        shown = []
+        max_points = point_limit(self.figure)
+        for name, data_df in data_df_array:
+            weeks = data_df['week'].to_numpy()
+            count = numpy.maximum(data_df['count'].to_numpy(), 1)
+            for metric in metrics:
+                description, line_weeks, values = self.line_detail(
+                    name, metric, None, weeks,
+                    data_df[metric].to_numpy() / count, max_points)
+                label = name + ' ' + metric
+                if description != 'weekly':
+                    label += ' (' + description + ' averages)'
+                shown.append(self.draw_line((name, metric), self.ax,
+                                            line_weeks, values, label,
+                                            marker='x'))
+        showing_growth = False
+        for name, metric, series, weeks, values in derived:
+            label = name + ' ' + metric + ' ' + SERIES[series]
+            if series == 'anomalies':
+                # Anomalies are rare, so every one is drawn.
+                shown.append(self.draw_line(
+                    (name, metric, series), self.ax, weeks, values, label,
+                    linestyle='none', marker='o', fillstyle='none',
+                    markersize=10))
+                continue
+            description, line_weeks, values = self.line_detail(
+                name, metric, series, weeks, values, max_points)
+            if description != 'weekly':
+                label += ' (' + description + ' averages)'
+            ax = self.ax
+            if series in GROWTH_SERIES:
+                ax = self.growth_axes()
+                showing_growth = True
+            shown.append(self.draw_line((name, metric, series), ax,
+                                        line_weeks, values, label,
+                                        linestyle='--'))
+        self.show(shown, showing_growth)
+
+    # Reduce the rows of an aggregate (see aggregate_instances), which share
+    # its weeks, to no more than max_points points. Returns the text added to
+    # the legend to describe the instances combined and the resolution used,
+    # and the weeks and rows to draw.
+    def aggregate_detail(self, aggregate, rows, max_points):
+        description, weeks, rows = shared_level_of_detail(
+            aggregate['weeks'], rows, max_points)
+        instances = ' (' + str(len(aggregate['names'])) + ' instances'
+        if description != 'weekly':
+            instances += ', ' + description + ' averages'
+        return instances + ')', weeks, rows
+
+    # Show the data of many instances combined in the given style (one of
+    # AGGREGATE_STYLES), given as [metric, aggregate] pairs (see
+    # aggregate_instances), and hide every other line. A stacked area of the
+    # shares of the total is only drawn for the first metric.
+    def update_aggregate(self, aggregates, style):
+        self.remove_areas()
+        shown = []
+        share_dates = None
+        max_points = point_limit(self.figure)
+        if style == 'share':
+            aggregates = aggregates[:1]
+        for metric, aggregate in aggregates:
+            if style == 'share':
+                labels, rows = stacked_shares(aggregate)
+            else:
+                keys = (('total',) if style == 'total'
+                        else ('median', 'lower', 'upper'))
+                rows = numpy.vstack([aggregate[key] for key in keys])
+            instances, weeks, values = self.aggregate_detail(aggregate, rows,
+                                                             max_points)
+            if style == 'share':
+                self.areas = self.ax.stackplot(
+                    week_dates(weeks), values,
+                    labels=[label + ' ' + metric + instances
+                            if position == 0 else label + ' ' + metric
+                            for position, label in enumerate(labels)])
+                shown += self.areas
+                share_dates = week_dates(weeks)
+                continue
+            line = self.draw_line(
+                (None, metric, keys[0]), self.ax, weeks, values[0],
+                keys[0].capitalize() + ' ' + metric + instances, marker='x')
+            shown.append(line)
+            if style == 'total':
+                continue
+            # The percentiles are drawn as dotted lines with the range
+            # between them shaded.
+            lower, upper = aggregate['percentiles']
+            for position, key in ((1, 'lower'), (2, 'upper')):
+                shown.append(self.draw_line(
+                    (None, metric, key), self.ax, weeks, values[position],
+                    '_nolegend_', linestyle=':', color=line.get_color()))
+            self.areas.append(self.ax.fill_between(
+                week_dates(weeks), values[1], values[2], alpha=0.2,
+                color=line.get_color(),
+                label=ordinal(lower) + ' to ' + ordinal(upper)
+                + ' percentile of ' + metric))
+        self.show(shown, False, share_dates)
+
+    # Remove the shaded areas drawn by the last update.
+    def remove_areas(self):
+        for area in self.areas:
+            area.remove()
+        self.areas = []
+
+    # Show the given lines and areas and hide every other line, removing the
+    # least recently shown hidden lines beyond MAX_HIDDEN_LINES. Then rescale
+    # the axes and create the legend. If shares of the total are shown (given
+    # the dates they are shown for), the y-axis shows percentages up to 100%.
+    def show(self, shown, showing_growth, share_dates=None):
+        visible = set(shown)
+        hidden = [key for key, line in self.lines.items()
+                  if line not in visible]
+        for key in hidden[:max(len(hidden) - MAX_HIDDEN_LINES, 0)]:
+            self.lines.pop(key).remove()
+        for line in self.lines.values():
+            line.set_visible(line in visible)
+        for line in shown:
+            line.set_visible(True)
+        showing_shares = share_dates is not None
+        if showing_shares != self.showing_shares:
+            self.showing_shares = showing_shares
+            self.ax.yaxis.set_major_formatter(
+                PercentFormatter(1) if showing_shares else ScalarFormatter())
+
+        # Rescale the axes to fit the lines that are shown. The stacked areas
+        # are not lines, so the axes are set to fit them instead.
+        if showing_shares:
+            if len(share_dates) > 0:
+                self.ax.set_xlim(share_dates[0], share_dates[-1])
+            self.ax.set_ylim(0, 1)
+        else:
+            self.ax.set_autoscale_on(True)
+            self.ax.relim(visible_only=True)
+            self.ax.autoscale_view()
+        if self.growth_ax is not None:
+            self.growth_ax.set_visible(showing_growth)
+            self.growth_ax.relim(visible_only=True)
+            self.growth_ax.autoscale_view()
+
+        # Create a graph legend. The lines of the percentiles are described by
+        # their shaded area, so they are left out.
+        handles = [handle for handle in shown
+                   if not handle.get_label().startswith('_')] + [
+            area for area in self.areas if area not in shown]
+        if handles:
+            self.ax.legend(handles=handles, loc='best')
+        elif self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
@@ -0,0 +1,447 @@
+'''
+The storage module reads and writes the collected activity data in
+'./data_files/'. It is used by the back-end, the front-end, and the
+data-conversion tool.
+
+The data for each instance is stored in two files:
+- '<instance>.npy' contains a snapshot of the data in columns: a 2D int64
+  NumPy array with one row for each of COLUMNS, sorted by 'week'.
+  Besides the sum of each value and the number of samples it was collected
+  from ('count'), the lowest and highest single sample of each value are
+  stored. A 'count' of 0 marks a week still in progress, whose values are
+  those of its latest sample.
+- '<instance>.journal' is an append-only log of the weeks that have changed
+  since the snapshot was written.
+
+Saving new data only appends the changed weeks to the journal. Once the
+journal grows large enough, it is compacted into a new snapshot, which is
+written to a temporary file and then swapped in, so a crash never leaves a
+partially written snapshot behind.
+
+The files of an instance are only written while holding a lock on
+'.<instance>.lock', so the back-end and the data-conversion tool (or two
+threads) never write them at the same time. Reading does not need the lock:
+a journal record that is incomplete (because it is still being written, or
+because writing it was interrupted) is skipped without changing the file, and
+is only removed by the next write. The lock uses fcntl, so on systems without
+it (such as Windows) only threads of the same process are kept apart.
+
+Whenever an instance's data is written, its summary in the index of
+instances is updated (see activity_index).
+
+Snapshots written by earlier versions ('<instance>', a pickled list of weeks
+with string values) are still read, and are replaced when the journal is next
+compacted. Data written before the lowest and highest samples were stored uses
+the average value for both.
+'''
+
+from contextlib import contextmanager
+from pickle import load, dumps, loads, UnpicklingError
+from os import fsync, listdir, makedirs, path, remove, replace, stat
+from struct import pack, unpack, calcsize
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from urllib.parse import urlparse
+from zlib import crc32
+import numpy
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None
+
+DATA_DIRECTORY = './data_files'
+SNAPSHOT_SUFFIX = '.npy'
+JOURNAL_SUFFIX = '.journal'
+TEMPORARY_SUFFIX = '.tmp'
+LOCK_SUFFIX = '.lock'
+
+# The values stored for each week, in the order of the snapshot's rows.
+COLUMNS = ('week', 'statuses', 'logins', 'registrations', 'count',
+           'statuses_min', 'statuses_max', 'logins_min', 'logins_max',
+           'registrations_min', 'registrations_max')
+
+# The values stored by earlier versions, which are the first rows of COLUMNS.
+BASE_COLUMNS = COLUMNS[:5]
+
+# Compact the journal once it contains this many records, or once it is larger
+# than the snapshot.
+COMPACT_AFTER_RECORDS = 64
+
+# Each journal record starts with its length and CRC-32 checksum.
+RECORD_HEADER = '>II'
+RECORD_HEADER_SIZE = calcsize(RECORD_HEADER)
+
+instance_locks = {}
+instance_locks_lock = Lock()
+
+
+# Get the name the data for an instance is stored under from its URL.
+def instance_name(instance):
+    return urlparse(instance).netloc
+
+
+# Get the names of the instances that data has been collected for.
+def list_instances():
+    if not path.isdir(DATA_DIRECTORY):
+        return []
+    names = set()
+    for file_name in listdir(DATA_DIRECTORY):
+        if file_name.startswith('.') or file_name.endswith(TEMPORARY_SUFFIX):
+            continue
+        for suffix in (SNAPSHOT_SUFFIX, JOURNAL_SUFFIX):
+            if file_name.endswith(suffix):
+                file_name = file_name[:-len(suffix)]
+                break
+        names.add(file_name)
+    return sorted(names)
+
+
+# Get the path of the snapshot for an instance.
+def snapshot_path(name):
+    return path.join(DATA_DIRECTORY, name + SNAPSHOT_SUFFIX)
+
+
+# Get the path of the snapshot for an instance written by earlier versions.
+def legacy_snapshot_path(name):
+    return path.join(DATA_DIRECTORY, name)
+
+
+# Get the path of the journal for an instance.
+def journal_path(name):
+    return path.join(DATA_DIRECTORY, name + JOURNAL_SUFFIX)
+
+
+# Get the path of the file locked while an instance's files are written.
+def lock_path(name):
+    return path.join(DATA_DIRECTORY, '.' + name + LOCK_SUFFIX)
+
+
+# Get the generation of the data for an instance: the modification times and
+# sizes of its files. The generation changes whenever the data is saved.
+def data_generation(name):
+    generation = []
+    for file_path in (snapshot_path(name), legacy_snapshot_path(name),
+                      journal_path(name)):
+        try:
+            status = stat(file_path)
+            generation.append((status.st_mtime_ns, status.st_size))
+        except FileNotFoundError:
+            generation.append(None)
+    return tuple(generation)
+
+
+# Check whether any data has been stored for an instance.
+def instance_exists(name):
+    return any(part is not None for part in data_generation(name))
+
+
+# Get the lock that prevents an instance's files being written by more than
+# one thread at a time.
+def instance_lock(name):
+    with instance_locks_lock:
+        if name not in instance_locks:
+            instance_locks[name] = Lock()
+        return instance_locks[name]
+
+
+# Hold an exclusive lock on a file (creating it if needed) for the code inside
+# a with statement, so that other processes holding the same lock wait.
+@contextmanager
+def file_lock(file_path):
+    makedirs(path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, 'a') as lock_file:
+        if flock is not None:
+            flock(lock_file.fileno(), LOCK_EX)
+        try:
+            yield
+        finally:
+            if flock is not None:
+                flock(lock_file.fileno(), LOCK_UN)
+
+
+# Hold the locks that allow an instance's files to be written, both between
+# threads and between processes.
+@contextmanager
+def writer_lock(name):
+    with instance_lock(name), file_lock(lock_path(name)):
+        yield
+
+
+# Create an empty set of columns.
+def empty_columns():
+    return numpy.empty((len(COLUMNS), 0), dtype=numpy.int64)
+
+
+# Get the value of a column for a week (dictionary). The lowest and highest
+# samples of a week stored by earlier versions are the average value.
+def column_value(entry, column):
+    if column in entry:
+        return int(entry[column])
+    value = column.rsplit('_', 1)[0]
+    return int(entry[value]) // max(int(entry['count']), 1)
+
+
+# Add the rows for the lowest and highest samples to columns stored by earlier
+# versions, using the average value of each week.
+def complete_columns(columns):
+    if columns.shape[0] == len(COLUMNS):
+        return columns
+    count = numpy.maximum(columns[BASE_COLUMNS.index('count')], 1)
+    rows = [columns[index] for index in range(len(BASE_COLUMNS))]
+    for column in COLUMNS[len(BASE_COLUMNS):]:
+        value = BASE_COLUMNS.index(column.rsplit('_', 1)[0])
+        rows.append(columns[value] // count)
+    return numpy.array(rows, dtype=numpy.int64).reshape(len(COLUMNS), -1)
+
+
+# Convert a list of weeks (dictionaries) to columns sorted by 'week'.
+def records_to_columns(records):
+    if not records:
+        return empty_columns()
+    columns = numpy.array([[column_value(entry, column) for entry in records]
+                           for column in COLUMNS], dtype=numpy.int64)
+    return numpy.ascontiguousarray(
+        columns[:, numpy.argsort(columns[0], kind='stable')])
+
+
+# Convert columns to a list of weeks (dictionaries) with integer values.
+def columns_to_records(columns):
+    return [dict(zip(COLUMNS, row)) for row in columns.T.tolist()]
+
+
+# Create a DataFrame from columns without copying them. pandas stores the
+# values of a DataFrame with a single data type as the transpose of a 2D
+# array, so the transposed columns are used directly.
+def columns_to_dataframe(columns):
+    # pandas is only needed by the front-end, so it is imported here to keep
+    # the back-end's start-up fast.
+    from pandas import DataFrame
+    return DataFrame(columns.T, columns=list(COLUMNS), copy=False)
+
+
+# Read the snapshot for an instance. If memory_map is True, the snapshot is
+# memory-mapped (read-only) rather than read into memory.
+def read_snapshot(name, memory_map=False):
+    try:
+        return complete_columns(numpy.load(
+            snapshot_path(name), mmap_mode='r' if memory_map else None,
+            allow_pickle=False))
+    except FileNotFoundError:
+        pass
+    try:
+        with open(legacy_snapshot_path(name), 'rb') as snapshot_file:
+            return records_to_columns(load(snapshot_file))
+    except FileNotFoundError:
+        return empty_columns()
+
+
+# Read the records in the journal for an instance. Returns the records and
+# the number of bytes that contain complete records. A record that is
+# incomplete, and anything after it, is skipped.
+def read_journal(name):
+    records = []
+    valid_length = 0
+    try:
+        with open(journal_path(name), 'rb') as journal_file:
+            while True:
+                header = journal_file.read(RECORD_HEADER_SIZE)
+                if len(header) < RECORD_HEADER_SIZE:
+                    break
+                length, checksum = unpack(RECORD_HEADER, header)
+                body = journal_file.read(length)
+                if len(body) < length or crc32(body) != checksum:
+                    break
+                try:
+                    records.append(loads(body))
+                except UnpicklingError:
+                    break
+                valid_length = journal_file.tell()
+    except FileNotFoundError:
+        pass
+    return records, valid_length
+
+
+# Remove a partially written record from the end of the journal. This must
+# only be done while holding the instance's writer lock.
+def repair_journal(name, valid_length):
+    try:
+        if path.getsize(journal_path(name)) > valid_length:
+            with open(journal_path(name), 'r+b') as journal_file:
+                journal_file.truncate(valid_length)
+    except FileNotFoundError:
+        pass
+
+
+# Replace the weeks in the columns with the weeks in the journal records.
+def apply_journal(columns, records):
+    if not records:
+        return columns
+    latest = {}
+    for record in records:
+        for entry in record:
+            latest[entry['week']] = entry
+    changed = records_to_columns(list(latest.values()))
+    unchanged = columns[:, ~numpy.isin(columns[0], changed[0])]
+    merged = numpy.concatenate((unchanged, changed), axis=1)
+    return numpy.ascontiguousarray(
+        merged[:, numpy.argsort(merged[0], kind='stable')])
+
+
+# Get the collected data for an instance as columns. The snapshot is
+# memory-mapped, so the columns are read-only. The journal is read before the
+# snapshot, so if it is compacted in between, its records are already in the
+# new snapshot.
+def load_columns(name):
+    records, valid_length = read_journal(name)
+    return apply_journal(read_snapshot(name, memory_map=True), records)
+
+
+# Get the number of weeks collected for an instance, its first week (or None),
+# and the columns of its last length weeks, without reading the rest of its
+# data. Only the header and the end of the memory-mapped snapshot are read,
+# with the journal. (A snapshot written by an earlier version is read in
+# full.)
+def load_tail(name, length):
+    records, valid_length = read_journal(name)
+    snapshot = read_snapshot(name, memory_map=True)
+    changed = apply_journal(empty_columns(), records)
+    # Count the weeks in the journal that are not in the snapshot.
+    weeks = snapshot[0]
+    positions = numpy.searchsorted(weeks, changed[0])
+    found = positions < len(weeks)
+    found[found] = weeks[positions[found]] == changed[0][found]
+    rows = snapshot.shape[1] + int(numpy.count_nonzero(~found))
+    first_weeks = [int(columns[0][0]) for columns in (snapshot, changed)
+                   if columns.shape[1] > 0]
+    # Every one of the last length weeks is either in the journal or in the
+    # last length weeks of the snapshot.
+    tail = apply_journal(numpy.array(snapshot[:, -length:]) if length > 0
+                         else empty_columns(), records)[:, -length:]
+    return rows, min(first_weeks, default=None), tail
+
+
+# Get the collected data for an instance as a list of weeks (dictionaries).
+def load_instance(name):
+    return columns_to_records(load_columns(name))
+
+
+# Get the collected data for an instance as a DataFrame, sorted by 'week'.
+def load_dataframe(name):
+    return columns_to_dataframe(load_columns(name))
+
+
+# Write columns to a file atomically, by writing them to a temporary file in
+# the same directory and then replacing the file with it.
+def write_atomically(file_path, columns):
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with NamedTemporaryFile('wb', dir=path.dirname(file_path),
+                            prefix='.' + path.basename(file_path),
+                            suffix=TEMPORARY_SUFFIX,
+                            delete=False) as temporary_file:
+        try:
+            numpy.save(temporary_file, numpy.ascontiguousarray(
+                columns, dtype=numpy.int64), allow_pickle=False)
+            temporary_file.flush()
+            fsync(temporary_file.fileno())
+        except BaseException:
+            temporary_file.close()
+            remove(temporary_file.name)
+            raise
+    replace(temporary_file.name, file_path)
+
+
+# Remove a file if it exists.
+def remove_if_exists(file_path):
+    try:
+        remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+# Store the weeks that have been added or changed for an instance.
+def save_changes(name, changed_entries):
+    if not changed_entries:
+        return
+    with writer_lock(name):
+        save_changes_locked(name, changed_entries)
+
+
+# Store the weeks that have been added or changed for an instance while its
+# writer lock is held.
+def save_changes_locked(name, changed_entries):
+    if not changed_entries:
+        return
+    body = dumps([{column: column_value(entry, column) for column in COLUMNS}
+                  for entry in changed_entries])
+    # Remove a record left incomplete by an interrupted write, so the new
+    # record is not appended after it.
+    records, valid_length = read_journal(name)
+    repair_journal(name, valid_length)
+    with open(journal_path(name), 'ab') as journal_file:
+        journal_file.write(pack(RECORD_HEADER, len(body), crc32(body))
+                           + body)
+        journal_file.flush()
+        fsync(journal_file.fileno())
+    if needs_compaction(name, len(records) + 1):
+        compact_locked(name)
+    index_instance(name)
+
+
+# Check whether the journal for an instance, containing the given number of
+# records, should be compacted.
+def needs_compaction(name, records):
+    journal_size = path.getsize(journal_path(name))
+    snapshot_size = 0
+    for file_path in (snapshot_path(name), legacy_snapshot_path(name)):
+        if path.exists(file_path):
+            snapshot_size = path.getsize(file_path)
+            break
+    return journal_size > snapshot_size or records >= COMPACT_AFTER_RECORDS
+
+
+# Write a new snapshot containing the journal and remove the journal.
+def compact_instance(name):
+    with writer_lock(name):
+        compact_locked(name)
+
+
+# Compact the journal for an instance while its writer lock is held.
+def compact_locked(name):
+    records, valid_length = read_journal(name)
+    write_atomically(snapshot_path(name),
+                     apply_journal(read_snapshot(name), records))
+    remove_if_exists(journal_path(name))
+    remove_if_exists(legacy_snapshot_path(name))
+
+
+# Replace all of the collected data for an instance.
+def write_instance(name, data):
+    write_columns(name, records_to_columns(data))
+
+
+# Replace all of the collected data for an instance with columns.
+def write_columns(name, columns):
+    with writer_lock(name):
+        write_columns_locked(name, columns)
+
+
+# Replace all of the collected data for an instance with columns while its
+# writer lock is held.
+def write_columns_locked(name, columns):
+    write_atomically(snapshot_path(name), columns)
+    remove_if_exists(journal_path(name))
+    remove_if_exists(legacy_snapshot_path(name))
+    index_instance(name, columns)
+
+
+# Update the summary of an instance in the index of instances, from the
+# columns written if they are given, while the instance's writer lock is held.
+# The index only describes the instances, so a failure to update it is
+# ignored, and the summary is created again when the index is next read.
+def index_instance(name, columns=None):
+    # activity_index imports this module, so it is imported here.
+    from activity_index import update_index
+    try:
+        update_index(name, columns)
+    except Exception:
+        pass
@@ -0,0 +1,469 @@
+'''
+The AI analysis module sends the displayed data to a local LLM through its
+OpenAI-compatible API, and streams the response back as it is generated.
+
+The data is sent as a compact table for each instance. If the table would not
+fit in the model's context window, the weekly values are averaged over longer
+periods (months, quarters, or years) until it does.
+
+The analysis is run on a worker thread, which puts the response into a queue
+for the front-end to display, so the window stays responsive while the LLM is
+generating its response. Cancelling an analysis shuts down the connections it
+is waiting for, so the worker stops at once rather than when the LLM next
+sends part of its response.
+
+When many instances are selected, each instance can be analysed in its own
+request (with several requests sent at once), and the analyses are then
+summarised in a final request. Each analysis is shown as soon as it is
+complete.
+
+Complete responses are cached in './ai_cache/', keyed by a hash of the prompt
+(which contains the data) and the model parameters, so the same analysis is
+not generated twice. A cached response is discarded once the data file of any
+instance it analysed changes, and the least recently used responses are
+removed once the cache grows too large.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
+from json import dumps, loads, JSONDecodeError
+from os import listdir, makedirs, path, remove, replace, utime
+from socket import SHUT_RDWR
+from tempfile import NamedTemporaryFile
+from threading import Event, Lock, Thread
+from dateutil.tz import tzlocal
+from pandas import DataFrame, to_datetime
+from requests import get, post, exceptions
+from activity_storage import data_generation
+
+# How long to wait to connect to the LLM, and how long to wait for each part
+# of its response, in seconds.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+
+# The default size of the model's context window, in tokens.
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# An estimate of the number of characters in each token of the data.
+CHARACTERS_PER_TOKEN = 3
+
+# The instruction sent before the data, which is completed with a description
+# of the period the data has been averaged over.
+PROMPT = 'What trends can you find from this data ({} averages):\n'
+
+# The instruction sent before the analyses of each instance, when they are
+# summarised.
+SUMMARY_PROMPT = ('These are analyses of the activity of several Mastodon '
+                  + 'instances. Summarise and compare the trends they '
+                  + 'describe:\n')
+
+# The default number of requests that can be sent to the LLM at once when
+# each instance is analysed separately.
+DEFAULT_CONCURRENT_REQUESTS = 4
+
+# The periods the data can be averaged over, from shortest to longest, as
+# (description, pandas period frequency) pairs. A frequency of None leaves
+# the data weekly.
+PERIODS = (('weekly', None), ('monthly', 'M'), ('quarterly', 'Q'),
+           ('yearly', 'Y'))
+
+# The directory responses are cached in, and the maximum size of the cache in
+# bytes.
+CACHE_DIRECTORY = './ai_cache'
+CACHE_SIZE = 16 * 1024 * 1024
+
+# The server addresses that have responded to a request for their models.
+available_servers = set()
+available_servers_lock = Lock()
+
+
+# Check whether the LLM server at an address is available. A successful check
+# is remembered, so the server is only checked once.
+def server_available(server_address):
+    with available_servers_lock:
+        if server_address in available_servers:
+            return True
+    response = get(f'{server_address}/v1/models',
+                   timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if response.status_code != 200:
+        return False
+    with available_servers_lock:
+        available_servers.add(server_address)
+    return True
+
+
+# Forget that the LLM server at an address is available, so it is checked
+# again before it is next used.
+def forget_server(server_address):
+    with available_servers_lock:
+        available_servers.discard(server_address)
+
+
+# Get the number of tokens available for the data, given the maximum number
+# of tokens in the response and the size of the model's context window.
+def prompt_token_budget(max_tokens, context_tokens=DEFAULT_CONTEXT_TOKENS):
+    return max(context_tokens - max_tokens - estimate_tokens(PROMPT), 0)
+
+
+# Estimate the number of tokens in some text.
+def estimate_tokens(text):
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+
+# Create a table of the average value of each metric for each week of an
+# instance's data, averaged over the given period.
+def average_table(data_df, metrics, frequency):
+    dates = to_datetime(data_df['week'].to_numpy(), unit='s', utc=True)\
+        .tz_convert(tzlocal()).tz_localize(None)
+    # A week still in progress has a count of 0 (see activity_merge).
+    count = data_df['count'].to_numpy().clip(min=1)
+    table = DataFrame({metric: data_df[metric].to_numpy() / count
+                       for metric in metrics}, index=dates)
+    if frequency is None:
+        table.index = table.index.strftime('%Y-%m-%d')
+    else:
+        table = table.groupby(table.index.to_period(frequency)).mean()
+        table.index = table.index.astype(str)
+    table.index.name = 'date'
+    return table
+
+
+# Create the data for the LLM: a CSV table of the average value of each metric
+# for each instance, averaged over the shortest period that fits within the
+# token budget. Returns the data and a description of the period used.
+def build_llm_input(data_df_array, metrics, token_budget):
+    for description, frequency in PERIODS:
+        tables = []
+        for name, data_df in data_df_array:
+            table = average_table(data_df, metrics, frequency)
+            tables.append('Instance: ' + name + '\n'
+                          + table.to_csv(float_format='%.1f'))
+        llm_input = '\n'.join(tables)
+        if estimate_tokens(llm_input) <= token_budget:
+            break
+    return llm_input, description
+
+
+# Create the prompt for the LLM from the data and the description of the
+# period it has been averaged over.
+def build_prompt(llm_input, description):
+    return PROMPT.format(description) + llm_input
+
+
+# Create the prompt that summarises the analyses of each instance, given as
+# (instance, analysis) pairs. Each analysis is shortened if needed so that the
+# prompt fits within the token budget.
+def build_summary_prompt(analyses, token_budget):
+    length = (max(token_budget - estimate_tokens(SUMMARY_PROMPT), 0)
+              * CHARACTERS_PER_TOKEN // max(len(analyses), 1))
+    parts = []
+    for name, analysis in sorted(analyses):
+        parts.append('Instance: ' + name + '\n' + analysis.strip()[:length])
+    return SUMMARY_PROMPT + '\n\n'.join(parts)
+
+
+# Get the fingerprints of the data files of the given instances, which change
+# whenever the data is changed.
+def data_fingerprints(names):
+    return {name: loads(dumps(data_generation(name))) for name in names}
+
+
+# Get the key a response is cached under.
+def response_key(payload):
+    return sha256(dumps([payload['prompt'], payload['model'],
+                         payload['max_tokens'], payload['temperature']])
+                  .encode('utf-8')).hexdigest()
+
+
+# A size-bounded cache of complete responses, stored on disk.
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIRECTORY, size=CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+        self.lock = Lock()
+
+    # Get the path of the file a response is cached in.
+    def entry_path(self, key):
+        return path.join(self.directory, key + '.json')
+
+    # Get a cached response, or None if it is not cached or the data it
+    # analysed has changed.
+    def get(self, key):
+        with self.lock:
+            try:
+                with open(self.entry_path(key), 'r') as entry_file:
+                    entry = loads(entry_file.read())
+            except (OSError, ValueError):
+                return None
+            if data_fingerprints(entry['fingerprints']) \
+                    != entry['fingerprints']:
+                self.remove(key)
+                return None
+            # Mark the response as recently used.
+            utime(self.entry_path(key))
+            return entry['response']
+
+    # Cache a response to an analysis of the given instances.
+    def put(self, key, names, response):
+        entry = dumps({'fingerprints': data_fingerprints(names),
+                       'response': response})
+        with self.lock:
+            makedirs(self.directory, exist_ok=True)
+            with NamedTemporaryFile('w', dir=self.directory, suffix='.tmp',
+                                    delete=False) as temporary_file:
+                temporary_file.write(entry)
+            replace(temporary_file.name, self.entry_path(key))
+            self.evict()
+
+    # Remove a cached response.
+    def remove(self, key):
+        try:
+            remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    # Remove the least recently used responses until the cache fits within
+    # its size.
+    def evict(self):
+        entries = []
+        for file_name in listdir(self.directory):
+            if file_name.endswith('.json'):
+                file_path = path.join(self.directory, file_name)
+                entries.append((path.getmtime(file_path),
+                                path.getsize(file_path), file_path))
+        total = sum(size for modified, size, file_path in entries)
+        for modified, size, file_path in sorted(entries):
+            if total <= self.size:
+                break
+            remove(file_path)
+            total -= size
+
+
+# Get the text from a completion, or a part of a streamed completion.
+def completion_text(completion):
+    choices = completion.get('choices') or [{}]
+    return choices[0].get('text') or ''
+
+
+# An error response from the LLM.
+class CompletionError(Exception):
+    pass
+
+
+# Get the socket a streamed response is being read from, or None if it cannot
+# be found.
+def response_socket(response):
+    try:
+        return response.raw._fp.fp.raw._sock
+    except AttributeError:
+        return None
+
+
+# Signals that an analysis has been cancelled. The responses being read when
+# it is cancelled (or opened after) have their connections shut down, so a
+# read waiting for the LLM returns at once.
+class Cancellation:
+    def __init__(self):
+        self.event = Event()
+        self.responses = set()
+        self.lock = Lock()
+
+    # Check whether the analysis has been cancelled.
+    def is_set(self):
+        return self.event.is_set()
+
+    # Cancel the analysis, shutting down the responses being read.
+    def set(self):
+        with self.lock:
+            self.event.set()
+            responses = list(self.responses)
+        for response in responses:
+            self.shut_down(response)
+
+    # Record that a response is being read, shutting it down at once if the
+    # analysis has already been cancelled.
+    def opened(self, response):
+        with self.lock:
+            self.responses.add(response)
+        if self.event.is_set():
+            self.shut_down(response)
+
+    # Record that a response is no longer being read.
+    def closed(self, response):
+        with self.lock:
+            self.responses.discard(response)
+
+    # Shut down the connection of a response. Closing the response is not
+    # enough, as it waits for the read in progress to finish.
+    def shut_down(self, response):
+        connection = response_socket(response)
+        if connection is None:
+            return
+        try:
+            connection.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# Request a completion and yield its text as it is generated. The request is
+# stopped when cancel (a Cancellation) is set.
+def stream_completion(server_address, payload, cancel):
+    response = post(f'{server_address}/v1/completions',
+                    json=dict(payload, stream=True), stream=True,
+                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    cancel.opened(response)
+    try:
+        if response.status_code != 200:
+            raise CompletionError('Error: ' + str(response.status_code)
+                                  + ' - ' + response.text)
+        # Some servers do not support streaming, and send the whole response.
+        if 'text/event-stream' not in response.headers.get('Content-Type',
+                                                            ''):
+            yield completion_text(response.json()) or 'No response'
+            return
+        for line in response.iter_lines(decode_unicode=True):
+            if cancel.is_set():
+                return
+            if not line or not line.startswith('data:'):
+                continue
+            line = line[len('data:'):].strip()
+            if line == '[DONE]':
+                return
+            try:
+                text = completion_text(loads(line))
+            except JSONDecodeError:
+                continue
+            if text:
+                yield text
+    except (exceptions.RequestException, OSError, ValueError):
+        # Reading a response fails once its connection is shut down.
+        if not cancel.is_set():
+            raise
+    finally:
+        cancel.closed(response)
+        response.close()
+
+
+# Run an analysis on a worker thread. Each part of the response is put into
+# output_queue as ('text', text), followed by ('error', message) if the
+# analysis failed, and then ('done', None). If on_complete is given, it is
+# called with the whole response once the analysis completes successfully
+# (and not if part of it failed, as recorded in incomplete).
+class AnalysisWorker:
+    def __init__(self, server_address, payload, output_queue,
+                 on_complete=None):
+        self.server_address = server_address
+        self.payload = payload
+        self.output_queue = output_queue
+        self.on_complete = on_complete
+        self.incomplete = False
+        self.cancel_event = Cancellation()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    # Start the analysis.
+    def start(self):
+        self.thread.start()
+
+    # Stop the analysis, without waiting for the next part of the response.
+    def cancel(self):
+        self.cancel_event.set()
+
+    # Check whether the analysis is still running.
+    def running(self):
+        return self.thread.is_alive()
+
+    # Generate the response.
+    def generate(self):
+        return stream_completion(self.server_address, self.payload,
+                                 self.cancel_event)
+
+    # Stream the response into the output queue.
+    def run(self):
+        response = []
+        try:
+            for text in self.generate():
+                response.append(text)
+                self.output_queue.put(('text', text))
+            if (self.on_complete is not None and response
+                    and not self.incomplete
+                    and not self.cancel_event.is_set()):
+                self.on_complete(''.join(response))
+        except CompletionError as error:
+            self.output_queue.put(('error', str(error)))
+        except exceptions.RequestException:
+            forget_server(self.server_address)
+            self.output_queue.put(('error', 'An error occurred when trying '
+                                   + 'to connect to the LLM.'))
+        except Exception as error:
+            # Any other error (such as a response that is not in the expected
+            # format) is reported rather than ending the thread silently.
+            self.output_queue.put(('error', 'An unexpected error occurred: '
+                                   + str(error)))
+        finally:
+            # The front-end waits for this, so it is always sent.
+            self.output_queue.put(('done', None))
+
+
+# Run an analysis of each instance separately on a worker thread, sending up
+# to concurrent_requests requests at once, and then summarise the analyses.
+# instance_payloads contains an (instance, payload) pair for each instance,
+# and the payload for the summary is created from the first payload.
+class MapReduceWorker(AnalysisWorker):
+    def __init__(self, server_address, instance_payloads, output_queue,
+                 concurrent_requests, token_budget, on_complete=None):
+        super().__init__(server_address, instance_payloads[0][1],
+                         output_queue, on_complete)
+        self.instance_payloads = instance_payloads
+        self.concurrent_requests = max(concurrent_requests, 1)
+        self.token_budget = token_budget
+
+    # Request a completion and return its text once it is complete.
+    def complete(self, payload):
+        return ''.join(stream_completion(self.server_address, payload,
+                                         self.cancel_event))
+
+    # Generate the analysis of each instance as it is completed, followed by
+    # the summary. The instances whose analysis failed are reported, and left
+    # out of the summary.
+    def generate(self):
+        analyses = []
+        failed = []
+        executor = ThreadPoolExecutor(max_workers=self.concurrent_requests)
+        try:
+            futures = {executor.submit(self.complete, payload): name
+                       for name, payload in self.instance_payloads}
+            for future in as_completed(futures):
+                if self.cancel_event.is_set():
+                    return
+                name = futures[future]
+                error = None
+                try:
+                    analysis = future.result()
+                except CompletionError as completion_error:
+                    error = str(completion_error)
+                except exceptions.RequestException:
+                    forget_server(self.server_address)
+                    error = ('An error occurred when trying to connect to '
+                             + 'the LLM.')
+                if error is not None:
+                    failed.append(name)
+                    self.incomplete = True
+                    yield name + ' (failed):\n' + error + '\n\n'
+                    continue
+                analyses.append((name, analysis))
+                yield name + ':\n' + analysis.strip() + '\n\n'
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self.cancel_event.is_set():
+            return
+        if not analyses:
+            raise CompletionError('Error: no instance could be analysed.')
+        if failed:
+            yield ('Not summarised, as their analysis failed: '
+                   + ', '.join(sorted(failed)) + '\n\n')
+        yield 'Summary:\n'
+        yield from stream_completion(
+            self.server_address,
+            dict(self.payload,
+                 prompt=build_summary_prompt(analyses, self.token_budget)),
+            self.cancel_event)
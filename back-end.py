@@ -1,157 +1,367 @@
 '''
-This program collects the appropriate activity data from a Mastodon instance.
+This program collects the appropriate activity data from Mastodon instances.
 It is intended to run uninterrupted on a device connected to the internet.
 
 To run this, use: python3 back-end.py
+
+To monitor several instances from one process, pass their URLs on the command
+line or list them (one per line) in a file:
+    python3 back-end.py https://mastodon.social/ https://fosstodon.org/
+    python3 back-end.py --file instances.txt
+
+To collect a sample from each instance every 15 minutes (storing the samples
+every hour) rather than once a day, use:
+    python3 back-end.py --sample-interval 15 --flush-interval 60
 '''
 
 try:
-    from requests import get, exceptions
-    from pickle import load, dump
-    from datetime import datetime, timedelta, UTC
-    from time import sleep
+    from requests import exceptions
+    from datetime import datetime
+    from time import monotonic, sleep
+    from argparse import ArgumentParser
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Lock, Semaphore
+    from socket import gethostbyname
     from urllib.parse import urlparse
-    from os import mkdir, path
+    from activity_merge import (index_weeks, merge_activity,
+                                prepare_requested_data)
+    from activity_storage import instance_name, load_instance, save_changes
+    from collector_schedule import Scheduler, COLLECTION_WINDOW
+    from collector_fetch import ActivityFetcher, CONNECT_TIMEOUT, READ_TIMEOUT
+    from collector_sampling import (SampleAccumulator, SAMPLE_INTERVAL,
+                                    FLUSH_INTERVAL)
+    from collector_metrics import CollectorMetrics, serve_metrics
 except Exception:
     raise SystemExit('Please install the required Python packages.\nMore '
                      + 'information can be found at: https://github.com/'
                      + 'Ubaydullah-A/Charting-Mastodon-Activity')
 
-# Ask the user for the URL of an instance.
-instance = input('Please enter the URL of the instance you would like to ' +
-                 'monitor (such as https://mastodon.social/): ')
+
+# Get the activity data of an instance via the API, waiting for a free slot
+# for the instance's host first. Returns None if the data has not changed since
+# it was last requested, unless repeat_unchanged is True.
+def request_activity(instance, repeat_unchanged=False):
+    with host_slot(instance):
+        return fetcher.fetch(instance, repeat_unchanged)
+
+
+# Get the semaphore that limits the number of concurrent requests to the
+# server hosting an instance. Each instance is only monitored once, so the
+# limit is shared by the instances whose host names resolve to the same
+# address (such as instances run by the same hosting provider).
+def host_slot(instance):
+    host = server_address(instance)
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = Semaphore(arguments.per_host)
+        return host_slots[host]
+
+
+# Get the IP address of the server hosting an instance. The address is looked
+# up once, and if it cannot be found, the instance's host name is used until
+# it can be.
+def server_address(instance):
+    with host_slots_lock:
+        if instance in server_addresses:
+            return server_addresses[instance]
+    host = urlparse(instance).hostname or instance_name(instance)
+    try:
+        address = gethostbyname(host)
+    except OSError:
+        return host
+    with host_slots_lock:
+        server_addresses[instance] = address
+    return address
+
+
+# Test that the program can collect new data from an instance via the API.
+# Returns the data collected, which may be stored as a sample, or None if
+# it could not be collected.
+def probe_instance(instance):
+    try:
+        return request_activity(instance)
+    except exceptions.RequestException:
+        return None
+
+
+# Collect new data for an instance and store it with the previously collected
+# data. Returns True if the data was collected and stored successfully, or if
+# it has not changed since it was last collected.
+def collect_instance(instance):
+    try:
+        requested_data = request_activity(instance)
+    except exceptions.RequestException:
+        metrics.increment('fetch_failures_total', instance_name(instance))
+        print('Unable to collect activity data from', instance + ':',
+              datetime.now())
+        return False
+    if requested_data is None:
+        metrics.succeeded(instance_name(instance))
+        print('Activity data from', instance, 'has not changed:',
+              datetime.now())
+        return True
+    return store_activity(instance, prepare_requested_data(requested_data))
+
+
+# Store new data for an instance, prepared by prepare_requested_data, with the
+# previously collected data. Returns True if the data was stored successfully.
+# If it was not, the previously collected data is loaded again, so the new
+# data can be stored later without being counted twice, and the validators of
+# the instance's last response are forgotten, so the next request receives its
+# data again rather than a response saying it has not changed.
+def store_activity(instance, new_entries):
+    name = instance_name(instance)
+    # Add the data to the previously collected data, summing the values of
+    # weeks that have already been collected.
+    with metrics.timer('merge_duration_seconds', name):
+        changed = merge_activity(histories[instance], new_entries,
+                                 indexes[instance])
+
+    # Store the weeks that have changed.
+    try:
+        with metrics.timer('write_duration_seconds', name):
+            save_changes(name, changed)
+        metrics.succeeded(name)
+        print('Successfully collected activity data from', instance + ':',
+              datetime.now())
+        return True
+    except Exception:
+        metrics.increment('write_failures_total', name)
+        print('Failed to save the collected activity data from',
+              instance + ':', datetime.now())
+        load_history(instance)
+        fetcher.forget(instance)
+        return False
+
+
+# Load the previously collected data for an instance.
+def load_history(instance):
+    try:
+        histories[instance] = load_instance(instance_name(instance))
+    except Exception:
+        histories[instance] = []
+    indexes[instance] = index_weeks(histories[instance])
+
+
+# Collect a sample of new data for an instance, to be stored when the samples
+# are next flushed. Returns True if the sample was collected successfully.
+def sample_instance(instance):
+    try:
+        requested_data = request_activity(instance, repeat_unchanged=True)
+    except exceptions.RequestException:
+        metrics.increment('fetch_failures_total', instance_name(instance))
+        print('Unable to collect activity data from', instance + ':',
+              datetime.now())
+        return False
+    metrics.succeeded(instance_name(instance))
+    samples.add(instance_name(instance),
+                prepare_requested_data(requested_data, include_current=True))
+    return True
+
+
+# Store the samples collected since they were last flushed. The samples that
+# could not be stored are kept, to be stored with the next flush.
+def flush_samples():
+    pending = samples.take()
+    print('Storing the samples for', len(pending), 'instance(s).')
+    stored = dict(zip(pending, executor.map(
+        lambda name: store_activity(instances_by_name[name], pending[name]),
+        pending)))
+    failed = [name for name in pending if not stored[name]]
+    for name in failed:
+        samples.add(name, pending[name])
+    if failed:
+        print('Unable to store the samples for', len(failed), 'instance(s). '
+              + 'They will be stored with the next samples.')
+
+
+# Collect new data from each instance once a day, storing it as it is
+# collected.
+def collect_daily():
+    # Schedule the collection of new data from each instance, carrying on
+    # from the stored schedule if the program has been restarted.
+    scheduler = Scheduler([instance_name(instance) for instance in instances],
+                          window=max(0, arguments.window) * 60)
+
+    # Store the data collected when testing each instance that is due to be
+    # collected from as its sample for the day, and schedule its next
+    # collection for the next day. The data collected from the other
+    # instances is discarded, so a restart does not collect from an instance
+    # more than once a day or change its stored schedule.
+    due = [instance for instance in instances
+           if scheduler.is_due(instance_name(instance))]
+    for instance, stored in zip(due, executor.map(
+            lambda instance: store_activity(
+                instance, prepare_requested_data(probes[instance])),
+            due)):
+        if stored:
+            scheduler.sampled(instance_name(instance))
+    for instance in instances:
+        if instance not in due:
+            fetcher.forget(instance)
+    print('Monitoring', len(instances), 'instance(s).')
+    print('First data collection:', str(scheduler.next_run()))
+
+    # Collect the new data when it is due and store it with the previously
+    # collected data. Each instance is only collected from successfully a
+    # maximum of once a day, and failed collections are retried later that
+    # day.
+    while True:
+        sleep(scheduler.wait_time())
+        due = [instances_by_name[name] for name in scheduler.due()
+               if name in instances_by_name]
+        if not due:
+            continue
+
+        # Collect new data via the API.
+        print('Attempting to collect activity data from', len(due),
+              'instance(s).\nPlease do **NOT** terminate the program during '
+              + 'this process.')
+        for instance, collected in zip(due, executor.map(collect_instance,
+                                                         due)):
+            name = instance_name(instance)
+            if collected:
+                scheduler.succeeded(name)
+                continue
+            next_run, retrying = scheduler.failed(name)
+            if retrying:
+                metrics.increment('retries_total', name)
+                print('Retrying data collection from', instance, 'at',
+                      str(next_run) + '.')
+            else:
+                print('No data collected today from', instance + '. Next '
+                      + 'data collection:', str(next_run))
+        print('Next data collection:', str(scheduler.next_run()))
+        print('')
+
+
+# Collect a sample of new data from each instance at every sample interval,
+# and store the samples in batches at every flush interval. The samples not
+# yet stored are stored when the program is stopped.
+def collect_samples():
+    sample_interval = max(arguments.sample_interval, 1) * 60
+    flush_interval = max(arguments.flush_interval, 1) * 60
+    for instance in instances:
+        samples.add(instance_name(instance),
+                    prepare_requested_data(probes[instance],
+                                           include_current=True))
+    print('Monitoring', len(instances), 'instance(s), collecting a sample '
+          + 'every', sample_interval // 60, 'minute(s).')
+    next_sample = monotonic() + sample_interval
+    next_flush = monotonic() + flush_interval
+    try:
+        while True:
+            sleep(max(0, next_sample - monotonic()))
+            # Skip samples that were missed rather than collecting them all
+            # at once.
+            next_sample = max(next_sample + sample_interval, monotonic())
+            collected = sum(executor.map(sample_instance, instances))
+            print('Collected a sample from', collected, 'of',
+                  len(instances), 'instance(s):', datetime.now())
+            if monotonic() >= next_flush:
+                flush_samples()
+                next_flush = monotonic() + flush_interval
+    finally:
+        flush_samples()
+
+
+# Get the URLs of the instances to monitor from the command line, a file, or
+# the user.
+parser = ArgumentParser(description='Collect the activity data of Mastodon '
+                        + 'instances.')
+parser.add_argument('instances', nargs='*', help='the URLs of the instances '
+                    + 'to monitor (such as https://mastodon.social/)')
+parser.add_argument('--file', help='a file containing the URLs of the '
+                    + 'instances to monitor, one per line')
+parser.add_argument('--workers', type=int, default=16, help='the maximum '
+                    + 'number of instances to collect data from at once')
+parser.add_argument('--per-host', type=int, default=1, help='the maximum '
+                    + 'number of requests to send to one server (IP '
+                    + 'address) at once')
+parser.add_argument('--connect-timeout', type=float,
+                    default=CONNECT_TIMEOUT, help='the number of seconds to '
+                    + 'wait to connect to an instance')
+parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                    help='the number of seconds to wait for a response from '
+                    + 'an instance')
+parser.add_argument('--sample-interval', type=int, help='collect a sample '
+                    + 'from each instance every number of minutes (such as '
+                    + str(SAMPLE_INTERVAL) + '), rather than once a day')
+parser.add_argument('--flush-interval', type=int, default=FLUSH_INTERVAL,
+                    help='the number of minutes between storing the samples '
+                    + 'collected')
+parser.add_argument('--window', type=int, default=COLLECTION_WINDOW // 60,
+                    help='the number of minutes after 10:00 UTC to spread '
+                    + 'the daily collections across')
+parser.add_argument('--metrics-port', type=int, help='serve metrics about '
+                    + 'the data collection on this port, at /metrics '
+                    + '(Prometheus) and /metrics.json')
+parser.add_argument('--metrics-address', default='127.0.0.1',
+                    help='the address to serve the metrics on')
+arguments = parser.parse_args()
+
+instances = list(arguments.instances)
+if arguments.file:
+    try:
+        instances_file = open(arguments.file, 'r')
+        for line in instances_file:
+            line = line.strip()
+            if line != '' and not line.startswith('#'):
+                instances.append(line)
+        instances_file.close()
+    except OSError:
+        raise SystemExit('Unable to read the instances file.')
+if not instances:
+    # Ask the user for the URL of an instance.
+    instances.append(input('Please enter the URL of the instance you would '
+                           + 'like to monitor (such as '
+                           + 'https://mastodon.social/): '))
+# Only monitor each instance once, as instances sharing a host share a file.
+instances = list({instance_name(instance): instance
+                  for instance in instances}.values())
+
+host_slots = {}
+server_addresses = {}
+host_slots_lock = Lock()
+executor = ThreadPoolExecutor(max_workers=max(1, arguments.workers))
+samples = SampleAccumulator()
+metrics = CollectorMetrics([instance_name(instance) for instance in instances])
+fetcher = ActivityFetcher(arguments.connect_timeout, arguments.read_timeout,
+                          max(1, arguments.workers), metrics)
+if arguments.metrics_port is not None:
+    try:
+        serve_metrics(metrics, arguments.metrics_port,
+                      arguments.metrics_address)
+    except OSError:
+        raise SystemExit('Unable to serve the metrics on port '
+                         + str(arguments.metrics_port) + '.')
+    print('Serving metrics at http://' + arguments.metrics_address + ':'
+          + str(arguments.metrics_port) + '/metrics')
 
 # Test that the program can collect new data via the API.
-requested_data = ''
-try:
-    requested_data = get(instance + 'api/v1/instance/activity').json()
-except exceptions.RequestException:
+probes = dict(zip(instances, executor.map(probe_instance, instances)))
+unreachable = [instance for instance in instances
+               if probes[instance] is None]
+if len(unreachable) == len(instances):
     raise SystemExit('Unable to connect to the instance.\nPlease ensure ' +
                      'that the URL is correct (including ending with \'/\'),' +
                      ' that the instance is **NOT** in whitelist mode, and ' +
                      'that you are connected to the internet.')
+for instance in unreachable:
+    print('Unable to connect to', instance + '. It will not be monitored.')
+    instances.remove(instance)
 
 # Get the previously collected data.
-file_name = urlparse(instance)
-if not path.exists('./data_files/'):
-    mkdir('data_files')
-data = []
-try:
-    data_file = open('./data_files/' + file_name.netloc, 'rb')
-    data = load(data_file)
-    data_file.close()
-except Exception:
-    pass
+histories = {}
+indexes = {}
+for instance in instances:
+    load_history(instance)
 
-# Calculate when to start collecting new data and wait until that time.
-next_collection = datetime.now().astimezone(UTC)
-today = next_collection.replace(hour=10, minute=0, second=0, microsecond=0)
-if next_collection < today:
-    next_collection = today
+# Collect new data from the instances, either once a day or (if a sample
+# interval was given) in frequent samples.
+instances_by_name = {instance_name(instance): instance
+                     for instance in instances}
+if arguments.sample_interval is None:
+    collect_daily()
 else:
-    tomorrow = next_collection + timedelta(days=1)
-    next_collection = tomorrow.replace(hour=10, minute=0, second=0,
-                                       microsecond=0)
-print('First data collection:', str(next_collection))
-sleep(datetime.timestamp(next_collection) - datetime.timestamp(datetime.now()))
-
-# Collect the new data and store it with the previously collected data.
-attempts = 0
-while True:
-    failed_to_collect = False
-    # Collect new data via the API.
-    requested_data = ''
-    print('Attempting to collect activity data.\nPlease do **NOT** terminate '
-          + 'the program during this process.')
-    try:
-        requested_data = get(instance + 'api/v1/instance/activity').json()
-    except exceptions.RequestException:
-        print('Unable to collect activity data:', datetime.now())
-        failed_to_collect = True
-
-    if not failed_to_collect:
-        # Format the data to avoid duplicate days.
-        exists = False
-        for requested_data_entry in range(1, len(requested_data)):
-            requested_data[requested_data_entry]['week'] = \
-                datetime.fromtimestamp(int(requested_data[requested_data_entry]
-                                           ['week'])).strftime('%d/%m/%Y')
-            temp = requested_data[requested_data_entry]['week'].split('/')
-            requested_data[requested_data_entry]['week'] = \
-                int(datetime.timestamp(datetime(int(temp[2]), int(temp[1]),
-                    int(temp[0]))))
-            for data_entry in range(0, len(data)):
-                if requested_data[requested_data_entry]['week'] == \
-                        data[data_entry]['week']:
-                    exists = True
-                    break
-            if not exists:
-                # Add a 'count' key = 1
-                requested_data[requested_data_entry]['count'] = '1'
-                data.append(requested_data[requested_data_entry])
-            else:
-                # Sum the old and new 'statuses', 'logins', and
-                # 'registrations', and increment 'count'.
-                # This is used to handle data inconsistencies between requests.
-                data[data_entry]['statuses'] = \
-                    str(int(data[data_entry]['statuses']) +
-                        int(requested_data[requested_data_entry]['statuses']))
-                data[data_entry]['logins'] = \
-                    str(int(data[data_entry]['logins']) +
-                        int(requested_data[requested_data_entry]['logins']))
-                data[data_entry]['registrations'] = \
-                    str(int(data[data_entry]['registrations']) +
-                        int(requested_data[requested_data_entry][
-                                           'registrations']))
-                data[data_entry]['count'] = str(int(data[data_entry]['count']
-                                                    ) + 1)
-                continue
-
-        # Store the new data.
-        try:
-            write_data = open('./data_files/' + file_name.netloc, 'wb')
-            dump(data, write_data)
-            write_data.close()
-            print('Successfully collected activity data:', datetime.now())
-        except Exception:
-            print('Failed to save the collected activity data:',
-                  datetime.now())
-            failed_to_collect = True
-
-    # Reattempt data collection if it was not successfully collected.
-    if failed_to_collect and attempts < 3:
-        attempts += 1
-        print('Attempt', attempts, 'failed.')
-        match attempts:
-            case 1:
-                # Reattempt data collection 1 hour after the original attempt.
-                attempt_1 = next_collection.replace(hour=11)
-                print('Retrying data collection in approximately 1 hour.')
-                sleep(datetime.timestamp(attempt_1)
-                      - datetime.timestamp(datetime.now()))
-            case 2:
-                # Reattempt data collection 6 hours after the original attempt.
-                attempt_2 = next_collection.replace(hour=16)
-                print('Retrying data collection in approximately 5 hours.')
-                sleep(datetime.timestamp(attempt_2)
-                      - datetime.timestamp(datetime.now()))
-            case 3:
-                # Reattempt data collection 12 hours after the original
-                # attempt.
-                attempt_3 = next_collection.replace(hour=22)
-                print('Retrying data collection in approximately 6 hours.')
-                sleep(datetime.timestamp(attempt_3)
-                      - datetime.timestamp(datetime.now()))
-        continue
-    elif failed_to_collect:
-        print('Attempt', attempts, 'failed.')
-        print('No data collected today.')
-
-    # Ensure that the program only successfully requests data a maximum of once
-    # every 24 hours.
-    next_collection = next_collection + timedelta(days=1)
-    print('Next data collection:', str(next_collection))
-    print('')
-    attempts = 0
-    sleep(datetime.timestamp(next_collection)
-          - datetime.timestamp(datetime.now()))
+    collect_samples()
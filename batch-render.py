@@ -0,0 +1,222 @@
+'''
+The batch-render tool saves graphs of the collected activity data without
+opening any windows, so it can be run on a schedule (such as nightly) on a
+device without a display.
+
+A graph is saved for every instance (or for each group of instances given),
+for each date range and file format given. The graphs are rendered in
+parallel, and the same data always produces the same files. If a graph
+cannot be rendered, the error is reported and the other graphs are still
+saved.
+
+To run this, use: python3 batch-render.py
+For example, to save PNG and SVG graphs of the last year of data for every
+instance, and one graph comparing two instances:
+    python3 batch-render.py --last-weeks 52 --formats png svg
+        --group big=mastodon.social,mastodon.online
+'''
+
+try:
+    import matplotlib
+    from argparse import ArgumentParser
+    from concurrent.futures import ProcessPoolExecutor
+    from os import makedirs, path
+    from time import mktime, perf_counter, strptime
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from pathvalidate import sanitize_filename
+    from activity_storage import list_instances, load_dataframe
+    from activity_frames import select_weeks
+    from activity_plot import PlotController, METRICS, AGGREGATE_STYLES
+    from activity_aggregate import aggregate_instances
+    from activity_analytics import SERIES, derive_series
+except Exception:
+    raise SystemExit('Please install the required Python packages.\nMore '
+                     + 'information can be found at: https://github.com/'
+                     + 'Ubaydullah-A/Charting-Mastodon-Activity')
+
+WEEK = 7 * 24 * 60 * 60
+DAY = 24 * 60 * 60
+
+# The metadata that would otherwise make each file different, such as the
+# date it was created, for each file format.
+STABLE_METADATA = {'png': {'Software': None},
+                   'svg': {'Date': None},
+                   'pdf': {'CreationDate': None, 'ModDate': None}}
+
+
+# Get the start and end of a date range given as 'DD/MM/YYYY-DD/MM/YYYY', as
+# Unix timestamps from midnight of the earlier date to just before the end of
+# the later date.
+def parse_range(date_range):
+    start, end = date_range.split('-')
+    limit1 = int(mktime(strptime(start.strip(), '%d/%m/%Y')))
+    limit2 = int(mktime(strptime(end.strip(), '%d/%m/%Y')))
+    if limit1 > limit2:
+        limit1, limit2 = limit2, limit1
+    return [limit1, limit2 + DAY, start.strip().replace('/', '-') + '_'
+            + end.strip().replace('/', '-')]
+
+
+# Render the graph of a group of instances for a date range, and save it in
+# each format. Returns the names of the files saved and the time taken.
+def render(job):
+    started = perf_counter()
+    matplotlib.use('Agg')
+    matplotlib.rcParams['svg.hashsalt'] = 'charting-mastodon-activity'
+    data_df_array = []
+    derived = []
+    for name in job['instances']:
+        data_df = load_dataframe(name)
+        # The derived series are calculated from the whole history, so the
+        # rolling averages and anomalies at the start of the range use the
+        # weeks before it.
+        full_series = [[metric, series] + list(derive_series(data_df, metric,
+                                                             series))
+                       for metric in job['metrics']
+                       for series in job['series']]
+        weeks = data_df['week'].to_numpy()
+        if job['last_weeks'] is not None and len(weeks) > 0:
+            start = int(weeks[-1]) - (job['last_weeks'] - 1) * WEEK
+            end = int(weeks[-1]) + 1
+        else:
+            start, end = job['start'], job['end']
+        if start is not None:
+            first, last = select_weeks(weeks, start, end)
+            data_df = data_df.iloc[first:last]
+        data_df_array.append([name, data_df])
+        for metric, series, series_weeks, values in full_series:
+            if start is not None:
+                first, last = select_weeks(series_weeks, start, end)
+                series_weeks = series_weeks[first:last]
+                values = values[first:last]
+            derived.append([name, metric, series, series_weeks, values])
+
+    plot_controller = PlotController(Figure())
+    FigureCanvasAgg(plot_controller.figure)
+    plot_controller.set_size(job['width'], job['height'])
+    if job['aggregate'] is None:
+        plot_controller.update(data_df_array, job['metrics'], derived)
+    else:
+        plot_controller.update_aggregate(
+            [[metric, aggregate_instances(data_df_array, metric)]
+             for metric in job['metrics']], job['aggregate'])
+    plot_controller.ax.set_title(job['title'])
+
+    file_names = []
+    for file_format in job['formats']:
+        file_name = path.join(job['output'], sanitize_filename(
+            job['title'] + '_' + job['range_name'] + '.' + file_format))
+        plot_controller.figure.savefig(
+            file_name, format=file_format,
+            metadata=STABLE_METADATA.get(file_format))
+        file_names.append(file_name)
+    return file_names, perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Save graphs of the collected '
+                            + 'activity data without opening any windows.')
+    parser.add_argument('--instances', nargs='+', help='the instances to save '
+                        + 'a graph of each of (default: every instance)')
+    parser.add_argument('--group', action='append', default=[],
+                        help='a graph of several instances, given as '
+                        + 'NAME=INSTANCE,INSTANCE,...')
+    parser.add_argument('--range', action='append', default=[],
+                        dest='ranges', help='a date range to save graphs '
+                        + 'of, given as DD/MM/YYYY-DD/MM/YYYY')
+    parser.add_argument('--last-weeks', type=int, help='save graphs of the '
+                        + 'most recent number of weeks of data')
+    parser.add_argument('--formats', nargs='+', default=['png'],
+                        help='the file formats to save the graphs in')
+    parser.add_argument('--metrics', nargs='+', default=list(METRICS),
+                        choices=METRICS, help='the metrics to show')
+    parser.add_argument('--series', nargs='+', default=[],
+                        choices=SERIES, help='the series derived from each '
+                        + 'metric to also show')
+    parser.add_argument('--aggregate', choices=AGGREGATE_STYLES,
+                        help='combine the instances of each group into '
+                        + 'their total, their median and range, or a '
+                        + 'stacked area of their shares of the total')
+    parser.add_argument('--width', type=int, help='the width of the graphs '
+                        + 'in inches')
+    parser.add_argument('--height', type=int, help='the height of the '
+                        + 'graphs in inches')
+    parser.add_argument('--output', default='./graphs', help='the directory '
+                        + 'to save the graphs in')
+    parser.add_argument('--workers', type=int, help='the number of graphs '
+                        + 'to render at once (default: the number of CPUs)')
+    arguments = parser.parse_args()
+
+    # Get the groups of instances to save graphs of.
+    groups = []
+    if arguments.instances or not arguments.group:
+        for name in arguments.instances or list_instances():
+            groups.append([name, [name]])
+    for group in arguments.group:
+        title, separator, names = group.partition('=')
+        if separator == '' or names.strip() == '':
+            raise SystemExit('Please give each group as '
+                             + 'NAME=INSTANCE,INSTANCE,...')
+        groups.append([title, sorted(name.strip() for name
+                                     in names.split(',') if name.strip())])
+    if not groups:
+        raise SystemExit('No data has been collected.')
+    unknown = sorted({name for title, names in groups for name in names}
+                     - set(list_instances()))
+    if unknown:
+        raise SystemExit('No data has been collected for: '
+                         + ', '.join(unknown))
+
+    # Get the date ranges to save graphs of.
+    ranges = []
+    try:
+        for date_range in arguments.ranges:
+            ranges.append(parse_range(date_range))
+    except ValueError:
+        raise SystemExit('Please give each date range as '
+                         + 'DD/MM/YYYY-DD/MM/YYYY.')
+    if arguments.last_weeks is not None:
+        ranges.append([None, None, 'last-' + str(arguments.last_weeks)
+                       + '-weeks'])
+    if not ranges:
+        ranges.append([None, None, 'all'])
+
+    jobs = []
+    for title, names in groups:
+        for start, end, range_name in ranges:
+            jobs.append({'title': title, 'instances': names, 'start': start,
+                         'end': end, 'range_name': range_name,
+                         'last_weeks': (arguments.last_weeks
+                                        if range_name.startswith('last-')
+                                        else None),
+                         'formats': arguments.formats,
+                         'metrics': arguments.metrics,
+                         'series': arguments.series,
+                         'aggregate': arguments.aggregate,
+                         'width': arguments.width, 'height': arguments.height,
+                         'output': arguments.output})
+
+    makedirs(arguments.output, exist_ok=True)
+    started = perf_counter()
+    render_times = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+        futures = [executor.submit(render, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                file_names, render_time = future.result()
+            except Exception as error:
+                failed += 1
+                print(f'Failed to render {job["title"]} '
+                      + f'({job["range_name"]}): {error}')
+                continue
+            render_times.append(render_time)
+            print(f'{render_time:8.3f}s  ' + ', '.join(file_names))
+    print(f'Saved {len(render_times)} graph(s) in '
+          + f'{perf_counter() - started:.3f}s (total render time '
+          + f'{sum(render_times):.3f}s, longest '
+          + f'{max(render_times, default=0):.3f}s).')
+    if failed:
+        print(f'Failed to render {failed} graph(s).')
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,71 @@
+'''
+This benchmark measures how long it takes to combine the data of many
+instances and calculate the total and median for each week, by placing every
+instance in one array (see activity_aggregate) and by joining the DataFrame of
+each instance in turn.
+
+To run this, use: python3 benchmarks/aggregate_benchmark.py
+'''
+
+from argparse import ArgumentParser
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+import numpy
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from activity_storage import COLUMNS, columns_to_dataframe  # noqa: E402
+from activity_aggregate import aggregate_instances  # noqa: E402
+
+WEEK = 7 * 24 * 60 * 60
+
+
+# Create the columns for an instance with the given number of weeks and random
+# values, starting at a random week so the instances only partly overlap.
+def create_columns(length, generator):
+    columns = numpy.ones((len(COLUMNS), length), dtype=numpy.int64)
+    columns[0] = (numpy.arange(length, dtype=numpy.int64)
+                  + generator.integers(0, length // 2)) * WEEK
+    columns[COLUMNS.index('statuses')] = generator.integers(0, 10000, length)
+    return columns
+
+
+# Join the values of each instance in turn on their weeks, and calculate the
+# total and median for each week.
+def aggregate_joins(data_df_array, metric):
+    joined = None
+    for name, data_df in data_df_array:
+        values = (data_df[metric] / data_df['count']).rename(name)
+        values.index = data_df['week']
+        joined = values.to_frame() if joined is None else joined.join(
+            values, how='outer')
+    return joined.sum(axis=1), joined.median(axis=1)
+
+
+# Get the time taken to call a function, in milliseconds.
+def time_call(function):
+    start = perf_counter()
+    function()
+    return (perf_counter() - start) * 1000
+
+
+parser = ArgumentParser(description='Benchmark combining instances.')
+parser.add_argument('--instances', type=int, nargs='+', default=[10, 100, 500],
+                    help='the numbers of instances to benchmark')
+parser.add_argument('--weeks', type=int, default=520,
+                    help='the number of weeks of data for each instance')
+arguments = parser.parse_args()
+
+generator = numpy.random.default_rng(0)
+print(f'{"instances":>10} {"joins (ms)":>12} {"array (ms)":>12}')
+for instances in arguments.instances:
+    data_df_array = [[str(instance), columns_to_dataframe(
+        create_columns(arguments.weeks, generator))]
+        for instance in range(instances)]
+    joins = time_call(lambda: aggregate_joins(data_df_array, 'statuses'))
+    array = time_call(lambda: aggregate_instances(data_df_array, 'statuses'))
+    print(f'{instances:>10} {joins:12.1f} {array:12.1f}')
+    # Check that both give the same totals.
+    aggregate = aggregate_instances(data_df_array, 'statuses')
+    totals = aggregate_joins(data_df_array, 'statuses')[0].to_numpy()
+    assert numpy.allclose(aggregate['total'], totals)
@@ -0,0 +1,74 @@
+'''
+This benchmark measures how long it takes to calculate every derived series
+(see activity_analytics) of every metric for many instances, when they are
+first calculated and when they are taken from the cache for a date range.
+
+To run this, use: python3 benchmarks/analytics_benchmark.py
+'''
+
+from argparse import ArgumentParser
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+import numpy
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from activity_storage import COLUMNS, columns_to_dataframe  # noqa: E402
+from activity_analytics import AnalyticsCache, SERIES  # noqa: E402
+from activity_plot import METRICS  # noqa: E402
+
+WEEK = 7 * 24 * 60 * 60
+
+
+# Create the columns for an instance with the given number of weeks and random
+# values.
+def create_columns(length, generator):
+    columns = numpy.ones((len(COLUMNS), length), dtype=numpy.int64)
+    columns[0] = numpy.arange(length, dtype=numpy.int64) * WEEK
+    for metric in METRICS:
+        columns[COLUMNS.index(metric)] = generator.integers(0, 10000, length)
+    return columns
+
+
+# An instance cache holding the generated data, in place of the data files.
+class GeneratedData:
+    def __init__(self, instances, length):
+        generator = numpy.random.default_rng(0)
+        self.entries = {}
+        for instance in range(instances):
+            columns = create_columns(length, generator)
+            self.entries[str(instance)] = {
+                'generation': 0, 'columns': columns,
+                'frame': columns_to_dataframe(columns)}
+
+    def entry(self, name):
+        return self.entries[name]
+
+    # The generated data is never removed.
+    def on_removal(self, callback):
+        pass
+
+
+parser = ArgumentParser(description='Benchmark calculating derived series.')
+parser.add_argument('--instances', type=int, nargs='+', default=[10, 100, 500],
+                    help='the numbers of instances to benchmark')
+parser.add_argument('--weeks', type=int, default=520,
+                    help='the number of weeks of data for each instance')
+arguments = parser.parse_args()
+
+print(f'{"instances":>10} {"series":>8} {"first (ms)":>12} '
+      + f'{"cached (ms)":>12}')
+for instances in arguments.instances:
+    data = GeneratedData(instances, arguments.weeks)
+    analytics = AnalyticsCache(data)
+    # Show the most recent year, which is the default range for a chart.
+    data_df_array = [[name, entry['frame'].iloc[-52:]]
+                     for name, entry in data.entries.items()]
+    timings = []
+    for repeat in range(2):
+        start = perf_counter()
+        derived = analytics.derived_array(data_df_array, METRICS,
+                                          list(SERIES))
+        timings.append((perf_counter() - start) * 1000)
+    print(f'{instances:>10} {len(derived):>8} {timings[0]:12.1f} '
+          + f'{timings[1]:12.1f}')
@@ -0,0 +1,116 @@
+'''
+This benchmark measures how long it takes to merge newly collected activity
+data into histories of different lengths, using the hash-indexed merge engine
+and the nested linear scan it replaced.
+
+To run this, use: python3 benchmarks/merge_benchmark.py
+'''
+
+from argparse import ArgumentParser
+from copy import deepcopy
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from activity_merge import merge_activity  # noqa: E402
+
+WEEK = 7 * 24 * 60 * 60
+
+
+# Create a history of the given length, split across instances that each
+# have the given number of weeks. The values are integers, as they are stored.
+def create_histories(length, weeks_per_instance):
+    histories = []
+    for start in range(0, length, weeks_per_instance):
+        history = []
+        for week in range(min(weeks_per_instance, length - start)):
+            history.append({'week': week * WEEK, 'statuses': week,
+                            'logins': week * 2, 'registrations': week % 7,
+                            'count': 1})
+        histories.append(history)
+    return histories
+
+
+# Create the data returned by one request for each history: the 12 most
+# recent weeks, the newest of which has not been collected before, prepared
+# as by prepare_requested_data.
+def create_requests(histories):
+    requests = []
+    for history in histories:
+        last_week = len(history)
+        requests.append([{'week': week * WEEK, 'statuses': 1, 'logins': 1,
+                          'registrations': 1}
+                         for week in range(last_week - 11, last_week + 1)])
+    return requests
+
+
+# Create the data merged by the data-conversion tool for each history: a
+# second history of the same length, half of which overlaps the first.
+def create_conversions(histories):
+    conversions = []
+    for history in histories:
+        offset = len(history) // 2
+        conversions.append([dict(entry, week=entry['week'] + offset * WEEK)
+                            for entry in history])
+    return conversions
+
+
+# The nested linear scan previously used by the back-end and the
+# data-conversion tool, adding integers as the merge engine does.
+def merge_linear(data, new_entries):
+    for new_entry in new_entries:
+        exists = False
+        for data_entry in range(0, len(data)):
+            if new_entry['week'] == data[data_entry]['week']:
+                exists = True
+                break
+        if not exists:
+            new_entry['count'] = 1
+            data.append(new_entry)
+        else:
+            for key in ('statuses', 'logins', 'registrations'):
+                data[data_entry][key] += int(new_entry[key])
+            data[data_entry]['count'] += 1
+
+
+# Time merging the requests into the histories with the given function.
+def time_merge(merge, histories, requests):
+    histories = deepcopy(histories)
+    requests = deepcopy(requests)
+    start = perf_counter()
+    for history, requested_data in zip(histories, requests):
+        merge(history, requested_data)
+    return perf_counter() - start
+
+
+parser = ArgumentParser(description='Benchmark the activity data merge.')
+parser.add_argument('--lengths', type=int, nargs='+',
+                    default=[1000, 100000, 1000000],
+                    help='the total history lengths, in weeks, to benchmark')
+parser.add_argument('--weeks-per-instance', type=int, nargs='+',
+                    default=[1000, 1000000],
+                    help='the history lengths of each instance')
+parser.add_argument('--linear-limit', type=float, default=2e7,
+                    help='the maximum number of comparisons to benchmark the '
+                    + 'linear scan with')
+arguments = parser.parse_args()
+
+print(f'{"merge":>10} {"weeks":>10} {"per instance":>13} {"instances":>10} '
+      + f'{"indexed (s)":>12} {"linear (s)":>12}')
+for length in arguments.lengths:
+    for weeks_per_instance in sorted({min(weeks, length) for weeks in
+                                      arguments.weeks_per_instance}):
+        histories = create_histories(length, weeks_per_instance)
+        for name, new_data in (('collection', create_requests(histories)),
+                               ('conversion', create_conversions(histories))):
+            indexed = time_merge(merge_activity, histories, new_data)
+            comparisons = sum(len(history) * len(entries) for history, entries
+                              in zip(histories, new_data))
+            if comparisons <= arguments.linear_limit:
+                linear = time_merge(merge_linear, histories, new_data)
+                linear = f'{linear:12.4f}'
+            else:
+                linear = f'{"skipped":>12}'
+            print(f'{name:>10} {length:>10} {weeks_per_instance:>13} '
+                  + f'{len(histories):>10} {indexed:12.4f} {linear}')
@@ -0,0 +1,71 @@
+'''
+This benchmark measures how long it takes to select the weeks in a date range
+from an instance's data, using the binary search on the sorted 'week' column
+and the boolean masks it replaced.
+
+To run this, use: python3 benchmarks/range_benchmark.py
+'''
+
+from argparse import ArgumentParser
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+import numpy
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from activity_storage import COLUMNS, columns_to_dataframe  # noqa: E402
+from activity_frames import select_weeks  # noqa: E402
+
+WEEK = 7 * 24 * 60 * 60
+
+
+# Create the columns for an instance with the given number of weeks.
+def create_columns(length):
+    columns = numpy.ones((len(COLUMNS), length), dtype=numpy.int64)
+    columns[0] = numpy.arange(length, dtype=numpy.int64) * WEEK
+    return columns
+
+
+# Select the weeks in the range with boolean masks, as the front-end
+# previously did.
+def select_masks(data_df, start, end):
+    data_df = data_df[data_df['week'].astype(int) >= start]
+    return data_df[data_df['week'].astype(int) < end]
+
+
+# Select the weeks in the range with a binary search.
+def select_search(data_df, weeks, start, end):
+    first, last = select_weeks(weeks, start, end)
+    return data_df.iloc[first:last]
+
+
+# Get the average time taken to call a function, in microseconds.
+def time_call(function, repeats):
+    start = perf_counter()
+    for repeat in range(repeats):
+        function()
+    return (perf_counter() - start) / repeats * 1000000
+
+
+parser = ArgumentParser(description='Benchmark selecting a date range.')
+parser.add_argument('--lengths', type=int, nargs='+',
+                    default=[1000, 100000, 1000000],
+                    help='the numbers of weeks to benchmark')
+parser.add_argument('--repeats', type=int, default=20,
+                    help='the number of times to repeat each selection')
+arguments = parser.parse_args()
+
+print(f'{"weeks":>10} {"selected":>10} {"masks (us)":>12} '
+      + f'{"search (us)":>12}')
+for length in arguments.lengths:
+    columns = create_columns(length)
+    data_df = columns_to_dataframe(columns)
+    # Select the most recent year, which is the default range for a chart.
+    start = int(columns[0][-52])
+    end = int(columns[0][-1]) + 1
+    selected = len(select_search(data_df, columns[0], start, end))
+    masks = time_call(lambda: select_masks(data_df, start, end),
+                      arguments.repeats)
+    search = time_call(lambda: select_search(data_df, columns[0], start, end),
+                       arguments.repeats)
+    print(f'{length:>10} {selected:>10} {masks:12.1f} {search:12.1f}')
@@ -0,0 +1,110 @@
+'''
+The fetch module requests the activity data of instances for the back-end.
+
+A single session is used for every request, so connections to each host are
+kept open and reused between requests (up to a limit on the number of open
+connections), and responses are compressed. Every request has a time limit
+for connecting and for receiving the response.
+
+The ETag and Last-Modified headers of each response are remembered, and sent
+with the next request for the same instance (as If-None-Match and
+If-Modified-Since). If the data has not changed, the instance only responds
+with '304 Not Modified', so the data is not sent again. The last data received
+from each instance is kept, so an unchanged response can still be used as a
+sample.
+
+If a CollectorMetrics object is given, the time taken by each request and the
+number of bytes received are recorded for each instance.
+'''
+
+from threading import Lock
+from requests import Session
+from requests.adapters import HTTPAdapter
+from activity_storage import instance_name
+
+# The default time limits, in seconds, for connecting to an instance and for
+# receiving its response.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+# The default number of connections to keep open to each host.
+POOL_SIZE = 16
+
+# The path of the activity endpoint of the API.
+ACTIVITY_PATH = 'api/v1/instance/activity'
+
+
+# Requests the activity data of instances through one session.
+class ActivityFetcher:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE, metrics=None):
+        self.metrics = metrics
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept': 'application/json',
+                                     'Accept-Encoding': 'gzip, deflate'})
+        self.validators = {}
+        self.last_data = {}
+        self.lock = Lock()
+
+    # Get the activity data of an instance. If it has not changed since it
+    # was last requested, None is returned, or the data last received if
+    # repeat_unchanged is True. Raises a requests exception if the data could
+    # not be requested.
+    def fetch(self, instance, repeat_unchanged=False):
+        url = instance + ACTIVITY_PATH
+        with self.lock:
+            headers = dict(self.validators.get(url, {}))
+        response = self.get(instance, url, headers)
+        if response.status_code == 304:
+            if repeat_unchanged:
+                with self.lock:
+                    return self.last_data.get(url)
+            return None
+        response.raise_for_status()
+        requested_data = response.json()
+
+        # Remember the validators of the response for the next request.
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        with self.lock:
+            self.validators[url] = validators
+            self.last_data[url] = requested_data
+        return requested_data
+
+    # Forget the validators and data last received from an instance, so the
+    # next request receives its data even if it has not changed (for example,
+    # if the data last received was not stored).
+    def forget(self, instance):
+        url = instance + ACTIVITY_PATH
+        with self.lock:
+            self.validators.pop(url, None)
+            self.last_data.pop(url, None)
+
+    # Send a request, recording the time taken and the number of bytes
+    # received if there are metrics to record.
+    def get(self, instance, url, headers):
+        if self.metrics is None:
+            return self.session.get(url, headers=headers, timeout=self.timeout)
+        name = instance_name(instance)
+        with self.metrics.timer('fetch_duration_seconds', name):
+            response = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+        self.metrics.increment('bytes_received_total', name,
+                               len(response.content))
+        if response.status_code == 304:
+            self.metrics.increment('not_modified_total', name)
+        elif response.ok:
+            self.metrics.increment('fetches_total', name)
+        return response
+
+    # Close the open connections.
+    def close(self):
+        self.session.close()
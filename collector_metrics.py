@@ -0,0 +1,198 @@
+'''
+The metrics module keeps counts and timings of the back-end's work for each
+instance, and can serve them over HTTP so the back-end can be monitored
+without reading its output.
+
+The metrics are kept in memory, in dictionaries protected by a single lock,
+so recording them costs very little. They can be read in the Prometheus text
+format from '/metrics', or as JSON from '/metrics.json', at the address given
+to serve_metrics (only on the local device by default).
+
+Each metric is described in METRICS. The time since the last successful
+collection from each instance ('staleness') is calculated when the metrics are
+read.
+'''
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Lock, Thread
+from time import perf_counter, time
+
+# The prefix of the name of every metric.
+PREFIX = 'mastodon_activity_'
+
+# The upper bounds of the histogram buckets, in seconds.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30)
+
+# The metrics recorded for each instance, as name: (type, description).
+METRICS = {
+    'fetch_duration_seconds': ('histogram', 'Time taken to request the '
+                               + 'activity data.'),
+    'merge_duration_seconds': ('histogram', 'Time taken to merge new data '
+                               + 'with the collected data.'),
+    'write_duration_seconds': ('histogram', 'Time taken to store the '
+                               + 'changed weeks.'),
+    'bytes_received_total': ('counter', 'Bytes of activity data received.'),
+    'fetches_total': ('counter', 'Successful requests for the activity '
+                      + 'data.'),
+    'not_modified_total': ('counter', 'Requests answered with 304 Not '
+                           + 'Modified.'),
+    'fetch_failures_total': ('counter', 'Failed requests for the activity '
+                             + 'data.'),
+    'write_failures_total': ('counter', 'Failures to store the collected '
+                             + 'data.'),
+    'retries_total': ('counter', 'Collections scheduled to be retried.'),
+    'last_success_timestamp_seconds': ('gauge', 'Unix time of the last '
+                                       + 'successful collection.'),
+    'staleness_seconds': ('gauge', 'Seconds since the last successful '
+                          + 'collection (or since the back-end started).'),
+}
+
+
+# Escape a label value for the Prometheus text format.
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+# Counters, histograms and the time of the last successful collection for
+# each instance.
+class CollectorMetrics:
+    def __init__(self, names=()):
+        self.started = time()
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.last_success = {name: None for name in names}
+
+    # Add an amount to a counter for an instance.
+    def increment(self, metric, name, amount=1):
+        with self.lock:
+            key = (metric, name)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Record a value (such as a duration) in a histogram for an instance.
+    def observe(self, metric, name, value):
+        with self.lock:
+            histogram = self.histograms.get((metric, name))
+            if histogram is None:
+                histogram = {'buckets': [0] * len(DURATION_BUCKETS),
+                             'sum': 0.0, 'count': 0}
+                self.histograms[(metric, name)] = histogram
+            for position, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][position] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    # Record the time taken by the code inside a with statement in a
+    # histogram for an instance.
+    @contextmanager
+    def timer(self, metric, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, name, perf_counter() - started)
+
+    # Record a successful collection from an instance.
+    def succeeded(self, name):
+        with self.lock:
+            self.last_success[name] = time()
+
+    # Get a copy of the metrics for each instance, as a dictionary keyed by
+    # the instance's name.
+    def snapshot(self):
+        now = time()
+        with self.lock:
+            names = set(self.last_success)
+            names.update(name for metric, name in self.counters)
+            names.update(name for metric, name in self.histograms)
+            instances = {}
+            for name in sorted(names):
+                last_success = self.last_success.get(name)
+                instance = {'last_success_timestamp_seconds': last_success,
+                            'staleness_seconds': now - (
+                                last_success if last_success is not None
+                                else self.started)}
+                for metric, (metric_type, description) in METRICS.items():
+                    if metric_type == 'counter':
+                        instance[metric] = self.counters.get((metric, name),
+                                                             0)
+                    elif metric_type == 'histogram':
+                        histogram = self.histograms.get((metric, name))
+                        if histogram is not None:
+                            instance[metric] = {
+                                'buckets': dict(zip(DURATION_BUCKETS,
+                                                    histogram['buckets'])),
+                                'sum': histogram['sum'],
+                                'count': histogram['count']}
+                instances[name] = instance
+        return {'uptime_seconds': now - self.started, 'instances': instances}
+
+    # Get the metrics as JSON.
+    def json_text(self):
+        return dumps(self.snapshot(), indent=1)
+
+    # Get the metrics in the Prometheus text format.
+    def prometheus_text(self):
+        instances = self.snapshot()['instances']
+        lines = []
+        for metric, (metric_type, description) in METRICS.items():
+            lines.append('# HELP ' + PREFIX + metric + ' ' + description)
+            lines.append('# TYPE ' + PREFIX + metric + ' ' + metric_type)
+            for name, instance in instances.items():
+                label = 'instance="' + escape_label(name) + '"'
+                value = instance.get(metric)
+                if value is None:
+                    continue
+                if metric_type != 'histogram':
+                    lines.append(f'{PREFIX}{metric}{{{label}}} {value}')
+                    continue
+                # Histogram buckets are cumulative in the Prometheus format.
+                total = 0
+                for bound, count in value['buckets'].items():
+                    total += count
+                    lines.append(f'{PREFIX}{metric}_bucket{{{label},'
+                                 + f'le="{bound}"}} {total}')
+                lines.append(f'{PREFIX}{metric}_bucket{{{label},le="+Inf"}} '
+                             + str(value['count']))
+                lines.append(f'{PREFIX}{metric}_sum{{{label}}} '
+                             + str(value['sum']))
+                lines.append(f'{PREFIX}{metric}_count{{{label}}} '
+                             + str(value['count']))
+        return '\n'.join(lines) + '\n'
+
+
+# Serve the metrics over HTTP on a background thread. Returns the server, which
+# can be stopped with its shutdown method.
+def serve_metrics(metrics, port, address='127.0.0.1'):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics.prometheus_text()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/metrics.json':
+                body = metrics.json_text()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Do not print a line for every request.
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,59 @@
+'''
+The sampling module lets the back-end collect data from instances more often
+than once a day, without writing to the data files after every sample.
+
+The values returned by the API for a week change between requests, which is
+why the stored values are sums over every time the week was collected (with
+'count' recording how many times). Collecting more often gives a better
+estimate of each week's values, particularly for the most recent weeks, whose
+values change the most.
+
+Each sample is added to an in-memory total for its instance and week (the sum
+of each value, the number of samples, and the lowest and highest sample).
+The totals are flushed to storage in batches, so each flush appends one
+journal record per instance however many samples were taken. Totals that
+could not be stored are added back, to be stored with the next flush.
+
+Samples include the current week, which is still in progress, so its most
+recent values are stored during the week rather than only once it is over.
+Its values keep growing until the week is over, so only its latest sample is
+kept (see activity_merge), and it is not added to the week's totals.
+'''
+
+from threading import Lock
+from activity_merge import merge_activity
+
+# The default number of minutes between samples, and between flushes to
+# storage.
+SAMPLE_INTERVAL = 15
+FLUSH_INTERVAL = 60
+
+
+# Adds up samples for each instance and week until they are flushed.
+class SampleAccumulator:
+    def __init__(self):
+        self.pending = {}
+        self.lock = Lock()
+
+    # Add a sample of an instance's data, prepared by prepare_requested_data,
+    # or totals returned by take that could not be stored.
+    def add(self, name, prepared_entries):
+        with self.lock:
+            if name not in self.pending:
+                self.pending[name] = ([], {})
+            data, index = self.pending[name]
+            merge_activity(data, prepared_entries, index)
+
+    # Get the number of weeks waiting to be flushed.
+    def pending_weeks(self):
+        with self.lock:
+            return sum(len(data) for data, index in self.pending.values())
+
+    # Remove and return the totals for each instance, as a dictionary of
+    # lists of weeks keyed by the instance's name. The totals can be merged
+    # with the collected data with merge_activity.
+    def take(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        return {name: data for name, (data, index) in pending.items()}
@@ -0,0 +1,205 @@
+'''
+The schedule module decides when the back-end next collects data from each
+instance.
+
+Data is collected from each instance once a day, during a collection window
+that starts at 10:00 UTC. Each instance is given its own time within the
+window (based on its name, so it does not change between runs), which spreads
+the requests to many instances (and their hosts) across the window rather than
+sending them all at once.
+
+If collection fails, it is retried after a delay that doubles after each
+failed attempt, with some randomness added so that instances that failed
+together are not all retried together. After the last retry (or if the next
+retry would be after the next day's collection), the instance is not retried
+until the next day.
+
+The time of the next collection (and the number of failed attempts) for each
+instance is stored in './collector_state/schedule.json' whenever it changes,
+so that a restarted back-end carries on from where it stopped.
+'''
+
+from datetime import datetime, timedelta, UTC
+from hashlib import sha256
+from heapq import heapify, heappop, heappush
+from json import dumps, loads
+from os import makedirs, path, replace
+from random import uniform
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+# The file the schedule is stored in.
+STATE_DIRECTORY = './collector_state'
+STATE_FILE = path.join(STATE_DIRECTORY, 'schedule.json')
+
+# The hour (UTC) the daily collection window starts at, and the default
+# length of the window in seconds.
+COLLECTION_HOUR = 10
+COLLECTION_WINDOW = 60 * 60
+
+# The delay before the first retry, the longest delay between retries (both
+# in seconds), and the number of retries after a failed collection.
+FIRST_RETRY_DELAY = 60 * 60
+MAX_RETRY_DELAY = 6 * 60 * 60
+MAX_RETRIES = 3
+
+# The largest fraction of a retry delay that is randomly added or removed.
+JITTER = 0.2
+
+
+# Get the number of seconds after the start of the collection window that an
+# instance is collected from.
+def window_offset(name, window):
+    digest = sha256(name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 * window
+
+
+# Get the delay before a retry, given the number of failed attempts.
+def retry_delay(attempts):
+    delay = min(FIRST_RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+    return delay * uniform(1 - JITTER, 1 + JITTER)
+
+
+# Keeps the time of the next collection for each instance, in order, and
+# stores it whenever it changes.
+class Scheduler:
+    def __init__(self, names, window=COLLECTION_WINDOW, state_file=STATE_FILE,
+                 now=None):
+        self.window = window
+        self.state_file = state_file
+        self.lock = Lock()
+        now = now if now is not None else datetime.now(UTC)
+        self.state = self.load()
+        self.queue = []
+        for name in names:
+            entry = self.state.get(name)
+            # An instance that has not been scheduled before is due at once,
+            # so data is collected from it when the back-end starts.
+            if entry is None or 'next_run' not in entry:
+                entry = {'next_run': now.timestamp(), 'attempts': 0,
+                         'slot': self.next_slot(name, now).timestamp()}
+                self.state[name] = entry
+            self.queue.append((entry['next_run'], name))
+        heapify(self.queue)
+        self.save()
+
+    # Load the stored schedule, or an empty schedule if none is stored.
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as state_file:
+                state = loads(state_file.read())
+            return state if isinstance(state, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    # Store the schedule, replacing the previous file in one step so it is
+    # never left partly written.
+    def save(self):
+        directory = path.dirname(self.state_file) or '.'
+        makedirs(directory, exist_ok=True)
+        with NamedTemporaryFile('w', dir=directory, suffix='.tmp',
+                                delete=False) as temporary_file:
+            temporary_file.write(dumps(self.state, indent=1, sort_keys=True))
+        replace(temporary_file.name, self.state_file)
+
+    # Get an instance's collection time on the day of the given time.
+    def slot(self, name, day):
+        start = day.astimezone(UTC).replace(hour=COLLECTION_HOUR, minute=0,
+                                            second=0, microsecond=0)
+        return start + timedelta(seconds=window_offset(name, self.window))
+
+    # Get an instance's first collection time after the given time.
+    def next_slot(self, name, after):
+        slot = self.slot(name, after)
+        if slot <= after:
+            slot = self.slot(name, after + timedelta(days=1))
+        return slot
+
+    # Get the time of the next collection from any instance, or None if there
+    # are no instances.
+    def next_run(self):
+        with self.lock:
+            # Remove collections that have since been rescheduled.
+            while (self.queue and self.state[self.queue[0][1]]['next_run']
+                   != self.queue[0][0]):
+                heappop(self.queue)
+            if not self.queue:
+                return None
+            return datetime.fromtimestamp(self.queue[0][0], UTC)
+
+    # Get the number of seconds until the next collection from any instance.
+    # This is never negative, even if the collection is overdue.
+    def wait_time(self, now=None):
+        next_run = self.next_run()
+        if next_run is None:
+            return 0
+        now = now if now is not None else datetime.now(UTC)
+        return max(0, (next_run - now).total_seconds())
+
+    # Remove and return the instances that are due to be collected from.
+    def due(self, now=None):
+        now = (now if now is not None else datetime.now(UTC)).timestamp()
+        names = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                next_run, name = heappop(self.queue)
+                # Skip collections that have since been rescheduled.
+                if self.state[name]['next_run'] == next_run:
+                    names.append(name)
+        return names
+
+    # Schedule an instance's next collection. slot is the daily collection
+    # time the collection belongs to, which is kept while it is retried.
+    def schedule(self, name, next_run, attempts, slot):
+        with self.lock:
+            self.state[name] = {'next_run': next_run.timestamp(),
+                                'attempts': attempts,
+                                'slot': slot.timestamp()}
+            heappush(self.queue, (next_run.timestamp(), name))
+            self.save()
+        return next_run
+
+    # Check whether an instance's next collection is due (or overdue).
+    def is_due(self, name, now=None):
+        now = (now if now is not None else datetime.now(UTC)).timestamp()
+        with self.lock:
+            return self.state[name]['next_run'] <= now
+
+    # Get the daily collection time an instance's next collection belongs to.
+    def current_slot(self, name):
+        with self.lock:
+            entry = self.state[name]
+            return datetime.fromtimestamp(entry.get('slot',
+                                                    entry['next_run']), UTC)
+
+    # Schedule the next day's collection for an instance, at least a day after
+    # the collection that was due. Returns the time of the next collection.
+    def succeeded(self, name, now=None):
+        now = now if now is not None else datetime.now(UTC)
+        next_run = self.slot(name, self.current_slot(name)
+                             + timedelta(days=1))
+        if next_run <= now:
+            next_run = self.next_slot(name, now)
+        return self.schedule(name, next_run, 0, next_run)
+
+    # Schedule the next day's collection for an instance after data has been
+    # collected from it outside of the schedule (such as when the back-end
+    # starts). Returns the time of the next collection.
+    def sampled(self, name, now=None):
+        now = now if now is not None else datetime.now(UTC)
+        next_run = self.slot(name, now + timedelta(days=1))
+        return self.schedule(name, next_run, 0, next_run)
+
+    # Schedule a retry for an instance after a failed collection. Returns the
+    # time of the next collection, and whether it is a retry (rather than the
+    # next day's collection).
+    def failed(self, name, now=None):
+        now = now if now is not None else datetime.now(UTC)
+        with self.lock:
+            attempts = self.state[name].get('attempts', 0) + 1
+        next_day = self.next_slot(name, now)
+        next_run = now + timedelta(seconds=retry_delay(attempts))
+        if attempts > MAX_RETRIES or next_run >= next_day:
+            return self.schedule(name, next_day, 0, next_day), False
+        return (self.schedule(name, next_run, attempts,
+                              self.current_slot(name)), True)
@@ -4,74 +4,209 @@ naming scheme, and stores it in the correct directory. If data has already been
 collected using v1.3.0 or later, this tool will merge the data files.
 
 To run this, use: python3 data-conversion.py
+
+To convert and merge many data files without being asked any questions, give
+each file and the URL of the instance it was collected for:
+    python3 data-conversion.py old/data=https://mastodon.social/
+        archive/data=https://mastodon.social/ other/data=https://fosstodon.org/
+The instances are converted in parallel. Files that have already been merged
+are skipped, so running the same conversion again does nothing (add --force
+to merge them again, such as after restoring the data from a backup). To see
+the weeks that would be added or changed without changing any data, add
+--dry-run (and --report FILE to save them as CSV).
 '''
 
-from pickle import load, dump
-from urllib.parse import urlparse
-from os import mkdir, path
-
-# Warn the user regarding the dangers of using this program.
-print('This tool may break collected data if used incorrectly.')
-print('It is recommended to only continue AFTER creating backups.')
-start = input('Do you want to continue? If yes, enter \'YES\': ')
-if start != 'YES':
-    exit()
-
-# Get the data stored in the old format.
-try:
-    requested_data_file = open('data', 'rb')
-    requested_data = load(requested_data_file)
-    requested_data_file.close()
-except Exception:
-    raise SystemExit('Unable to load the old data.')
-
-instance = input('Please enter the URL of the instance this data has been '
-                 + 'collected for (such as https://mastodon.social/): ')
-
-# Ensure that the directory 'data_files' exists.
-file_name = urlparse(instance)
-if not path.exists('./data_files/'):
-    mkdir('data_files')
-
-data = []
-try:
-    data_file = open('./data_files/' + file_name.netloc, 'rb')
-    data = load(data_file)
-    data_file.close()
-except Exception:
-    pass
-
-for requested_data_entry in range(0, len(requested_data)):
-    exists = False
-    for data_entry in range(0, len(data)):
-        if requested_data[requested_data_entry]['week'] == \
-                data[data_entry]['week']:
-            exists = True
-            break
-    if not exists:
-        # Add the old data.
-        data.append(requested_data[requested_data_entry])
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from csv import writer
+from datetime import datetime
+from time import perf_counter
+from activity_merge import merge_activity
+from activity_storage import instance_name, save_changes_locked, writer_lock
+from activity_conversion import (load_existing, migrate_instance,
+                                 prepare_stored_entry, read_legacy_file,
+                                 load_manifest, save_manifest, record_merge,
+                                 remove_marker, resolve_markers,
+                                 REPORTED_KEYS)
+
+
+# Print the weeks added or changed for an instance.
+def print_changes(report):
+    for week, before, after in report['changes']:
+        date = datetime.fromtimestamp(week).strftime('%d/%m/%Y')
+        if before is None:
+            print(f'  {date} added:', ', '.join(
+                f'{key} {value}' for key, value in zip(REPORTED_KEYS, after)))
+        else:
+            print(f'  {date} changed:', ', '.join(
+                f'{key} {old} -> {new}' for key, old, new
+                in zip(REPORTED_KEYS, before, after) if old != new))
+
+
+# Save the weeks added or changed for every instance as CSV.
+def save_report(reports, file_name):
+    with open(file_name, 'w', newline='') as report_file:
+        report_writer = writer(report_file)
+        report_writer.writerow(['instance', 'week', 'date', 'change']
+                               + [key + '_before' for key in REPORTED_KEYS]
+                               + [key + '_after' for key in REPORTED_KEYS])
+        for report in reports:
+            for week, before, after in report['changes']:
+                report_writer.writerow(
+                    [report['name'], week,
+                     datetime.fromtimestamp(week).strftime('%Y-%m-%d'),
+                     'added' if before is None else 'changed']
+                    + (before or [''] * len(REPORTED_KEYS)) + after)
+
+
+# Convert and merge the given source files into the data for their instances
+# without asking any questions.
+def convert_bulk(arguments):
+    # Group the source files by the instance they were collected for.
+    sources = {}
+    for mapping in arguments.mappings:
+        source, separator, instance = mapping.partition('=')
+        if separator == '' or source == '' or instance == '':
+            raise SystemExit('Please give each file as SOURCE=INSTANCE.')
+        sources.setdefault(instance_name(instance), []).append(source)
+
+    # Merge the files for each instance in parallel, and store each instance
+    # once. The manifest is updated as soon as each instance is stored.
+    manifest = load_manifest()
+    if not arguments.dry_run:
+        # Finish recording the conversions that were stopped before the
+        # manifest was updated.
+        recorded, discarded = resolve_markers(manifest)
+        for name in recorded:
+            print(f'{name}: recorded the files merged by an unfinished '
+                  + 'conversion.')
+        for name in discarded:
+            print(f'{name}: an unfinished conversion did not change the '
+                  + 'data, so its files will be merged again.')
+    started = perf_counter()
+    reports = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+        futures = {name: executor.submit(
+            migrate_instance, name, source_paths,
+            [] if arguments.force
+            else manifest.get(name, {}).get('sources', []),
+            arguments.dry_run, manifest.get(name, {}).get('merged_weeks'))
+            for name, source_paths in sources.items()}
+        for name, future in futures.items():
+            try:
+                report = future.result()
+            except Exception as error:
+                failed += 1
+                print('Failed to convert the data for', name + ':', error)
+                continue
+            reports.append(report)
+            if report['data_changed'] and not arguments.force:
+                print(f'{name}: the data has changed since files were last '
+                      + 'merged into it. If it was restored from a backup, '
+                      + 'use --force to merge the files again.')
+            if not arguments.dry_run and report['checksums']:
+                record_merge(manifest, name, report['checksums'],
+                             report['merged_weeks'])
+                save_manifest(manifest)
+                remove_marker(name)
+            if not report['checksums']:
+                print(f'{name}: nothing to merge ({report["skipped"]} '
+                      + 'file(s) already merged).')
+                continue
+            added = sum(before is None
+                        for week, before, after in report['changes'])
+            print(f'{name}: merged {report["records"]} weeks from '
+                  + f'{report["sources"] - report["skipped"]} file(s) '
+                  + f'({report["skipped"]} already merged); '
+                  + f'{added} weeks added, '
+                  + f'{len(report["changes"]) - added} changed, '
+                  + f'{report["weeks"]} in total '
+                  + f'({report["seconds"]:.3f}s).')
+            if arguments.dry_run and arguments.report is None:
+                print_changes(report)
+    seconds = perf_counter() - started
+
+    total_records = sum(report['records'] for report in reports)
+    total_changes = sum(len(report['changes']) for report in reports)
+    if arguments.report is not None:
+        save_report(reports, arguments.report)
+        print('Saved the changes to', arguments.report + '.')
+    print(f'{"Would convert" if arguments.dry_run else "Converted"} '
+          + f'{total_records} weeks ({total_changes} weeks added or changed) '
+          + f'for {len(reports)} instance(s) in {seconds:.3f}s '
+          + f'({total_records / max(seconds, 1e-9):.0f} weeks per second).')
+    if arguments.dry_run:
+        print('This was a dry run, so no data was changed.')
+    raise SystemExit(1 if failed else 0)
+
+
+# Convert the 'data' file in the current directory, asking the user which
+# instance it was collected for.
+def convert_interactive():
+    # Warn the user regarding the dangers of using this program.
+    print('This tool may break collected data if used incorrectly.')
+    print('It is recommended to only continue AFTER creating backups.')
+    start = input('Do you want to continue? If yes, enter \'YES\': ')
+    if start != 'YES':
+        exit()
+
+    # Get the data stored in the old format.
+    try:
+        requested_data = [prepare_stored_entry(entry)
+                          for entry in read_legacy_file('data')]
+    except Exception:
+        raise SystemExit('Unable to load the old data.')
+
+    instance = input('Please enter the URL of the instance this data has '
+                     + 'been collected for (such as '
+                     + 'https://mastodon.social/): ')
+
+    # Hold the instance's writer lock, so no data stored by the back-end while
+    # the data is converted is lost.
+    file_name = instance_name(instance)
+    with writer_lock(file_name):
+        # Get the data already collected for the instance. If it cannot be
+        # read, nothing is changed.
+        try:
+            data = load_existing(file_name)
+        except Exception:
+            raise SystemExit('Unable to load the data already collected for '
+                             + 'the instance.\nNo data has been changed.')
+
+        # Add the old data, summing 'statuses', 'logins', 'registrations',
+        # and 'count' for weeks that already exist.
+        changed = merge_activity(data, requested_data)
+
+        # Store the weeks that have changed.
+        try:
+            save_changes_locked(file_name, changed)
+            print('Successfully updated the activity data.')
+        except Exception:
+            print('Failed to update the activity data.\nPlease try again.')
+
+
+# The instances are converted in separate processes, which import this file,
+# so the conversion is only started when it is run directly.
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Convert and merge data collected '
+                            + 'before v1.3.0.')
+    parser.add_argument('mappings', nargs='*', metavar='SOURCE=INSTANCE',
+                        help='a data file and the URL of the instance it was '
+                        + 'collected for; if given, every file is converted '
+                        + 'without asking any questions')
+    parser.add_argument('--dry-run', action='store_true', help='report the '
+                        + 'weeks that would be added or changed without '
+                        + 'changing any data')
+    parser.add_argument('--report', help='save the weeks added or changed '
+                        + 'to this CSV file')
+    parser.add_argument('--force', action='store_true', help='merge the '
+                        + 'files even if they have already been merged')
+    parser.add_argument('--workers', type=int, help='the number of instances '
+                        + 'to convert at once (default: the number of CPUs)')
+    arguments = parser.parse_args()
+
+    if arguments.mappings:
+        convert_bulk(arguments)
     else:
-        # Sum the old and new 'statuses', 'logins', 'registrations', and
-        # 'count'.
-        data[data_entry]['statuses'] = \
-            str(int(data[data_entry]['statuses']) +
-                int(requested_data[requested_data_entry]['statuses']))
-        data[data_entry]['logins'] = \
-            str(int(data[data_entry]['logins']) +
-                int(requested_data[requested_data_entry]['logins']))
-        data[data_entry]['registrations'] = \
-            str(int(data[data_entry]['registrations']) +
-                int(requested_data[requested_data_entry]['registrations']))
-        data[data_entry]['count'] = \
-            str(int(data[data_entry]['count'])
-                + int(requested_data[requested_data_entry]['count']))
-
-# Store the data.
-try:
-    write_data = open('./data_files/' + file_name.netloc, 'wb')
-    dump(data, write_data)
-    write_data.close()
-    print('Successfully updated the activity data.')
-except Exception:
-    print('Failed to update the activity data.\nPlease try again.')
+        convert_interactive()
@@ -4,12 +4,20 @@ on a graph. When connected to a local LLM, it can also provide an AI analysis
 of the displayed data.
 
 To run this, use: python3 front-end.py
+To skip the welcome window, use: python3 front-end.py --no-welcome
 '''
 
+from argparse import ArgumentParser
+from time import perf_counter
 from tkinter import (Tk, ttk, Canvas, Text, Button, StringVar, Label, Toplevel,
                      BooleanVar, Checkbutton, Frame, font, Scale, colorchooser)
-from requests import get, post
 from webbrowser import open_new_tab
+from startup_loader import StartupLoader
+
+# Record when the front-end started, to report how long it took to show the
+# first chart. Only the standard library and the startup loader have been
+# imported so far, which is quick.
+startup_started = perf_counter()
 
 
 # Open a URL.
@@ -32,8 +40,30 @@ def copy_command(root):
     copy_pop_up.deiconify()
 
 
-# Create a welcome message window.
+# Report how long it took to show the first chart, and how much of that time
+# was spent after the welcome window was closed.
+def report_startup_time():
+    finished = perf_counter()
+    print(f'Time to first chart: {finished - startup_started:.2f}s '
+          + f'({finished - welcome_closed:.2f}s after the welcome window was '
+          + f'closed, data loaded after {loader.loaded_time:.2f}s).')
+
+
+parser = ArgumentParser(description='Display the collected activity data on '
+                        + 'a graph.')
+parser.add_argument('--no-welcome', action='store_true',
+                    help='do not show the welcome window')
+arguments = parser.parse_args()
+
+# Import the required packages and load the data in the background while the
+# welcome window is shown.
+loader = StartupLoader(startup_started).start()
+
+# Create a welcome message window. It is hidden straight away if it should not
+# be shown.
 welcome_window = Tk()
+if arguments.no_welcome:
+    welcome_window.withdraw()
 welcome_window.title('Welcome')
 welcome_font = font.Font(size=15)
 
@@ -82,56 +112,86 @@ command.bind('<Button-1>', lambda e: copy_command(welcome_window))
 link.bind('<Button-1>', lambda e: open_url('https://github.com/Ubaydullah-A/'
           + 'Charting-Mastodon-Activity'))
 
-welcome_window.mainloop()
+if arguments.no_welcome:
+    welcome_window.destroy()
+else:
+    welcome_window.mainloop()
+welcome_closed = perf_counter()
+
+# Wait for the required packages to be imported and the data to be loaded.
+loader.wait()
 
 try:
     import numpy
-    from pickle import load
-    from matplotlib.pyplot import close, subplots
     from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-    from pandas import DataFrame
     from sys import exit
     from datetime import datetime
     from time import mktime, strptime
     from tkcalendar import DateEntry
-    from os import listdir, mkdir, path
+    from os import mkdir, path
     from pathvalidate import is_valid_filename, sanitize_filename
+    from activity_frames import build_instance_index, InstanceCache
+    from activity_index import (filter_summaries, sort_summaries,
+                                describe_summary)
+    from activity_plot import PlotController, METRICS, AGGREGATE_STYLES
+    from activity_aggregate import aggregate_instances
+    from activity_analytics import AnalyticsCache, SERIES
+    from ai_analysis import (server_available, AnalysisWorker,
+                             build_llm_input, build_prompt,
+                             prompt_token_budget, DEFAULT_CONTEXT_TOKENS,
+                             ResponseCache, response_key, MapReduceWorker,
+                             DEFAULT_CONCURRENT_REQUESTS, SUMMARY_PROMPT)
+    from queue import Queue, Empty
 except Exception:
     raise SystemExit('Please install the required Python packages.\nMore '
                      + 'information can be found at: https://github.com/'
                      + 'Ubaydullah-A/Charting-Mastodon-Activity')
 
 
-# Plot the graph.
-def draw_figure(data_df_array, frame, file_name, save):
-    # Remove the old graph.
-    global figure_canvas_agg, selected_instances
-    figure_canvas_agg.get_tk_widget().destroy()
-    close('all')
+# Get the metrics that have been selected to be shown.
+def selected_metrics():
+    metrics = []
+    if show_statuses.get():
+        metrics.append('statuses')
+    if show_logins.get():
+        metrics.append('logins')
+    if show_registrations.get():
+        metrics.append('registrations')
+    return metrics
+
 
-    # Create the new graph.
-    fig, ax = subplots()
-    ax.grid()
+# Get the derived series that have been selected to be shown.
+def selected_series():
+    return [series for series in SERIES if show_series[series].get()]
+
+
+# Plot the graph. The same figure is reused for every graph, and only the data
+# of its lines is updated.
+def draw_figure(data_df_array, frame, file_name, save,
+                aggregate_df_array=None):
+    global figure_canvas_agg, selected_instances
     width_value = width_text_box.get('1.0', 'end-1c').strip()
     height_value = height_text_box.get('1.0', 'end-1c').strip()
+    width = None
+    height = None
 
     try:
         if width_value.isdigit() and height_value.isdigit():
-            fig.set_figwidth(int(width_value))
-            fig.set_figheight(int(height_value))
+            width = int(width_value)
+            height = int(height_value)
         elif width_value.isdigit() and height_value == '':
-            fig.set_figwidth(int(width_value))
+            width = int(width_value)
         elif height_value.isdigit() and width_value == '':
-            fig.set_figheight(int(height_value))
+            height = int(height_value)
         elif width_value.isdigit() and height_value != '':
-            fig.set_figwidth(int(width_value))
+            width = int(width_value)
             pop_up_window.title('Invalid height')
             pop_up_label.configure(text='The height entered was invalid.\nThe '
                                    + 'height has been reset.')
             pop_up_window.geometry('')
             pop_up_window.deiconify()
         elif height_value.isdigit() and width_value != '':
-            fig.set_figheight(int(height_value))
+            height = int(height_value)
             pop_up_window.title('Invalid width')
             pop_up_label.configure(text='The width entered was invalid.\nThe '
                                    + 'width has been reset.')
@@ -158,57 +218,30 @@ def draw_figure(data_df_array, frame, file_name, save):
             pop_up_window.deiconify()
 
         # Plot the data on the graph.
-        for index in range(len(data_df_array)):
-            for i in range(len(selected_instances)):
-                if (selected_instances[i][0] == data_df_array[index][0] and
-                        selected_instances[i][1] == 1):
-                    if show_statuses.get():
-                        ax.plot(data_df_array[index][1]['week'].to_numpy(),
-                                data_df_array[index][1]['statuses'].to_numpy()
-                                .astype(int) / data_df_array[index][1]['count']
-                                .to_numpy().astype(int),
-                                label=data_df_array[index][0] + ' statuses',
-                                marker='x')
-                    if show_logins.get():
-                        ax.plot(data_df_array[index][1]['week'].to_numpy(),
-                                data_df_array[index][1]['logins'].to_numpy()
-                                .astype(int) / data_df_array[index][1]['count']
-                                .to_numpy().astype(int),
-                                label=data_df_array[index][0] + ' logins',
-                                marker='x')
-                    if show_registrations.get():
-                        ax.plot(data_df_array[index][1]['week'].to_numpy(),
-                                data_df_array[index][1]['registrations']
-                                .to_numpy().astype(int)
-                                / data_df_array[index][1]['count']
-                                .to_numpy().astype(int),
-                                label=(data_df_array[index][0]
-                                       + ' registrations'), marker='x')
-                    break
-
-        # Create a graph legend.
-        if (show_statuses.get() or show_logins.get()
-                or show_registrations.get()):
-            for i in range(len(selected_instances)):
-                if selected_instances[i][1] == 1:
-                    ax.legend(loc='best')
-                    break
-
-        # Draw the graph to get the x-axis labels.
-        figure_canvas_agg = FigureCanvasTkAgg(fig, frame)
-        figure_canvas_agg.draw()
-        figure_canvas_agg.get_tk_widget().grid(row=4, column=5)
-
-        # Replace the x-axis labels with dates rather than Unix timestamps.
-        old_labels = [item.get_position() for item in ax.get_xticklabels()]
-        labels = old_labels.copy()
-        for label in range(0, len(labels)):
-            labels[label] = datetime.fromtimestamp(
-                    float(labels[label][0])).strftime('%d/%m/%y, %H:%M')
-        for x in range(0, len(old_labels)):
-            old_labels[x] = float(old_labels[x][0])
-        ax.set_xticks(old_labels)
-        ax.set_xticklabels(labels, rotation=15)
+        fig = plot_controller.figure
+        plot_controller.set_size(width, height)
+        # If the instances are combined, the instances in
+        # aggregate_df_array (or the selected instances) are aligned by week
+        # and shown as a few lines or a stacked area.
+        aggregate_style = AGGREGATE_OPTIONS[aggregate_chosen.get()]
+        if aggregate_style is None:
+            plot_controller.update(data_df_array, selected_metrics(),
+                                   analytics.derived_array(
+                                       data_df_array, selected_metrics(),
+                                       selected_series()))
+        else:
+            if aggregate_df_array is None:
+                aggregate_df_array = data_df_array
+            plot_controller.update_aggregate(
+                [[metric, aggregate_instances(aggregate_df_array, metric)]
+                 for metric in selected_metrics()], aggregate_style)
+
+        # Resize the canvas to fit the graph and redraw it.
+        figure_canvas_agg.get_tk_widget().configure(
+            width=int(fig.get_figwidth() * fig.dpi),
+            height=int(fig.get_figheight() * fig.dpi))
+        figure_canvas_agg.draw_idle()
+
         if save:
             if not path.exists('./graphs/'):
                 mkdir('graphs')
@@ -262,23 +295,36 @@ def on_closing():
     close_window.deiconify()
 
 
-# Create the DataFrame.
-def create_dataframe(data):
+# Create the DataFrame. The DataFrame for each selected instance (or each of
+# the instances in names, if given) is taken from the instance cache, which
+# only loads an instance when it is first needed or when its data has changed,
+# and is sorted by 'week'. If start and end are given, only the weeks from
+# start up to (but not including) end are used.
+def create_dataframe(data, start=None, end=None, names=None):
     global selected_instances
+    if names is None:
+        names = [instance[0] for instance in selected_instances
+                 if instance[1] == 1]
     data_df_array = []
-    for i in range(len(selected_instances)):
-        if selected_instances[i][1] == 1:
-            for index in range(len(data)):
-                if selected_instances[i][0] == data[index][0]:
-                    break
-            data_df = DataFrame(data[index][1])
-            data_df = data_df.sort_values(by=['week'], ascending=False)
-            data_df = data_df.reset_index()
-            data_df = data_df.drop('index', axis=1)
-            data_df_array.append([selected_instances[i][0], data_df])
+    for name in names:
+        try:
+            if start is None:
+                data_df = data.frame(name)
+            else:
+                data_df = data.frame_range(name, start, end)
+        except Exception:
+            continue
+        data_df_array.append([name, data_df])
     return data_df_array
 
 
+# Get the names of the instances listed in the combobox (those matching the
+# filter).
+def listed_instances():
+    return [instance_labels[label] for label in combobox.cget('values')
+            if label in instance_labels]
+
+
 # Get the inputs from the relevant entry elements to provide the required data
 # to create the new graph (and save it if required).
 def get_inputs(data, frame, save, ai_response):
@@ -286,7 +332,6 @@ def get_inputs(data, frame, save, ai_response):
     file_name = save_text_box.get('1.0', 'end-1c')
     # Create a new DataFrame which only contains the data between midnight of
     # the earlier date and just before the end of the later date.
-    data_df_array = create_dataframe(data)
     limit1 = int(mktime(strptime(date1.get(), '%d/%m/%Y')))
     limit2 = int(mktime(strptime(date2.get(), '%d/%m/%Y')))
     if limit1 > limit2:
@@ -294,25 +339,25 @@ def get_inputs(data, frame, save, ai_response):
         limit1 = limit2
         limit2 = temp
     limit2 += (24 * 60 * 60)
-    for index in range(len(data_df_array)):
-        data_df_array[index][1] = \
-            data_df_array[index][1][data_df_array[index][1]['week']
-                                    .astype(int) >= limit1]
-        data_df_array[index][1] = \
-            data_df_array[index][1][data_df_array[index][1]['week']
-                                    .astype(int) < limit2]
+    data_df_array = create_dataframe(data, limit1, limit2)
+    aggregate_df_array = None
+    if (AGGREGATE_OPTIONS[aggregate_chosen.get()] is not None
+            and combine_listed.get()):
+        aggregate_df_array = create_dataframe(data, limit1, limit2,
+                                              listed_instances())
     if ai_response:
         # Ensure all inputs are valid.
-        llm_input = []
-        temp = []
         valid_ai_inputs = False
         server_address_text = server_address_text_box.get('1.0', 'end-1c')
         model_text = model_text_box.get('1.0', 'end-1c')
         max_tokens_text = max_tokens_text_box.get('1.0', 'end-1c')
         temperature_text = temperature_text_box.get('1.0', 'end-1c')
+        context_tokens_text = context_tokens_text_box.get('1.0',
+                                                          'end-1c').strip()
+        concurrent_requests_text = concurrent_requests_text_box.get(
+            '1.0', 'end-1c').strip()
         try:
-            response = get(f'{server_address_text}/v1/models')
-            if response.status_code == 200:
+            if server_available(server_address_text):
                 if model_text != '':
                     if max_tokens_text != '' and max_tokens_text.isdigit():
                         if temperature_text != '':
@@ -352,37 +397,52 @@ def get_inputs(data, frame, save, ai_response):
                                        + ' the LLM.')
                 pop_up_window.geometry('')
                 pop_up_window.deiconify()
+            if (valid_ai_inputs and context_tokens_text != ''
+                    and not context_tokens_text.isdigit()):
+                pop_up_window.title('Invalid context length')
+                pop_up_label.configure(text='Please enter a valid value for '
+                                       + 'the context length.')
+                pop_up_window.geometry('')
+                pop_up_window.deiconify()
+                valid_ai_inputs = False
+            if (valid_ai_inputs and concurrent_requests_text != ''
+                    and (not concurrent_requests_text.isdigit()
+                         or int(concurrent_requests_text) == 0)):
+                pop_up_window.title('Invalid number of requests')
+                pop_up_label.configure(text='Please enter a valid value for '
+                                       + 'the number of simultaneous '
+                                       + 'requests.')
+                pop_up_window.geometry('')
+                pop_up_window.deiconify()
+                valid_ai_inputs = False
             if valid_ai_inputs:
-                # Create the array that will provide the data to the LLM.
-                for index in range(len(data_df_array)):
-                    for week in range(len(data_df_array[index][1]['week'])):
-                        instance = data_df_array[index][0]
-                        temp.append('Instance:' + data_df_array[index][0])
-                        week_date = datetime.fromtimestamp(
-                            float(data_df_array[index][1]['week'][week]))\
-                            .strftime('%d/%m/%y')
-                        temp.append('Date:' + week_date)
-                        if show_statuses.get():
-                            statuses = \
-                                (int(data_df_array[index][1]['statuses'][week])
-                                 / int(data_df_array[index][1]['count'][week]))
-                            temp.append('statuses:' + str(statuses))
-                        if show_logins.get():
-                            logins = \
-                                (int(data_df_array[index][1]['logins'][week])
-                                 / int(data_df_array[index][1]['count'][week]))
-                            temp.append('logins:' + str(logins))
-                        if show_registrations.get():
-                            registrations = (int(
-                                    data_df_array[index][1]
-                                    ['registrations'][week])
-                                    / int(data_df_array[index][1]
-                                          ['count'][week]))
-                            temp.append('registrations:' + str(registrations))
-                        llm_input.append(temp)
-                        temp = []
-                get_ai_response(llm_input, max_tokens_text, model_text,
-                                temperature_text, server_address_text)
+                # Create the table that will provide the data to the LLM,
+                # averaging it over longer periods if it would not fit in the
+                # model's context window. If each instance is analysed
+                # separately, a table is created for each instance.
+                context_tokens = DEFAULT_CONTEXT_TOKENS
+                if context_tokens_text != '':
+                    context_tokens = int(context_tokens_text)
+                concurrent_requests = DEFAULT_CONCURRENT_REQUESTS
+                if concurrent_requests_text != '':
+                    concurrent_requests = int(concurrent_requests_text)
+                token_budget = prompt_token_budget(int(max_tokens_text),
+                                                   context_tokens)
+                if analyse_separately.get() and len(data_df_array) > 1:
+                    groups = [[data_df_item] for data_df_item
+                              in data_df_array]
+                else:
+                    groups = [data_df_array]
+                prompts = []
+                for group in groups:
+                    llm_input, period = build_llm_input(
+                        group, selected_metrics(), token_budget)
+                    prompts.append([group[0][0],
+                                    build_prompt(llm_input, period)])
+                get_ai_response(prompts, max_tokens_text, model_text,
+                                temperature_text, server_address_text,
+                                [name for name, data_df in data_df_array],
+                                concurrent_requests, token_budget)
         except Exception:
             pop_up_window.title('Unable to connect to LLM')
             pop_up_label.configure(text='An error occurred when trying to '
@@ -392,7 +452,7 @@ def get_inputs(data, frame, save, ai_response):
             pop_up_window.geometry('')
             pop_up_window.deiconify()
 
-    draw_figure(data_df_array, frame, file_name, save)
+    draw_figure(data_df_array, frame, file_name, save, aggregate_df_array)
 
 
 # Adjust the region that can be scrolled when the information displayed on the
@@ -420,7 +480,8 @@ def resize_ai_output(event):
 def instance_changed(event):
     global selected_instances
     for index in range(len(selected_instances)):
-        if selected_instances[index][0] == instance_chosen.get():
+        if selected_instances[index][0] == instance_labels.get(
+                instance_chosen.get()):
             if selected_instances[index][1] == 0:
                 selected_instances[index][1] = 1
             else:
@@ -429,6 +490,15 @@ def instance_changed(event):
     get_inputs(data, frame, False, False)
 
 
+# Show the instances whose names contain the filter text in the combobox, in
+# the chosen order, described using the index of instances.
+def instance_filter_changed(event):
+    summaries = filter_summaries(instance_index,
+                                 filter_text_box.get('1.0', 'end-1c').strip())
+    summaries = sort_summaries(summaries, SORT_OPTIONS[sort_chosen.get()])
+    combobox['values'] = [describe_summary(summary) for summary in summaries]
+
+
 # Change the font when a new font is selected.
 def font_changed(event):
     app_font.configure(family=font_chosen.get())
@@ -449,6 +519,9 @@ def font_size_changed(event):
     app_width_4 = int(round((1/font_size_scale.get()) * 300))
     date1.configure(width=app_width_1)
     date2.configure(width=app_width_2)
+    filter_text_box.configure(width=app_width_2)
+    sort_combobox.configure(width=app_width_1)
+    aggregate_combobox.configure(width=app_width_1)
     width_text_box.configure(width=app_width_2)
     height_text_box.configure(width=app_width_2)
     save_text_box.configure(width=app_width_3)
@@ -458,6 +531,8 @@ def font_size_changed(event):
     model_text_box.configure(width=app_width_4)
     max_tokens_text_box.configure(width=app_width_4)
     temperature_text_box.configure(width=app_width_4)
+    context_tokens_text_box.configure(width=app_width_4)
+    concurrent_requests_text_box.configure(width=app_width_4)
 
 
 # Explicitly change the background colour of every relevant element.
@@ -470,6 +545,14 @@ def choose_bg_colour():
     configuration_grid.configure(bg=chosen_bg_colour[1])
     dates_grid.configure(bg=chosen_bg_colour[1])
     checkbox_grid.configure(bg=chosen_bg_colour[1])
+    instance_filter_grid.configure(bg=chosen_bg_colour[1])
+    filter_label.configure(bg=chosen_bg_colour[1])
+    sort_label.configure(bg=chosen_bg_colour[1])
+    aggregate_grid.configure(bg=chosen_bg_colour[1])
+    aggregate_label.configure(bg=chosen_bg_colour[1])
+    combine_listed_checkbox.configure(bg=chosen_bg_colour[1],
+                                      highlightbackground=chosen_bg_colour[1])
+    filter_text_box.configure(highlightbackground=chosen_bg_colour[1])
     window_configuration_label.configure(bg=chosen_bg_colour[1])
     change_font_label.configure(bg=chosen_bg_colour[1])
     change_font_size_label.configure(bg=chosen_bg_colour[1])
@@ -485,6 +568,9 @@ def choose_bg_colour():
                               highlightbackground=chosen_bg_colour[1])
     registrations_checkbox.configure(bg=chosen_bg_colour[1],
                                      highlightbackground=chosen_bg_colour[1])
+    for series_checkbox in series_checkboxes:
+        series_checkbox.configure(bg=chosen_bg_colour[1],
+                                  highlightbackground=chosen_bg_colour[1])
     graph_size_grid.configure(bg=chosen_bg_colour[1])
     width_label.configure(bg=chosen_bg_colour[1])
     height_label.configure(bg=chosen_bg_colour[1])
@@ -528,6 +614,14 @@ def choose_bg_colour():
     model_text_box.configure(highlightbackground=chosen_bg_colour[1])
     temperature_label.configure(bg=chosen_bg_colour[1])
     temperature_text_box.configure(highlightbackground=chosen_bg_colour[1])
+    context_tokens_label.configure(bg=chosen_bg_colour[1])
+    context_tokens_text_box.configure(
+        highlightbackground=chosen_bg_colour[1])
+    analyse_separately_checkbox.configure(
+        bg=chosen_bg_colour[1], highlightbackground=chosen_bg_colour[1])
+    concurrent_requests_label.configure(bg=chosen_bg_colour[1])
+    concurrent_requests_text_box.configure(
+        highlightbackground=chosen_bg_colour[1])
 
 
 # Explicitly change the colour of every relevant input element.
@@ -540,11 +634,14 @@ def choose_input_colour():
     width_text_box.configure(bg=chosen_input_colour[1])
     height_text_box.configure(bg=chosen_input_colour[1])
     save_text_box.configure(bg=chosen_input_colour[1])
+    filter_text_box.configure(bg=chosen_input_colour[1])
     ai_text_box.configure(bg=chosen_input_colour[1])
     server_address_text_box.configure(bg=chosen_input_colour[1])
     max_tokens_text_box.configure(bg=chosen_input_colour[1])
     model_text_box.configure(bg=chosen_input_colour[1])
     temperature_text_box.configure(bg=chosen_input_colour[1])
+    context_tokens_text_box.configure(bg=chosen_input_colour[1])
+    concurrent_requests_text_box.configure(bg=chosen_input_colour[1])
 
 
 # Explicitly change the colour of every relevant text element.
@@ -561,6 +658,12 @@ def choose_text_colour():
     highlight_colour_button.configure(fg=chosen_text_colour[1])
     graph_configuration_label.configure(fg=chosen_text_colour[1])
     combobox_label.configure(fg=chosen_text_colour[1])
+    filter_label.configure(fg=chosen_text_colour[1])
+    sort_label.configure(fg=chosen_text_colour[1])
+    aggregate_label.configure(fg=chosen_text_colour[1])
+    combine_listed_checkbox.configure(fg=chosen_text_colour[1])
+    filter_text_box.configure(fg=chosen_text_colour[1],
+                              selectforeground=chosen_text_colour[1])
     entries_label.configure(fg=chosen_text_colour[1])
     entries_button.configure(fg=chosen_text_colour[1])
     save_label.configure(fg=chosen_text_colour[1])
@@ -570,6 +673,8 @@ def choose_text_colour():
     statuses_checkbox.configure(fg=chosen_text_colour[1])
     logins_checkbox.configure(fg=chosen_text_colour[1])
     registrations_checkbox.configure(fg=chosen_text_colour[1])
+    for series_checkbox in series_checkboxes:
+        series_checkbox.configure(fg=chosen_text_colour[1])
     width_label.configure(fg=chosen_text_colour[1])
     width_text_box.configure(fg=chosen_text_colour[1],
                              selectforeground=chosen_text_colour[1])
@@ -600,7 +705,15 @@ def choose_text_colour():
     temperature_label.configure(fg=chosen_text_colour[1])
     temperature_text_box.configure(fg=chosen_text_colour[1],
                                    selectforeground=chosen_text_colour[1])
+    context_tokens_label.configure(fg=chosen_text_colour[1])
+    context_tokens_text_box.configure(fg=chosen_text_colour[1],
+                                      selectforeground=chosen_text_colour[1])
+    analyse_separately_checkbox.configure(fg=chosen_text_colour[1])
+    concurrent_requests_label.configure(fg=chosen_text_colour[1])
+    concurrent_requests_text_box.configure(
+        fg=chosen_text_colour[1], selectforeground=chosen_text_colour[1])
     ai_analysis_button.configure(fg=chosen_text_colour[1])
+    ai_cancel_button.configure(fg=chosen_text_colour[1])
 
 
 # Explicitly change the colour of every relevant button element.
@@ -617,6 +730,7 @@ def choose_button_colour():
     close_no_button.configure(bg=chosen_button_colour[1])
     close_yes_button.configure(bg=chosen_button_colour[1])
     ai_analysis_button.configure(bg=chosen_button_colour[1])
+    ai_cancel_button.configure(bg=chosen_button_colour[1])
 
 
 # Explicitly change the highlight colour of every relevant element.
@@ -637,6 +751,8 @@ def choose_highlight_colour():
     separator.configure(bg=chosen_highlight_colour[1])
     save_text_box.configure(selectbackground=chosen_highlight_colour[1],
                             insertbackground=chosen_highlight_colour[1])
+    filter_text_box.configure(selectbackground=chosen_highlight_colour[1],
+                              insertbackground=chosen_highlight_colour[1])
     width_text_box.configure(selectbackground=chosen_highlight_colour[1],
                              insertbackground=chosen_highlight_colour[1])
     height_text_box.configure(selectbackground=chosen_highlight_colour[1],
@@ -662,8 +778,15 @@ def choose_highlight_colour():
                              insertbackground=chosen_highlight_colour[1])
     temperature_text_box.configure(selectbackground=chosen_highlight_colour[1],
                                    insertbackground=chosen_highlight_colour[1])
+    context_tokens_text_box.configure(
+        selectbackground=chosen_highlight_colour[1],
+        insertbackground=chosen_highlight_colour[1])
+    concurrent_requests_text_box.configure(
+        selectbackground=chosen_highlight_colour[1],
+        insertbackground=chosen_highlight_colour[1])
     ai_analysis_button.configure(
         highlightbackground=chosen_highlight_colour[1])
+    ai_cancel_button.configure(highlightbackground=chosen_highlight_colour[1])
 
 
 # Hide the pop-up windows to allow for them to be used again.
@@ -681,34 +804,109 @@ def iconify_ai_pop_up():
     ai_analysis_window.iconify()
 
 
-# Interact with the LLM to provide the data and display the response.
-def get_ai_response(llm_input, max_tokens, model, temperature, server_address):
-    # Define the prompt and parameters
-    payload = {
-        'model': model,
-        'prompt': 'What trends can you find from this data: ' + str(llm_input),
-        'max_tokens': max_tokens,
-        'temperature': temperature
-    }
+# Interact with the LLM to provide the data and display the response. The
+# requests are sent on a worker thread, and the response is shown as it is
+# generated. prompts contains an [instance, prompt] pair for each request: if
+# there is more than one, each prompt is analysed separately and the analyses
+# are then summarised. If the same analysis of the same data has already been
+# generated, the cached response is shown instead.
+def get_ai_response(prompts, max_tokens, model, temperature, server_address,
+                    instances, concurrent_requests, token_budget):
+    global ai_worker
+    # Define the prompts and parameters
+    instance_payloads = []
+    for name, prompt in prompts:
+        instance_payloads.append([name, {
+            'model': model,
+            'prompt': prompt,
+            'max_tokens': int(max_tokens),
+            'temperature': float(temperature)
+        }])
+    payload = dict(instance_payloads[0][1], prompt='\n'.join(
+        prompt for name, prompt in prompts))
+    if len(prompts) > 1:
+        payload['prompt'] += SUMMARY_PROMPT
+
+    # Stop any analysis that is still running.
+    if ai_worker is not None:
+        ai_worker.cancel()
+        ai_worker = None
 
-    # Send the request
-    ai_analysis_window.iconify()
-    response = post(f'{server_address}/v1/completions', json=payload)
-
-    if response.status_code == 200:
-        data = response.json()
-        ai_text_box.configure(state='normal')
-        ai_text_box.delete('0.0', 'end')
-        ai_text_box.insert(1.0, data.get('choices', [{}])[0]
-                           .get('text', 'No response'))
+    ai_text_box.configure(state='normal')
+    ai_text_box.delete('0.0', 'end')
+    ai_analysis_window.deiconify()
+
+    # Show the cached response if there is one.
+    key = response_key(payload)
+    cached_response = response_cache.get(key)
+    if cached_response is not None:
+        ai_text_box.insert('end', cached_response)
         ai_text_box.configure(state='disabled')
+        ai_cancel_button.configure(state='disabled')
+        return
+
+    # Send the request
+    ai_text_box.configure(state='disabled')
+    ai_cancel_button.configure(state='normal')
+    if len(prompts) > 1:
+        ai_worker = MapReduceWorker(server_address, instance_payloads, Queue(),
+                                    concurrent_requests, token_budget,
+                                    lambda response: cache_ai_response(
+                                        key, instances, response))
     else:
-        ai_text_box.configure(state='normal')
-        ai_text_box.delete('0.0', 'end')
-        ai_text_box.insert(1.0, 'Error: ' + str(response.status_code) + ' - '
-                           + response.text)
-        ai_text_box.configure(state='disabled')
-    ai_analysis_window.deiconify()
+        ai_worker = AnalysisWorker(server_address, payload, Queue(),
+                                   lambda response: cache_ai_response(
+                                       key, instances, response))
+    ai_worker.start()
+    show_ai_response(ai_worker)
+
+
+# Cache a complete response from the LLM. The response is still shown if it
+# cannot be cached.
+def cache_ai_response(key, instances, response):
+    try:
+        response_cache.put(key, instances, response)
+    except OSError:
+        pass
+
+
+# Show the parts of the response that have been received from the LLM, and
+# check again shortly until the response is complete.
+def show_ai_response(worker):
+    if worker is not ai_worker:
+        # The analysis has been replaced by a new one.
+        return
+    received_text = False
+    ai_text_box.configure(state='normal')
+    try:
+        while True:
+            kind, text = worker.output_queue.get_nowait()
+            if kind == 'text':
+                ai_text_box.insert('end', text)
+                received_text = True
+            elif kind == 'error':
+                ai_text_box.delete('0.0', 'end')
+                ai_text_box.insert('end', text)
+                received_text = True
+            else:
+                if ai_text_box.get('1.0', 'end-1c') == '':
+                    ai_text_box.insert('end', 'No response')
+                ai_text_box.configure(state='disabled')
+                ai_cancel_button.configure(state='disabled')
+                return
+    except Empty:
+        pass
+    if received_text:
+        ai_text_box.see('end')
+    ai_text_box.configure(state='disabled')
+    root.after(50, show_ai_response, worker)
+
+
+# Stop the analysis that is running.
+def cancel_ai_response():
+    if ai_worker is not None:
+        ai_worker.cancel()
+    ai_cancel_button.configure(state='disabled')
 
 
 # Create the window.
@@ -747,44 +945,68 @@ frame.bind('<Configure>', on_frame_configure)
 show_statuses = BooleanVar()
 show_logins = BooleanVar()
 show_registrations = BooleanVar()
-
-# Check if data has been collected.
-try:
-    file_check = open('./data_files/' + listdir('./data_files')[0], 'a')
-    file_check.close()
-except Exception:
+show_series = {series: BooleanVar() for series in SERIES}
+combine_listed = BooleanVar()
+
+# Check if data has been collected, using the index of the instances it has
+# been collected for and the cache of the collected data that were created in
+# the background. The cache loads the data for each instance when it is first
+# selected. If creating them in the background failed, they are created now.
+if loader.error is None:
+    instance_index = loader.instance_index
+    data = loader.data
+else:
+    instance_index = build_instance_index()
+    data = InstanceCache()
+if not instance_index:
     raise SystemExit('No data has been collected.')
 
+# Create the cache of the series derived from the collected data, which are
+# calculated when they are first shown and again when the data changes.
+analytics = AnalyticsCache(data)
+instance_names = [entry['name'] for entry in instance_index]
+
+
+# Get the cached resolutions a line is drawn at, for the collected values of
+# a metric (if series is None) or a series derived from them.
+def line_levels(name, metric, series):
+    if series is None:
+        return data.levels(name, metric)
+    return analytics.levels(name, metric, series)
+
+
+# Create the descriptions of the instances shown in the combobox, and the
+# options for sorting them.
+instance_labels = {describe_summary(entry): entry['name']
+                   for entry in instance_index}
+SORT_OPTIONS = {'Name': 'name', 'Most weeks collected': 'rows',
+                'Most recently collected': 'last_week',
+                'Most statuses': 'statuses', 'Most logins': 'logins',
+                'Most registrations': 'registrations',
+                'Fastest growing statuses': 'growth:statuses',
+                'Fastest growing logins': 'growth:logins',
+                'Fastest growing registrations': 'growth:registrations'}
+
+# Create the options for showing the instances separately or combined.
+AGGREGATE_OPTIONS = {'Separate lines': None}
+for aggregate_style, description in AGGREGATE_STYLES.items():
+    AGGREGATE_OPTIONS[description] = aggregate_style
+
 # Create the array that tracks which instances have been selected.
 selected_instances = []
-for x in listdir('./data_files'):
+for x in instance_names:
     selected_instances.append([x, 0])
 selected_instances[0][1] = 1
 
-# Get the collected data.
-data = []
-for instance in range(len(listdir('./data_files'))):
-    try:
-        data_file = open('./data_files/' + listdir('./data_files')[instance],
-                         'rb')
-        data.append([listdir('./data_files')[instance], load(data_file)])
-        data_file.close()
-    except Exception:
-        continue
-
-# Create a DataFrame to set the value for how much data to show initially.
-data_df = DataFrame(data[0][1])
-data_df = data_df.sort_values(by=['week'], ascending=False)
-data_df = data_df.reset_index()
-data_df = data_df.drop('index', axis=1)
-if len(data_df) < 12:
-    data_quantity = len(data_df)
+# Set the value for how much data to show initially.
+if instance_index[0]['rows'] < 12:
+    data_quantity = instance_index[0]['rows']
 else:
     data_quantity = 12
 
 # Create the initial DataFrame using the data_quantity limit.
 data_df_array = create_dataframe(data)
-data_df = data_df_array[0][1].head(data_quantity)
+data_df = data_df_array[0][1].tail(data_quantity)
 
 # Create the frame for getting inputs from the user to configure the window.
 configuration_grid = Frame(frame, height=250, width=300)
@@ -846,8 +1068,14 @@ ai_analysis_window.protocol('WM_DELETE_WINDOW', iconify_ai_pop_up)
 ai_label = Label(ai_analysis_window, font=app_pop_up_font,
                  text='AI analysis response')
 ai_text_box = Text(ai_analysis_window, font=app_textbox_font, state='disabled')
+ai_cancel_button = Button(ai_analysis_window, text='Cancel', command=lambda:
+                          cancel_ai_response(), font=app_font,
+                          state='disabled')
 ai_label.pack(fill='both', expand=True)
+ai_cancel_button.pack(side='bottom', pady=5)
 ai_text_box.pack()
+ai_worker = None
+response_cache = ResponseCache()
 ai_analysis_window.geometry('1050x300')
 ai_analysis_window.iconify()
 
@@ -939,11 +1167,27 @@ temperature_label = Label(configuration_grid, text='Enter the temperature '
                           + 'value: ', wraplength=400, font=app_font)
 temperature_text_box = Text(configuration_grid, height=1, width=30,
                             font=app_textbox_font)
-ai_analysis_button = Button(configuration_grid, text='Generate AI analysis\n('
-                            + 'window will\nbe temporarily\nunresponsive)',
+context_tokens_label = Label(configuration_grid, text='Enter the model\'s '
+                             + 'context length in tokens (optional): ',
+                             wraplength=400, font=app_font)
+context_tokens_text_box = Text(configuration_grid, height=1, width=30,
+                               font=app_textbox_font)
+analyse_separately = BooleanVar()
+analyse_separately_checkbox = Checkbutton(configuration_grid, text='Analyse '
+                                          + 'each instance separately',
+                                          variable=analyse_separately,
+                                          onvalue=True, offvalue=False,
+                                          wraplength=290, font=app_font)
+concurrent_requests_label = Label(configuration_grid, text='Enter the maximum '
+                                  + 'number of simultaneous requests '
+                                  + '(optional): ', wraplength=400,
+                                  font=app_font)
+concurrent_requests_text_box = Text(configuration_grid, height=1, width=30,
+                                    font=app_textbox_font)
+ai_analysis_button = Button(configuration_grid, text='Generate AI analysis',
                             command=lambda:
                                 get_inputs(data, frame, False, True),
-                                font=app_font, height=4)
+                                font=app_font, height=2)
 empty_row_7 = Label(configuration_grid, text='')
 empty_row_8 = Label(configuration_grid, text='')
 server_address_label.grid(row=16, column=0, sticky='ew')
@@ -954,9 +1198,14 @@ max_tokens_label.grid(row=20, column=0, sticky='ew')
 max_tokens_text_box.grid(row=21, column=0, sticky='ew')
 temperature_label.grid(row=22, column=0, sticky='ew')
 temperature_text_box.grid(row=23, column=0, sticky='ew')
-empty_row_7.grid(row=24, column=0)
-ai_analysis_button.grid(row=25, column=0, sticky='ew')
-empty_row_8.grid(row=26, column=0)
+context_tokens_label.grid(row=24, column=0, sticky='ew')
+context_tokens_text_box.grid(row=25, column=0, sticky='ew')
+analyse_separately_checkbox.grid(row=26, column=0, sticky='w')
+concurrent_requests_label.grid(row=27, column=0, sticky='ew')
+concurrent_requests_text_box.grid(row=28, column=0, sticky='ew')
+empty_row_7.grid(row=29, column=0)
+ai_analysis_button.grid(row=30, column=0, sticky='ew')
+empty_row_8.grid(row=31, column=0)
 
 # Add padding around the frames and the separator.
 empty_column_1 = Label(frame, text='', width=2)
@@ -989,43 +1238,13 @@ separator.grid(row=0, column=3, rowspan=6, sticky='ns')
 input_grid = Frame(frame, height=250, width=300)
 input_grid.grid(row=1, column=5, sticky='w')
 
-# Create the initial graph.
-fig, ax = subplots()
-ax.grid()
-
-# Plot the data on the graph.
-ax.plot(data_df['week'].to_numpy(),
-        data_df['statuses'].to_numpy().astype(int) /
-        data_df['count'].to_numpy().astype(int),
-        label=data_df_array[0][0] + ' statuses', marker='x')
-ax.plot(data_df['week'].to_numpy(),
-        data_df['logins'].to_numpy().astype(int) /
-        data_df['count'].to_numpy().astype(int),
-        label=data_df_array[0][0] + ' logins', marker='x')
-ax.plot(data_df['week'].to_numpy(),
-        data_df['registrations'].to_numpy().astype(int) /
-        data_df['count'].to_numpy().astype(int),
-        label=data_df_array[0][0] + ' registrations', marker='x')
-
-# Create a graph legend.
-ax.legend(loc='best')
-
-# Draw the graph to get the x-axis labels.
-figure_canvas_agg = FigureCanvasTkAgg(fig, frame)
+# Create the initial graph, which is reused for every graph drawn.
+plot_controller = PlotController(levels=line_levels)
+plot_controller.update([[data_df_array[0][0], data_df]], METRICS)
+figure_canvas_agg = FigureCanvasTkAgg(plot_controller.figure, frame)
 figure_canvas_agg.draw()
 figure_canvas_agg.get_tk_widget().grid(row=4, column=5)
 
-# Replace the x-axis labels with dates rather than Unix timestamps.
-old_labels = [item.get_position() for item in ax.get_xticklabels()]
-labels = old_labels.copy()
-for label in range(0, len(labels)):
-    labels[label] = datetime.fromtimestamp(
-            float(labels[label][0])).strftime('%d/%m/%y, %H:%M')
-for x in range(0, len(old_labels)):
-    old_labels[x] = float(old_labels[x][0])
-ax.set_xticks(old_labels)
-ax.set_xticklabels(labels, rotation=15)
-
 graph_configuration_label = Label(input_grid, text='Graph Configuration',
                                   anchor='w', wraplength=800,
                                   font=app_title_font)
@@ -1039,9 +1258,27 @@ combobox_label = Label(input_grid,
 combobox_label.grid(row=1, column=0, sticky='w')
 combobox = ttk.Combobox(input_grid, state='readonly',
                         textvariable=instance_chosen, font=app_textbox_font)
-combobox['values'] = listdir('./data_files')
+combobox['values'] = list(instance_labels)
 combobox.grid(row=2, column=0, columnspan=2, sticky='ew')
 
+# Create the elements for filtering and sorting the instances in the combobox.
+instance_filter_grid = Frame(input_grid, height=50, width=300)
+filter_label = Label(instance_filter_grid, text='Filter the instances by '
+                     + 'name:', anchor='sw', font=app_font)
+filter_text_box = Text(instance_filter_grid, height=1, width=43, pady=5,
+                       padx=2, font=app_textbox_font)
+sort_label = Label(instance_filter_grid, text='Sort the instances by:',
+                   anchor='sw', font=app_font)
+sort_chosen = StringVar(value='Name')
+sort_combobox = ttk.Combobox(instance_filter_grid, state='readonly', width=42,
+                             textvariable=sort_chosen, font=app_textbox_font)
+sort_combobox['values'] = list(SORT_OPTIONS)
+filter_label.grid(row=0, column=0, sticky='w')
+filter_text_box.grid(row=1, column=0, sticky='w')
+sort_label.grid(row=0, column=1, sticky='w')
+sort_combobox.grid(row=1, column=1, sticky='ew')
+instance_filter_grid.grid(row=3, column=0, columnspan=2, sticky='w')
+
 entries_label = Label(input_grid,
                       text='Enter the start and end dates for the data:',
                       anchor='sw', wraplength=800, font=app_font)
@@ -1068,20 +1305,44 @@ checkbox_grid = Frame(input_grid, height=50, width=300)
 # Create the frames for the width and height inputs.
 graph_size_grid = Frame(input_grid, height=50, width=300)
 
+# Create the frame for choosing how the instances are shown.
+aggregate_grid = Frame(input_grid, height=50, width=300)
+
 # Add the elements to the input_grid frame.
-entries_label.grid(row=3, column=0, sticky='sw')
+entries_label.grid(row=4, column=0, sticky='sw')
+
+dates_grid.grid(row=5, column=0, sticky='ew')
 
-dates_grid.grid(row=4, column=0, sticky='ew')
+entries_button.grid(row=5, column=1, rowspan=4, sticky='ns')
 
-entries_button.grid(row=4, column=1, rowspan=4, sticky='ns')
+graph_size_grid.grid(row=6, column=0, sticky='w')
 
-graph_size_grid.grid(row=5, column=0, sticky='w')
+aggregate_grid.grid(row=7, column=0, sticky='w')
 
-checkbox_grid.grid(row=7, column=0, sticky='nw')
+checkbox_grid.grid(row=8, column=0, sticky='nw')
 
-save_label.grid(row=8, column=0, sticky='sw')
-save_text_box.grid(row=9, column=0, sticky='w')
-save_button.grid(row=9, column=1)
+save_label.grid(row=9, column=0, sticky='sw')
+save_text_box.grid(row=10, column=0, sticky='w')
+save_button.grid(row=10, column=1)
+
+# Create the elements for choosing whether the instances are shown separately
+# or combined, and which instances are combined.
+aggregate_label = Label(aggregate_grid, text='Show the instances as:',
+                        anchor='sw', font=app_font)
+aggregate_chosen = StringVar(value='Separate lines')
+aggregate_combobox = ttk.Combobox(aggregate_grid, state='readonly', width=42,
+                                  textvariable=aggregate_chosen,
+                                  font=app_textbox_font)
+aggregate_combobox['values'] = list(AGGREGATE_OPTIONS)
+combine_listed_checkbox = Checkbutton(aggregate_grid, text='Combine every '
+                                      + 'listed instance (not only the '
+                                      + 'selected instances)',
+                                      variable=combine_listed, onvalue=True,
+                                      offvalue=False, wraplength=400,
+                                      font=app_font)
+aggregate_label.grid(row=0, column=0, sticky='w')
+aggregate_combobox.grid(row=1, column=0, sticky='w')
+combine_listed_checkbox.grid(row=1, column=1, sticky='w')
 
 # Create the checkboxes that will determine if a metric is shown.
 statuses_checkbox = Checkbutton(checkbox_grid, text='Show statuses',
@@ -1103,6 +1364,20 @@ statuses_checkbox.grid(row=0, column=0)
 logins_checkbox.grid(row=0, column=1)
 registrations_checkbox.grid(row=0, column=2)
 
+# Create the checkboxes that will determine if each derived series (such as
+# the rolling average or growth of each metric shown) is shown, and add them
+# below the checkboxes for the metrics.
+series_checkboxes = []
+for position, series in enumerate(SERIES):
+    series_checkbox = Checkbutton(checkbox_grid, text='Show '
+                                  + SERIES[series],
+                                  variable=show_series[series], onvalue=True,
+                                  offvalue=False, wraplength=240,
+                                  font=app_font)
+    series_checkbox.grid(row=1 + position // 3, column=position % 3,
+                         sticky='w')
+    series_checkboxes.append(series_checkbox)
+
 # Create the elements for the graph_size_grid frame.
 width_label = Label(graph_size_grid, text='Enter the width of the graph ' +
                     'in inches (optional): ', wraplength=400, font=app_font)
@@ -1119,15 +1394,16 @@ width_text_box.grid(row=1, column=0)
 height_label.grid(row=0, column=1, sticky='w')
 height_text_box.grid(row=1, column=1)
 
-# Create the calendars for the dates_grid frame.
-start_date = datetime.fromtimestamp(float(old_labels[0])).strftime('%d/%m/%Y')
+# Create the calendars for the dates_grid frame, starting with the dates of the
+# data shown initially.
+start_date = datetime.fromtimestamp(float(data_df['week'].iloc[0]))\
+    .strftime('%d/%m/%Y')
 date1 = DateEntry(dates_grid, state='readonly', width=42,
                   font=app_textbox_font)
 date1.set_date(start_date)
 
-end_date = datetime.fromtimestamp(float(
-                                  old_labels[len(
-                                    old_labels)-1])).strftime('%d/%m/%Y')
+end_date = datetime.fromtimestamp(float(data_df['week'].iloc[-1]))\
+    .strftime('%d/%m/%Y')
 date2 = DateEntry(dates_grid, state='readonly', width=43,
                   font=app_textbox_font)
 date2.set_date(end_date)
@@ -1154,10 +1430,18 @@ root.bind('<Configure>', resize_canvas)
 # Call the instance_changed function when a new instance is selected.
 combobox.bind('<<ComboboxSelected>>', instance_changed)
 
+# Call the instance_filter_changed function when the filter text or the sort
+# order changes.
+filter_text_box.bind('<KeyRelease>', instance_filter_changed)
+sort_combobox.bind('<<ComboboxSelected>>', instance_filter_changed)
+
 # Call the font_changed function when a new font is selected.
 font_combobox.bind('<<ComboboxSelected>>', font_changed)
 
 # Call the font_size_changed function when a new font size is selected.
 font_size_scale.bind('<ButtonRelease-1>', font_size_changed)
 
+# Report the time taken to show the first chart once the window is shown.
+root.after_idle(report_startup_time)
+
 root.mainloop()
@@ -0,0 +1,59 @@
+'''
+The startup loader prepares the front-end in the background, so the slow parts
+of starting it (importing numpy, pandas, matplotlib and tkcalendar, and
+indexing and loading the collected data) happen while the welcome window is
+shown, rather than after it is closed.
+
+Only the standard library is imported by this module itself. The modules
+imported in the background are kept by Python, so importing them again from
+the front-end once the loader has finished is immediate.
+'''
+
+from importlib import import_module
+from threading import Event, Thread
+from time import perf_counter
+
+# The modules the front-end needs, imported in the background.
+MODULES = ('numpy', 'pandas', 'matplotlib.backends.backend_tkagg',
+           'tkcalendar', 'pathvalidate', 'requests', 'activity_frames',
+           'activity_plot', 'ai_analysis')
+
+
+# Imports the front-end's modules, builds the index of the instances data has
+# been collected for, and loads the data for the first instance, on a
+# background thread.
+class StartupLoader:
+    def __init__(self, started=None):
+        self.started = started if started is not None else perf_counter()
+        self.instance_index = []
+        self.data = None
+        self.error = None
+        self.loaded_time = None
+        self.finished = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    # Start loading.
+    def start(self):
+        self.thread.start()
+        return self
+
+    # Import the modules and load the data. Any error is kept, so it can be
+    # reported by the front-end once it needs the results.
+    def run(self):
+        try:
+            for module in MODULES:
+                import_module(module)
+            from activity_frames import build_instance_index, InstanceCache
+            self.instance_index = build_instance_index()
+            self.data = InstanceCache()
+            if self.instance_index:
+                self.data.frame(self.instance_index[0]['name'])
+        except Exception as error:
+            self.error = error
+        self.loaded_time = perf_counter() - self.started
+        self.finished.set()
+
+    # Wait for loading to finish.
+    def wait(self):
+        self.finished.wait()
+        return self